@@ -0,0 +1,238 @@
+# bench/bench.py
+"""
+Офлайн-бенчмарк бота: разбор афиши и новостей, выборка недели и обработка
+сообщений по намерениям. Сеть не нужна: страницы helikon.ru берутся из
+bench/fixtures, БД — временная, Google Calendar — заглушка.
+
+    python bench/bench.py                  # полный прогон
+    python bench/bench.py --iterations 50  # быстрее
+    python bench/bench.py --json out.json  # сохранить результаты для сравнения
+    python bench/bench.py --record         # обновить фикстуры с живого сайта
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import httpx
+
+from common import (
+    FIXTURES_DIR,
+    INTENT_MESSAGES,
+    StubCalendarService,
+    fake_context,
+    fake_update,
+    load_fixture,
+    print_report,
+    season_playbill_html,
+    seed_events,
+    summarize,
+    use_temp_db,
+)
+
+
+def record_fixtures():
+    """Сохраняет текущие страницы helikon.ru в bench/fixtures (нужна сеть)."""
+    import requests
+    from parser import NEWS_URL, PLAYBILL_URL
+    from http_client import USER_AGENT
+    for name, url in (("playbill.html", PLAYBILL_URL), ("news.html", NEWS_URL)):
+        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        with open(os.path.join(FIXTURES_DIR, name), "w", encoding="utf-8") as f:
+            f.write(response.text)
+        print(f"{name}: {len(response.text)} байт")
+
+
+def time_sync(name, func, iterations):
+    latencies = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t)
+    return summarize(name, latencies, sum(latencies))
+
+
+async def time_async(name, factory, iterations):
+    """
+    await factory(i) возвращает корутину, которая и замеряется; подготовка
+    внутри factory (например, заполнение pending_events) в замер не входит.
+    """
+    latencies = []
+    for i in range(iterations):
+        coro = await factory(i)
+        t = time.perf_counter()
+        await coro
+        latencies.append(time.perf_counter() - t)
+    return summarize(name, latencies, sum(latencies))
+
+
+def bench_parsing(iterations, season_html):
+    import parser
+
+    playbill_html = load_fixture("playbill.html")
+    news_html = load_fixture("news.html")
+    season_events = parser._parse_afisha_html(season_html)
+    today = date.today()
+    monday = today - timedelta(days=today.weekday())
+    index = parser.index_events_by_date(season_events)
+
+    # parse_afisha целиком, с заглушкой requests.get: холодный кэш, попадание, ответ 304
+    def fake_get(url, headers=None, timeout=None):
+        status = 304 if headers and headers.get("If-None-Match") else 200
+        return SimpleNamespace(status_code=status, text=season_html, headers={"ETag": '"bench"'},
+                               raise_for_status=lambda: None)
+
+    parser.requests.get = fake_get
+
+    def cold():
+        parser.clear_playbill_cache()
+        parser.parse_afisha()
+
+    def revalidated():
+        parser.PLAYBILL_CACHE_TTL = 0
+        parser.parse_afisha()
+
+    rows = [
+        time_sync("разбор афиши (месяц)", lambda: parser._parse_afisha_html(playbill_html), iterations),
+        time_sync(f"разбор афиши (сезон, {len(season_events)})", lambda: parser._parse_afisha_html(season_html),
+                  max(5, iterations // 10)),
+        time_sync("разбор новостей", lambda: parser._parse_news_html(news_html), iterations),
+        time_sync("parse_afisha: холодный кэш", cold, max(5, iterations // 10)),
+    ]
+    parser.clear_playbill_cache()
+    parser.parse_afisha()
+    rows.append(time_sync("parse_afisha: попадание в кэш", parser.parse_afisha, iterations))
+    ttl = parser.PLAYBILL_CACHE_TTL
+    rows.append(time_sync("parse_afisha: ответ 304", revalidated, iterations))
+    parser.PLAYBILL_CACHE_TTL = ttl
+    rows.append(time_sync("get_events_for_week (фильтр)",
+                          lambda: parser.get_events_for_week(monday, monday + timedelta(days=6), season_events),
+                          iterations))
+    rows.append(time_sync("неделя по индексу дат",
+                          lambda: parser.events_in_range(index, monday, monday + timedelta(days=6)), iterations))
+    print(f"кэш афиши: {parser.get_playbill_cache_stats()}")
+    return rows
+
+
+async def prepare_snapshot(season_html):
+    """Заполняет снимок prefetch через настоящий асинхронный путь, но с локальным транспортом."""
+    import http_client
+    import prefetch
+
+    news_html = load_fixture("news.html")
+
+    def handler(request):
+        if "/news" in request.url.path:
+            return httpx.Response(200, content=news_html.encode("utf-8"))
+        return httpx.Response(200, text=season_html)
+
+    http_client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    await prefetch.refresh_snapshot()
+
+
+async def bench_handlers(iterations, users):
+    import bot
+
+    rows = []
+    for intent, text in INTENT_MESSAGES.items():
+        async def factory(i, text=text):
+            user_id = users[i % len(users)]
+            return bot.handle_message(fake_update(text, user_id, i), fake_context())
+        rows.append(await time_async(f"handle_message: {intent}", factory, iterations))
+
+    # Добавление и удаление: у каждой итерации своё название, чтобы не было конфликтов
+    async def add_factory(i):
+        text = f"Добавь репетицию «Бенч {i}» 15.10 с 12:00 до 13:00 в Стравинском"
+        return bot.handle_message(fake_update(text, users[i % len(users)], i), fake_context())
+    rows.append(await time_async("handle_message: add", add_factory, iterations))
+
+    async def delete_factory(i):
+        text = f"Удалить репетицию «Бенч {i}» 15.10"
+        return bot.handle_message(fake_update(text, users[i % len(users)], i), fake_context())
+    rows.append(await time_async("handle_message: delete", delete_factory, iterations))
+
+    # «да»: сначала вне замера запрашиваем неделю у пользователя без записей
+    async def confirm_factory(i):
+        user_id = 10_000_000 + i
+        context = fake_context()
+        await bot.handle_message(fake_update(INTENT_MESSAGES["my_week"], user_id, i), context)
+        return bot.handle_message(fake_update("да", user_id, i), context)
+    rows.append(await time_async("handle_message: confirm", confirm_factory, iterations))
+    return rows
+
+
+async def bench_outbox(iterations):
+    """Фоновая синхронизация с Calendar: пачка из 50 операций через заглушку сервиса."""
+    import calendar_sync
+    import db
+
+    service = StubCalendarService()
+    calendar_sync.get_calendar_service = lambda: service
+
+    async def factory(i):
+        ops = [
+            ("insert", f"hbbench{i:06d}x{j:03d}", {
+                "summary": "Репетиция", "start_time": "2026-10-15T12:00:00", "end_time": "2026-10-15T13:00:00",
+                "location": "Зал Стравинский", "description": "бенчмарк",
+            })
+            for j in range(50)
+        ]
+        db.add_events(1, [], ops)
+        return calendar_sync.process_outbox()
+
+    return [await time_async("calendar outbox: 50 операций", factory, max(5, iterations // 10))]
+
+
+async def run(args):
+    use_temp_db()
+    # bot.py при импорте настраивает логирование и создаёт схему — уже во временной БД
+    import bot  # noqa: F401
+    logging.getLogger().setLevel(logging.WARNING)
+
+    season_html = season_playbill_html(days=args.season_days)
+    users = list(range(1, args.users + 1))
+    seed_events(users, args.events_per_user)
+
+    results = {"parsing": bench_parsing(args.iterations, season_html)}
+    await prepare_snapshot(season_html)
+    results["handlers"] = await bench_handlers(args.iterations, users)
+    results["calendar"] = await bench_outbox(args.iterations)
+
+    print_report(results["parsing"], "Разбор страниц и выборка афиши")
+    print_report(results["handlers"], "Обработка сообщений по намерениям")
+    print_report(results["calendar"], "Синхронизация с Google Calendar (заглушка)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    import executor
+    import http_client
+    await http_client.close_client()
+    executor.shutdown_executor()
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Офлайн-бенчмарк helikon_bot")
+    argparser.add_argument("--iterations", type=int, default=200, help="повторов на сценарий")
+    argparser.add_argument("--users", type=int, default=500, help="пользователей в тестовой БД")
+    argparser.add_argument("--events-per-user", type=int, default=40, help="событий на пользователя")
+    argparser.add_argument("--season-days", type=int, default=300, help="дней в «раздутой» афише")
+    argparser.add_argument("--json", help="сохранить результаты в JSON")
+    argparser.add_argument("--record", action="store_true", help="обновить фикстуры с helikon.ru и выйти")
+    args = argparser.parse_args()
+
+    if args.record:
+        record_fixtures()
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
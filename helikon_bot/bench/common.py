@@ -0,0 +1,254 @@
+# bench/common.py
+# Общие заготовки для бенчмарков и нагрузочного теста: фикстуры helikon.ru,
+# «раздутая» афиша на сезон, временная БД, заглушки Telegram и Google Calendar.
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+
+# Модули бота лежат уровнем выше и импортируются как в bot_service.py
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# Сообщения по намерениям — как их пишут пользователи
+INTENT_MESSAGES = {
+    "my_week": "Что у меня на этой неделе?",
+    "my_next_week": "Что у меня на следующей неделе?",
+    "playbill_week": "Какие спектакли в театре на этой неделе?",
+    "playbill_next_week": "Какие спектакли в театре на следующей неделе?",
+    "news": "Есть ли новости?",
+    "conductor": "Кто дирижёр «Кармен»?",
+    "clarify": "Во сколько репетиция?",
+    "fallback": "Привет",
+}
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def season_playbill_html(start=None, days=300, per_day=(1, 3), seed=1):
+    """
+    Страница афиши на весь сезон: строки из фикстуры playbill.html, размноженные
+    на days дней начиная с start (по умолчанию — месяц назад), по per_day строк в день.
+    Образцами служат строки таблиц, которые разбирает сам парсер, так что подходит
+    и синтетическая фикстура, и записанная с сайта (bench.py --record).
+    Ссылки на другие месяцы убраны, чтобы обход афиши остановился на этой странице.
+    """
+    from copy import deepcopy
+    from lxml import etree, html as lxml_html
+    import parser
+
+    root = lxml_html.document_fromstring(load_fixture("playbill.html"))
+    templates = [
+        row for row in root.xpath('//table//tr')
+        if parser._parse_afisha_html(f"<table>{etree.tostring(row, encoding='unicode', with_tail=False)}</table>")
+    ]
+    if not templates:
+        raise ValueError("В bench/fixtures/playbill.html нет строк афиши, которые разбирает parser.py: "
+                         "проверьте фикстуру (bench.py --record) или разбор таблиц в парсере")
+    start = start or date.today() - timedelta(days=30)
+    rng = random.Random(seed)
+
+    rows = []
+    for offset in range(days):
+        day = (start + timedelta(days=offset)).strftime("%d.%m.%Y")
+        for _ in range(rng.randint(*per_day)):
+            row = deepcopy(rng.choice(templates))
+            row.tail = None
+            _set_row_date(row, day)
+            rows.append(row)
+
+    parent = templates[0].getparent()
+    position = parent.index(templates[0])
+    for row in templates:
+        row.drop_tree()
+    parent[position:position] = rows
+
+    for link in root.xpath('//a[@href]'):
+        if parser._PLAYBILL_PAGE_RE.search(link.get("href")):
+            del link.attrib["href"]
+    return lxml_html.tostring(root, encoding="unicode", doctype="<!DOCTYPE html>")
+
+
+def _set_row_date(row, day):
+    """Заменяет первую дату ДД.ММ.ГГГГ в первой ячейке строки на day."""
+    import parser
+    cell = next(row.iter("td"))
+    for element in cell.iter():
+        texts = [("text", element.text)]
+        if element is not cell:
+            texts.append(("tail", element.tail))
+        for attr, value in texts:
+            if value and parser._AFISHA_DATE_RE.search(value):
+                setattr(element, attr, parser._AFISHA_DATE_RE.sub(day, value, count=1))
+                return
+
+
+def use_temp_db():
+    """Переключает db.py на новую временную БД и создаёт схему. Возвращает путь."""
+    import db
+    path = os.path.join(tempfile.mkdtemp(prefix="helikon-bench-"), "bench.db")
+    db.close_connections()
+    db.DB_PATH = path
+    db.init_db()
+    return path
+
+
+def seed_events(users, events_per_user, weeks=(-8, 8), seed=1):
+    """Наполняет events историей: events_per_user событий на пользователя в диапазоне недель."""
+    import db
+    rng = random.Random(seed)
+    today = date.today()
+    for telegram_id in users:
+        db.create_or_update_user(telegram_id)
+        rows = []
+        for i in range(events_per_user):
+            day = today + timedelta(days=rng.randint(weeks[0] * 7, weeks[1] * 7))
+            rows.append({
+                "event_name": f"Репетиция {i}",
+                "date": day.isoformat(),
+                "start_time": f"{rng.randint(10, 19)}:00",
+                "end_time": "21:00",
+                "hall": rng.choice(["Стравинский", "Шаховской", "Покровский"]),
+                "event_type": "репетиция",
+                "role": "участие в оркестре — фагот",
+                "calendar_event_id": "",
+            })
+        db.add_events(telegram_id, rows)
+
+
+class FakeMessage:
+    def __init__(self, text, chat_id):
+        self.text = text
+        self.chat_id = chat_id
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        return SimpleNamespace(text=text)
+
+
+def fake_update(text, user_id, update_id=0):
+    """Минимальный Update для вызова обработчиков бота напрямую."""
+    message = FakeMessage(text, user_id)
+    user = SimpleNamespace(id=user_id, first_name="Бенч")
+    chat = SimpleNamespace(id=user_id, type="private")
+    return SimpleNamespace(
+        update_id=update_id,
+        message=message,
+        effective_message=message,
+        effective_user=user,
+        effective_chat=chat,
+    )
+
+
+def fake_context(user_data=None):
+    return SimpleNamespace(user_data=user_data if user_data is not None else {}, chat_data={}, bot_data={},
+                           args=[], job_queue=None, application=None)
+
+
+class _StubRequest:
+    def __init__(self, service, kind, event_id, body=None):
+        self.service = service
+        self.kind = kind
+        self.event_id = event_id
+        self.body = body
+
+    def execute(self, http=None, num_retries=0):
+        return self.service.handle(self)
+
+
+class _StubBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id))
+
+    def execute(self, http=None):
+        # Один batch — одна задержка «сети», как у настоящего batch API
+        self.service.wait()
+        for request, request_id in self.requests:
+            self.callback(request_id, self.service.apply(request), None)
+
+
+class _StubEvents:
+    def __init__(self, service):
+        self.service = service
+
+    def insert(self, calendarId, body):
+        return _StubRequest(self.service, "insert", body.get("id"), body)
+
+    def update(self, calendarId, eventId, body):
+        return _StubRequest(self.service, "update", eventId, body)
+
+    def delete(self, calendarId, eventId):
+        return _StubRequest(self.service, "delete", eventId)
+
+
+class StubCalendarService:
+    """Заглушка googleapiclient-сервиса Calendar: хранит события в памяти, latency — задержка запроса."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.events_store = {}
+        self.requests = 0
+
+    def events(self):
+        return _StubEvents(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _StubBatch(self, callback)
+
+    def wait(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def handle(self, request):
+        self.wait()
+        return self.apply(request)
+
+    def apply(self, request):
+        if request.kind == "delete":
+            self.events_store.pop(request.event_id, None)
+            return ""
+        event_id = request.event_id or f"stub{len(self.events_store)}"
+        self.events_store[event_id] = request.body
+        return dict(request.body, id=event_id)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, elapsed):
+    """Строка отчёта: число операций, пропускная способность и p50/p95/p99 в миллисекундах."""
+    values = sorted(latencies)
+    return {
+        "name": name,
+        "n": len(values),
+        "ops_per_sec": len(values) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+def print_report(rows, title):
+    print(f"\n{title}")
+    print(f"{'сценарий':<34}{'n':>7}{'оп/с':>11}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for row in rows:
+        print(f"{row['name']:<34}{row['n']:>7}{row['ops_per_sec']:>11.1f}"
+              f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
@@ -0,0 +1,330 @@
+# bench/loadtest.py
+"""
+Нагрузочный тест бота: тысячи синтетических пользователей пишут боту
+одновременно, а настоящий Application (обработчики, JobQueue, пул потоков,
+SQLite) отвечает им через поддельный Telegram Bot API. helikon.ru и
+Google Calendar заменены локальными заглушками, сеть не нужна.
+
+Для каждого уровня конкурентности печатаются задержка ответа (от отправки
+сообщения до sendMessage) и пропускная способность, простои цикла событий,
+очередь пула потоков и конкуренция за SQLite (время записей, ошибки
+«database is locked»).
+
+    python bench/loadtest.py                              # уровни 10, 100, 1000
+    python bench/loadtest.py --levels 100,1000,3000 --messages 3
+    python bench/loadtest.py --concurrent-updates 256     # обработка обновлений параллельно
+    python bench/loadtest.py --mode webhook --concurrent-updates 64
+    python bench/loadtest.py --json load.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+
+from common import (
+    INTENT_MESSAGES,
+    load_fixture,
+    percentile,
+    season_playbill_html,
+    seed_events,
+    use_temp_db,
+)
+from stub_servers import FakeTelegram, StubCalendar, StubHelikon, StubServers
+
+# Сколько ждать первого обхода афиши после старта бота (секунды)
+SNAPSHOT_TIMEOUT = 30
+
+# Сценарий одного музыканта перед репетицией; {uid} — чтобы записи не совпадали
+SESSION = [
+    INTENT_MESSAGES["my_week"],
+    INTENT_MESSAGES["playbill_week"],
+    "Добавь репетицию «Нагрузка {uid}» 15.10 с 12:00 до 13:00 в Стравинском",
+    INTENT_MESSAGES["news"],
+    INTENT_MESSAGES["my_next_week"],
+    "Удалить репетицию «Нагрузка {uid}» 15.10",
+]
+
+
+class ReplyWaiters:
+    """Связывает ответы поддельного Telegram (поток заглушек) с ожидающими пользователями."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.futures = {}
+
+    def expect(self, chat_id):
+        future = self.loop.create_future()
+        self.futures[chat_id] = future
+        return future
+
+    def on_reply(self, chat_id, text, received_at):
+        self.loop.call_soon_threadsafe(self._resolve, chat_id, received_at)
+
+    def _resolve(self, chat_id, received_at):
+        future = self.futures.pop(chat_id, None)
+        if future is not None and not future.done():
+            future.set_result(received_at)
+
+
+class DbTimings:
+    """Оборачивает функции db.py в модулях бота: время вызова и ошибки блокировки."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.locked = 0
+
+    def install(self, *modules):
+        for module in modules:
+            for name, func in list(vars(module).items()):
+                if callable(func) and getattr(func, "__module__", None) == "db":
+                    setattr(module, name, self._wrap(func))
+
+    def _wrap(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" in str(e):
+                    with self.lock:
+                        self.locked += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - t
+                with self.lock:
+                    self.calls.setdefault(func.__name__, []).append(elapsed)
+        return wrapper
+
+    def report(self):
+        with self.lock:
+            calls = {name: sorted(values) for name, values in self.calls.items()}
+            locked = self.locked
+        return {
+            "locked_errors": locked,
+            "functions": {
+                name: {
+                    "n": len(values),
+                    "p95_ms": percentile(values, 95) * 1000,
+                    "max_ms": values[-1] * 1000,
+                }
+                for name, values in sorted(calls.items())
+            },
+        }
+
+
+async def monitor(stop, interval, samples):
+    """Замеряет, насколько позже положенного просыпается цикл событий, и пик очереди пула."""
+    from executor import get_executor_stats
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples["lags"].append(max(0.0, time.perf_counter() - t - interval))
+        samples["queue_peak"] = max(samples["queue_peak"], get_executor_stats()["queued"])
+
+
+async def simulated_user(uid, messages, telegram, waiters, result, timeout, think_time):
+    for i in range(messages):
+        text = SESSION[i % len(SESSION)].format(uid=uid)
+        future = waiters.expect(uid)
+        sent_at = time.perf_counter()
+        telegram.send_update(uid, text)
+        try:
+            received_at = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            result["timeouts"] += 1
+            waiters.futures.pop(uid, None)
+            continue
+        result["latencies"].append(received_at - sent_at)
+        if think_time:
+            await asyncio.sleep(random.uniform(0, think_time))
+
+
+async def run_level(level, stage, args, telegram, waiters, db_timings, calendar):
+    import db
+
+    db_timings.reset()
+    calendar_before = (calendar.batches, calendar.operations)
+    result = {"latencies": [], "timeouts": 0}
+    samples = {"lags": [], "queue_peak": 0}
+    stop = asyncio.Event()
+    monitor_task = asyncio.create_task(monitor(stop, args.lag_interval, samples))
+
+    base = (stage + 1) * 1_000_000
+    t = time.perf_counter()
+    await asyncio.gather(*(
+        simulated_user(base + i, args.messages, telegram, waiters, result, args.timeout, args.think_time)
+        for i in range(level)
+    ))
+    elapsed = time.perf_counter() - t
+    stop.set()
+    await monitor_task
+
+    latencies = sorted(result["latencies"])
+    lags = sorted(samples["lags"])
+    return {
+        "users": level,
+        "replies": len(latencies),
+        "timeouts": result["timeouts"],
+        "elapsed_s": elapsed,
+        "replies_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "loop_lag_p99_ms": percentile(lags, 99) * 1000,
+        "loop_lag_max_ms": (lags[-1] if lags else 0.0) * 1000,
+        # Простой — всё, на что цикл опоздал больше чем на 50 мс
+        "loop_stall_total_s": sum(lag for lag in lags if lag > 0.05),
+        "executor_queue_peak": samples["queue_peak"],
+        "sqlite": db_timings.report(),
+        "calendar_batches": calendar.batches - calendar_before[0],
+        "calendar_operations": calendar.operations - calendar_before[1],
+        "outbox": db.get_calendar_outbox_stats(),
+    }
+
+
+def print_level(row):
+    print(f"\n{row['users']} пользователей: {row['replies']} ответов за {row['elapsed_s']:.1f} с "
+          f"({row['replies_per_sec']:.1f} отв/с), таймаутов: {row['timeouts']}")
+    print(f"  задержка ответа, мс: p50 {row['p50_ms']:.1f}  p95 {row['p95_ms']:.1f}  "
+          f"p99 {row['p99_ms']:.1f}  max {row['max_ms']:.1f}")
+    print(f"  цикл событий: опоздание p99 {row['loop_lag_p99_ms']:.1f} мс, max {row['loop_lag_max_ms']:.1f} мс, "
+          f"простои >50 мс: {row['loop_stall_total_s']:.2f} с; пик очереди пула: {row['executor_queue_peak']}")
+    sqlite_report = row["sqlite"]
+    print(f"  SQLite: ошибок «database is locked»: {sqlite_report['locked_errors']}")
+    for name, stats in sqlite_report["functions"].items():
+        print(f"    {name:<32}{stats['n']:>7}  p95 {stats['p95_ms']:>8.2f} мс  max {stats['max_ms']:>8.2f} мс")
+    print(f"  Google Calendar: batch-запросов {row['calendar_batches']}, операций {row['calendar_operations']}, "
+          f"очередь: {row['outbox']}")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    waiters = ReplyWaiters(loop)
+    telegram = FakeTelegram(on_reply=waiters.on_reply)
+    calendar = StubCalendar(latency=args.calendar_latency)
+    # Страница афиши появится ниже: для неё нужен parser, а его до адресов заглушек импортировать нельзя
+    helikon = StubHelikon("", load_fixture("news.html"), latency=args.site_latency)
+    stubs = StubServers(telegram, helikon, calendar).start()
+
+    # Адреса читаются при импорте модулей бота, поэтому задаются до него
+    # (в том числе до season_playbill_html, которая импортирует parser)
+    os.environ["HELIKON_PLAYBILL_URL"] = stubs.url("helikon") + "/ru/playbill"
+    os.environ["HELIKON_NEWS_URL"] = stubs.url("helikon") + "/ru/news/"
+    os.environ["GOOGLE_CALENDAR_API_ENDPOINT"] = stubs.url("calendar") + "/"
+    helikon.set_page("/ru/playbill", season_playbill_html(days=args.season_days))
+    use_temp_db()
+    import bot
+    import calendar_sync
+    import db
+    import executor
+    import google_calendar
+    import http_client
+    import parser
+    import prefetch
+    import users
+    from google.auth.credentials import AnonymousCredentials
+    from update_processor import PerChatUpdateProcessor
+
+    # Если какой-то модуль бота импортировали раньше, адреса остались боевыми —
+    # тогда тест пошёл бы на helikon.ru и в Google Calendar
+    for name, actual, stub in (
+        ("parser.PLAYBILL_URL", parser.PLAYBILL_URL, stubs.url("helikon")),
+        ("parser.NEWS_URL", parser.NEWS_URL, stubs.url("helikon")),
+        ("google_calendar.CALENDAR_API_ENDPOINT", google_calendar.CALENDAR_API_ENDPOINT, stubs.url("calendar")),
+    ):
+        if not (actual or "").startswith(stub):
+            raise SystemExit(f"{name} = {actual!r}, а не заглушка {stub}: модули бота "
+                             f"импортированы до того, как заданы адреса заглушек")
+
+    logging.getLogger().setLevel(logging.WARNING)
+    google_calendar._creds = AnonymousCredentials()
+    seed_events(range(1, args.users + 1), args.events_per_user)
+
+    db_timings = DbTimings()
+    db_timings.install(bot, calendar_sync, prefetch, users)
+
+    options = {}
+    if args.concurrent_updates:
+        options["concurrent_updates"] = PerChatUpdateProcessor(args.concurrent_updates)
+    app = bot.build_application("1:load", base_url=stubs.url("telegram") + "/bot", **options)
+    levels = [int(level) for level in args.levels.split(",")]
+    results = []
+    async with app:
+        await app.start()
+        if args.mode == "webhook":
+            port = _free_port()
+            await app.updater.start_webhook(listen="127.0.0.1", port=port, url_path="telegram",
+                                            webhook_url=f"http://127.0.0.1:{port}/telegram",
+                                            secret_token="load-test-secret")
+        else:
+            await app.updater.start_polling(poll_interval=0, timeout=1)
+        # Первый обход афиши выполняет задача prefetch сразу после старта
+        deadline = time.monotonic() + SNAPSHOT_TIMEOUT
+        while prefetch.get_snapshot_info()["afisha_updated_at"] is None:
+            if time.monotonic() > deadline:
+                raise SystemExit(f"Афиша не загрузилась с заглушки за {SNAPSHOT_TIMEOUT} с "
+                                 f"(ошибок подряд: {prefetch.get_snapshot_info()['failures']})")
+            await asyncio.sleep(0.05)
+
+        for stage, level in enumerate(levels):
+            row = await run_level(level, stage, args, telegram, waiters, db_timings, calendar)
+            print_level(row)
+            results.append(row)
+
+        await app.updater.stop()
+        await app.stop()
+
+    if telegram.webhook_errors:
+        print(f"Ошибок доставки на webhook: {telegram.webhook_errors}")
+    await http_client.close_client()
+    executor.shutdown_executor()
+    db.close_connections()
+    stubs.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "levels": results}, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Нагрузочный тест helikon_bot")
+    argparser.add_argument("--levels", default="10,100,1000", help="число одновременных пользователей по этапам")
+    argparser.add_argument("--messages", type=int, default=len(SESSION), help="сообщений от каждого пользователя")
+    argparser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между сообщениями, с")
+    argparser.add_argument("--timeout", type=float, default=60.0, help="сколько ждать ответа, с")
+    argparser.add_argument("--concurrent-updates", type=int, default=0,
+                           help="параллельная обработка обновлений в Application (0 — по одному)")
+    argparser.add_argument("--mode", choices=("polling", "webhook"), default="polling",
+                           help="как бот получает обновления от поддельного Telegram")
+    argparser.add_argument("--users", type=int, default=500, help="пользователей с историей в тестовой БД")
+    argparser.add_argument("--events-per-user", type=int, default=40, help="событий на пользователя")
+    argparser.add_argument("--season-days", type=int, default=300, help="дней в «раздутой» афише")
+    argparser.add_argument("--site-latency", type=float, default=0.05, help="задержка заглушки helikon.ru, с")
+    argparser.add_argument("--calendar-latency", type=float, default=0.1, help="задержка заглушки Calendar, с")
+    argparser.add_argument("--lag-interval", type=float, default=0.01, help="шаг замера цикла событий, с")
+    argparser.add_argument("--json", help="сохранить результаты в JSON")
+    asyncio.run(run(argparser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+# bench/stub_servers.py
+# Локальные заглушки для нагрузочного теста: Telegram Bot API, helikon.ru и
+# Google Calendar API. Все три работают в отдельном потоке со своим циклом
+# событий, чтобы их обработка не смешивалась с замерами цикла бота.
+import asyncio
+import email.parser
+import hashlib
+import json
+import threading
+import time
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+
+_REASONS = {200: "OK", 204: "No Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found"}
+
+
+class MiniHTTPServer:
+    """
+    Минимальный HTTP/1.1-сервер на asyncio с keep-alive. handler(request) —
+    корутина, возвращающая (status, headers, body); request — SimpleNamespace
+    с method, path, query, headers (ключи в нижнем регистре) и body.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = None
+        self.port = None
+        self.requests = 0
+        self._connections = set()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._serve, host, port, limit=2 ** 20)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            # wait_closed не закрывает keep-alive соединения — завершаем их сами
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                url = urlsplit(target)
+                request = SimpleNamespace(method=method, path=url.path, query=dict(parse_qsl(url.query)),
+                                          headers=headers, body=body)
+                self.requests += 1
+                status, response_headers, response_body = await self.handler(request)
+
+                head = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}", f"Content-Length: {len(response_body)}"]
+                head += [f"{name}: {value}" for name, value in response_headers.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + response_body)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # CancelledError — остановка сервера посреди long polling
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+
+def _json_response(payload, status=200):
+    return status, {"Content-Type": "application/json"}, json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+class FakeTelegram:
+    """
+    Поддельный Bot API: getUpdates отдаёт синтетические сообщения (long polling
+    с коротким таймаутом), sendMessage вызывает on_reply(chat_id, text, t) —
+    t по time.perf_counter, единым для всех потоков процесса. После setWebhook
+    обновления не копятся, а отправляются POST-запросами на адрес бота, как это
+    делает настоящий Telegram: не больше max_connections одновременно.
+    """
+
+    BOT = {"id": 1, "is_bot": True, "first_name": "Helikon Load", "username": "helikon_load_bot"}
+    MAX_POLL_TIMEOUT = 1.0
+    DEFAULT_MAX_CONNECTIONS = 40
+
+    def __init__(self, on_reply=None):
+        self.on_reply = on_reply
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.replies = 0
+        self.loop = None
+        self._arrived = None
+        self.webhook = None
+        self.webhook_errors = 0
+        self._webhook_client = None
+        self._webhook_slots = None
+
+    def push_update(self, chat_id, text):
+        """Ставит сообщение пользователя в очередь; вызывается в цикле заглушек."""
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": f"Музыкант {chat_id}"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"Музыкант {chat_id}"},
+            "text": text,
+        }
+        update = {"update_id": self.next_update_id, "message": message}
+        self.next_update_id += 1
+        self.next_message_id += 1
+        if self.webhook is not None:
+            self.loop.create_task(self._deliver(update))
+            return
+        self.updates.append(update)
+        self._arrived.set()
+
+    def send_update(self, chat_id, text):
+        """Потокобезопасная обёртка над push_update для кода из другого цикла."""
+        self.loop.call_soon_threadsafe(self.push_update, chat_id, text)
+
+    async def handle(self, request):
+        method = request.path.rsplit("/", 1)[-1]
+        params = dict(request.query)
+        content_type = request.headers.get("content-type", "")
+        if request.body and content_type.startswith("application/json"):
+            params.update(json.loads(request.body))
+        elif request.body:
+            params.update(parse_qsl(request.body.decode("utf-8")))
+
+        if method == "getMe":
+            return _json_response({"ok": True, "result": self.BOT})
+        if method == "getUpdates":
+            return _json_response({"ok": True, "result": await self._get_updates(params)})
+        if method == "sendMessage":
+            return _json_response({"ok": True, "result": self._send_message(params)})
+        if method == "setWebhook":
+            return _json_response({"ok": True, "result": await self._set_webhook(params)})
+        if method == "deleteWebhook":
+            return _json_response({"ok": True, "result": await self._set_webhook({})})
+        return _json_response({"ok": True, "result": True})
+
+    async def _set_webhook(self, params):
+        if self._webhook_client is not None:
+            await self._webhook_client.aclose()
+            self._webhook_client = None
+        if not params.get("url"):
+            self.webhook = None
+            return True
+        max_connections = int(params.get("max_connections") or self.DEFAULT_MAX_CONNECTIONS)
+        self.webhook = {"url": params["url"], "secret_token": params.get("secret_token"),
+                        "max_connections": max_connections}
+        self._webhook_client = httpx.AsyncClient(
+            timeout=30, limits=httpx.Limits(max_connections=max_connections))
+        self._webhook_slots = asyncio.Semaphore(max_connections)
+        return True
+
+    async def _deliver(self, update):
+        headers = {}
+        if self.webhook["secret_token"]:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook["secret_token"]
+        async with self._webhook_slots:
+            try:
+                response = await self._webhook_client.post(self.webhook["url"], json=update, headers=headers)
+                if response.status_code != 200:
+                    self.webhook_errors += 1
+            except httpx.HTTPError:
+                self.webhook_errors += 1
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), self.MAX_POLL_TIMEOUT)
+        # Подтверждённые обновления (id < offset) больше не нужны
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def _send_message(self, params):
+        received_at = time.perf_counter()
+        chat_id = int(params["chat_id"])
+        self.replies += 1
+        if self.on_reply is not None:
+            self.on_reply(chat_id, params.get("text", ""), received_at)
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.BOT,
+            "text": params.get("text", ""),
+        }
+
+
+class StubHelikon:
+    """Заглушка helikon.ru: одна страница афиши и новости, с ETag и ответами 304."""
+
+    def __init__(self, playbill_html, news_html, latency=0.0):
+        self.pages = {}
+        self.set_page("/ru/playbill", playbill_html)
+        self.set_page("/ru/news/", news_html)
+        self.latency = latency
+        self.not_modified = 0
+
+    def set_page(self, path, html):
+        body = html.encode("utf-8")
+        self.pages[path] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        page = self.pages.get(request.path) or self.pages.get(request.path.rstrip("/") + "/")
+        if page is None:
+            return 404, {}, b""
+        body, etag = page
+        if request.headers.get("if-none-match") == etag:
+            self.not_modified += 1
+            return 304, {"ETag": etag}, b""
+        return 200, {"Content-Type": "text/html; charset=utf-8", "ETag": etag}, body
+
+
+class StubCalendar:
+    """
+    Заглушка Google Calendar API v3: insert/update/delete событий и batch-эндпоинт
+    /batch/calendar/v3 в формате multipart/mixed, как его собирает googleapiclient.
+    latency — задержка на HTTP-запрос (batch целиком — один запрос).
+    """
+
+    BOUNDARY = "batch_helikon_stub"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.events = {}
+        self.batches = 0
+        self.operations = 0
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.path.startswith("/batch/"):
+            return self._batch(request)
+        status, payload = self._apply(request.method, request.path, request.body)
+        return status, {"Content-Type": "application/json"}, payload
+
+    def _apply(self, method, path, body):
+        self.operations += 1
+        parts = path.rstrip("/").split("/")
+        event_id = parts[-1] if parts[-2] == "events" else None
+        if method == "DELETE":
+            if self.events.pop(event_id, None) is None:
+                return 404, json.dumps({"error": {"code": 404, "message": "Not Found"}}).encode()
+            return 204, b""
+        event = json.loads(body or b"{}")
+        if method == "POST":
+            event_id = event.get("id") or f"stub{len(self.events)}"
+            if event_id in self.events:
+                return 409, json.dumps({"error": {"code": 409, "message": "duplicate"}}).encode()
+        event["id"] = event_id
+        self.events[event_id] = event
+        return 200, json.dumps(event, ensure_ascii=False).encode("utf-8")
+
+    def _batch(self, request):
+        self.batches += 1
+        header = f"content-type: {request.headers['content-type']}\r\n\r\n"
+        message = email.parser.Parser().parsestr(header + request.body.decode("utf-8"))
+
+        chunks = []
+        for part in message.get_payload():
+            inner = part.get_payload()
+            request_line, _, rest = inner.partition("\n")
+            method, target, _ = request_line.strip().split(" ", 2)
+            inner_message = email.parser.Parser().parsestr(rest)
+            status, payload = self._apply(method, urlsplit(target).path, inner_message.get_payload().encode("utf-8"))
+            content_id = part["Content-ID"].strip("<>")
+            chunks.append(
+                f"--{self.BOUNDARY}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {_REASONS.get(status, 'Error')}\r\n"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{payload.decode('utf-8')}\r\n"
+            )
+        body = ("".join(chunks) + f"--{self.BOUNDARY}--\r\n").encode("utf-8")
+        return 200, {"Content-Type": f"multipart/mixed; boundary={self.BOUNDARY}"}, body
+
+
+class StubServers:
+    """Запускает заглушки в фоновом потоке; адреса доступны после start()."""
+
+    def __init__(self, telegram, helikon, calendar):
+        self.telegram = telegram
+        self.helikon = helikon
+        self.calendar = calendar
+        self.servers = {}
+        self.loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stub-servers", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.telegram.loop = self.loop
+        self.telegram._arrived = asyncio.Event()
+        for name, stub in (("telegram", self.telegram), ("helikon", self.helikon), ("calendar", self.calendar)):
+            self.servers[name] = self.loop.run_until_complete(MiniHTTPServer(stub.handle).start())
+        self._ready.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.servers[name].port}"
+
+    def stop(self):
+        async def close_all():
+            await self.telegram._set_webhook({})
+            for server in self.servers.values():
+                await server.close()
+        asyncio.run_coroutine_threadsafe(close_all(), self.loop).result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
@@ -1,20 +1,45 @@
 # bot.py
+import asyncio
 import logging
-import re
+import os
+import secrets
 from datetime import datetime, timedelta
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 from db import (
     init_db,
-    create_or_update_user,
+    close_connections,
     add_event,
+    add_events,
     get_events_for_next_week,
     get_events_for_current_week,
     delete_event
 )
-from parser import parse_news, get_events_for_week
-from google_calendar import get_calendar_service, create_calendar_event, delete_calendar_event
+from prefetch import get_afisha_for_range, get_news_snapshot, get_snapshot_info, schedule_prefetch
+from http_client import close_client
+from executor import run_blocking, shutdown_executor
+from google_calendar import calendar_event_key, calendar_event_payload, schedule_token_refresh
+from calendar_sync import schedule_outbox
+from reminders import add_reminders, remove_reminders, schedule_reminders
+from broadcast import broadcast_status, schedule_broadcasts, start_digest, stop_broadcasts
+from persistence import SQLitePersistence, schedule_state_eviction
+from users import flush_users, load_known_users, remember_user
+import schedule_cache
+from update_processor import PerChatUpdateProcessor
+from intents import classify
+from commands import parse_event_command
+from metrics import Counter, Histogram, start_metrics_server, timed
+from profiling import (
+    TracedRequest,
+    install_profile_signal,
+    is_admin,
+    span,
+    start_profiling,
+    stop_profiling,
+    top_functions,
+    trace,
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,395 +51,361 @@ logger = logging.getLogger(__name__)
 # Инициализация БД при старте
 init_db()
 
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Время обработки сообщения по намерениям", ["intent"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках по намерениям", ["intent"])
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, intent="start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    create_or_update_user(user_id)
+    with trace(f"update {update.update_id}") as tags:
+        tags["intent"] = "start"
+        remember_user(user_id)
+        await update.message.reply_text(
+            "Здравствуйте! Я ваш личный менеджер по расписанию. Чем могу помочь?"
+        )
+
+async def _send_profile(bot, chat_id, session):
+    top = "\n".join(f"{count:>6}  {name}" for name, count in top_functions(session))
+    await bot.send_message(chat_id, f"Профиль готов: {session.samples} сэмплов.\n"
+                                    f"Чаще всего на вершине стека:\n{top}")
+    if session.path:
+        with open(session.path, "rb") as f:
+            await bot.send_document(chat_id, f, filename=os.path.basename(session.path))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /profile 30 — профилировать 30 секунд, /profile 200u — до обработки 200 обновлений,
+    /profile stop — закончить раньше. Готовый профиль (collapsed stacks) присылается в чат.
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+
+    arg = context.args[0].lower() if context.args else "30"
+    if arg == "stop":
+        stopped = stop_profiling()
+        await update.message.reply_text("Профилирование останавливается..." if stopped else "Профилирование не запущено.")
+        return
+    try:
+        count = int(arg.rstrip("su"))
+    except ValueError:
+        count = 0
+    if count <= 0:
+        await update.message.reply_text("Использование: /profile 30 (секунд), /profile 200u (обновлений) или /profile stop")
+        return
+    seconds, updates = (None, count) if arg.endswith("u") else (count, None)
+
+    loop = asyncio.get_running_loop()
+    bot, chat_id = context.bot, update.effective_chat.id
+
+    def on_finish(session):
+        # Вызывается из потока профайлера — отправку передаём в цикл событий бота
+        asyncio.run_coroutine_threadsafe(_send_profile(bot, chat_id, session), loop)
+
+    if not start_profiling(seconds=seconds, updates=updates, on_finish=on_finish):
+        await update.message.reply_text("Профилирование уже идёт. /profile stop — остановить.")
+        return
     await update.message.reply_text(
-        "Здравствуйте! Я ваш личный менеджер по расписанию. Чем могу помочь?"
+        f"Профилирование запущено: {f'{seconds} с' if seconds else f'{updates} обновлений'}."
+    )
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /broadcast — разослать дайджест (афиша следующей недели и новые новости) сейчас,
+    /broadcast status — ход последних рассылок, /broadcast stop — отменить текущие.
+    """
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+
+    arg = context.args[0].lower() if context.args else ""
+    if arg == "status":
+        await update.message.reply_text(await broadcast_status())
+    elif arg == "stop":
+        stopped = await stop_broadcasts()
+        await update.message.reply_text(f"Отменено рассылок: {stopped}." if stopped else "Активных рассылок нет.")
+    elif not arg:
+        broadcast_id = await start_digest(context.application)
+        await update.message.reply_text(
+            f"Рассылка #{broadcast_id} запущена. /broadcast status — ход рассылки." if broadcast_id
+            else "Рассылать нечего: на следующей неделе нет событий и новых новостей."
+        )
+    else:
+        await update.message.reply_text("Использование: /broadcast, /broadcast status или /broadcast stop")
+
+# Дирижёры спектаклей; порядок важен — «кармен щедрин» проверяется раньше «кармен»
+CONDUCTORS = {
+    "в гостях у оперной сказки": "Михаил Егиазарьян",
+    "маддалена": "Валерий Кирьянов",
+    "кармен щедрин": "Феликс Коробов",
+    "кармен": "Феликс Коробов",
+    "алеко": "Феликс Коробов",
+    "паяцы": "Тимур Зангиев",
+    "борис годунов": "Александр Ведерников",
+    "сказки гофмана": "Феликс Коробов",
+    "травиата": "Феликс Коробов",
+    "тоска": "Феликс Коробов",
+    "аида": "Феликс Коробов",
+    "ключ на мостовой": "Дмитрий Бертман",
+    "золушка": "Феликс Коробов",
+    "диалоги кармелиток": "Феликс Коробов",
+    "медиум": "Дмитрий Бертман",
+    "кофейная кантата": "Дмитрий Бертман",
+    "летучая мышь": "Феликс Коробов",
+    "свет вифлеемской звезды": "Дмитрий Бертман",
+    "новый год в сказочном городе": "Дмитрий Бертман"
+}
+_CONDUCTOR_NOISE = ["спектакль", "репетиц", "дириж", "кто", "«", "»", '"', "‘", "’"]
+
+def _week_range(weeks_ahead=0):
+    today = datetime.now().date()
+    start_of_week = today - timedelta(days=today.weekday()) + timedelta(weeks=weeks_ahead)
+    return start_of_week, start_of_week + timedelta(days=6)
+
+async def _load_my_week(user_id, weeks_ahead):
+    """
+    События пользователя за неделю и словарь готовых текстов ответов для неё.
+    Если неделя уже в schedule_cache, БД не трогается. Словарь пуст и не
+    сохраняется, если события успели измениться, пока шёл запрос.
+    """
+    monday, _ = _week_range(weeks_ahead)
+    entry = schedule_cache.get(user_id, monday)
+    if entry is not None:
+        return entry["events"], entry["replies"]
+    since = schedule_cache.generation()
+    fetch = get_events_for_next_week if weeks_ahead else get_events_for_current_week
+    events = await run_blocking(fetch, user_id, key=user_id)
+    entry = schedule_cache.put(user_id, monday, events, since)
+    return events, entry["replies"] if entry is not None else {}
+
+def _render_my_schedule(header, events):
+    return header + "".join(
+        f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event']}» в зале {ev['hall']}.\n"
+        for ev in events
     )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
-    text_lower = text.lower()
     user_id = update.effective_user.id
-    create_or_update_user(user_id)
-
-    # === Удаление репетиции или спектакля ===
-    if ("удалить" in text_lower) and ("репетиц" in text_lower or "спектакл" in text_lower):
-        title_match = re.search(r'[«"‘](.+?)[»"’]', text)
-        if not title_match:
-            await update.message.reply_text(
-                "Укажите название спектакля/репетиции в кавычках, например: удалить спектакль «Кармен» 15.10"
-            )
-            return
-
-        title = title_match.group(1).strip()
-
-        # Обработка даты (цифры или название месяца)
-        date_match = re.search(r"(\d{1,2})[ .\-](\d{1,2})(?:[ .\-](\d{4}))?", text)
-        if date_match:
-            day = int(date_match.group(1))
-            month = int(date_match.group(2))
-            year = int(date_match.group(3)) if date_match.group(3) else datetime.now().year
-        else:
-            month_map = {
-                'январ': 1, 'феврал': 2, 'март': 3, 'апрел': 4, 'май': 5, 'июн': 6,
-                'июл': 7, 'август': 8, 'сентябр': 9, 'октябр': 10, 'ноябр': 11, 'декабр': 12
-            }
-            date_match_text = re.search(r"(\d{1,2})\s+([а-яё]+)", text, re.IGNORECASE)
-            if date_match_text:
-                day = int(date_match_text.group(1))
-                month_word = date_match_text.group(2).lower()
-                month = None
-                for key, val in month_map.items():
-                    if month_word.startswith(key):
-                        month = val
-                        break
-                if month is None:
-                    await update.message.reply_text("Не удалось распознать месяц. Укажите дату как 15.10 или 15 октября.")
-                    return
-                year = datetime.now().year
-            else:
-                await update.message.reply_text("Укажите дату (например: 15.10 или 15 октября)")
-                return
-
-        try:
-            event_date = datetime(year, month, day).date()
-            date_iso = event_date.strftime("%Y-%m-%d")
-        except ValueError:
-            await update.message.reply_text("Некорректная дата.")
-            return
-
-        cal_event_id = delete_event(user_id, title, date_iso)
-
-        if not cal_event_id:
-            await update.message.reply_text(
-                f"Событие «{title}» на {date_iso} не найдено в вашем расписании."
-            )
-            return
-
-        try:
-            service = get_calendar_service()
-            delete_calendar_event(service, cal_event_id)
-        except Exception as e:
-            logger.error(f"Ошибка при удалении из Google Calendar: {e}")
-            await update.message.reply_text(
-                f"✅ Событие удалено из локального расписания, но не удалось удалить из Google Calendar: {e}"
-            )
-            return
+    with trace(f"update {update.update_id}") as tags:
+        with span("parse"):
+            intent, hits = classify(text.lower())
+        tags["intent"] = intent
 
-        await update.message.reply_text(
-            f"🗑️ Событие «{title}» на {date_iso} успешно удалено из расписания и Google Calendar."
-        )
+        with HANDLER_SECONDS.time(intent=intent):
+            try:
+                remember_user(user_id)
+                await INTENT_HANDLERS[intent](update, context, text, hits)
+            except Exception:
+                HANDLER_ERRORS.inc(intent=intent)
+                raise
+
+# === Удаление репетиции или спектакля ===
+async def handle_delete(update, context, text, hits):
+    user_id = update.effective_user.id
+    with span("parse"):
+        command, error = parse_event_command(text, "delete", hits)
+    if error:
+        await update.message.reply_text(error)
         return
+    title, date_iso = command["title"], command["date"]
 
-    # === Ручное добавление репетиции или спектакля по шаблону ===
-    if "добавь" in text_lower and ("репетиц" in text_lower or "спектакл" in text_lower):
-        title_match = re.search(r'[«"‘](.+?)[»"’]', text)
-        if not title_match:
-            await update.message.reply_text(
-                "Укажите название спектакля в кавычках, например: «В гостях у оперной сказки»"
-            )
-            return
-
-        title = title_match.group(1).strip()
-
-        # === ИСПРАВЛЕНО: поддержка даты в формате "15 октября" ===
-        date_match = re.search(r"(\d{1,2})[ .\-](\d{1,2})(?:[ .\-](\d{4}))?", text)
-        if date_match:
-            day = int(date_match.group(1))
-            month = int(date_match.group(2))
-            year = int(date_match.group(3)) if date_match.group(3) else datetime.now().year
-        else:
-            month_map = {
-                'январ': 1, 'феврал': 2, 'март': 3, 'апрел': 4, 'май': 5, 'июн': 6,
-                'июл': 7, 'август': 8, 'сентябр': 9, 'октябр': 10, 'ноябр': 11, 'декабр': 12
-            }
-            date_match_text = re.search(r"(\d{1,2})\s+([а-яё]+)", text, re.IGNORECASE)
-            if date_match_text:
-                day = int(date_match_text.group(1))
-                month_word = date_match_text.group(2).lower()
-                month = None
-                for key, val in month_map.items():
-                    if month_word.startswith(key):
-                        month = val
-                        break
-                if month is None:
-                    await update.message.reply_text("Не удалось распознать месяц. Укажите дату как 15.10 или 15 октября.")
-                    return
-                year = datetime.now().year
-            else:
-                await update.message.reply_text("Укажите дату (например: 15.10 или 15 октября)")
-                return
-
-        try:
-            event_date = datetime(year, month, day).date()
-            date_iso = event_date.strftime("%Y-%m-%d")
-        except ValueError:
-            await update.message.reply_text("Некорректная дата.")
-            return
-
-        # === ИСПРАВЛЕНО: поддержка "до" в указании времени ===
-        time_match = re.search(
-            r"(\d{1,2}:\d{2})\s*(?:[-–]|\bдо\b)\s*(\d{1,2}:\d{2})",
-            text,
-            re.IGNORECASE
-        )
-        if time_match:
-            start_time = time_match.group(1)
-            end_time = time_match.group(2)
-        else:
-            time_match = re.search(r"(\d{1,2}:\d{2})", text)
-            if not time_match:
-                await update.message.reply_text("Укажите время (например: 14:00–15:30 или 14:00 до 15:30)")
-                return
-            start_time = time_match.group(1)
-            duration = 1.5 if "репетиц" in text_lower else 2.5
-            try:
-                start_obj = datetime.strptime(start_time, "%H:%M")
-                end_obj = start_obj + timedelta(hours=duration)
-                end_time = end_obj.strftime("%H:%M")
-            except:
-                end_time = "13:30" if "репетиц" in text_lower else "21:30"
-
-        hall = "Стравинский"
-        if "шаховск" in text_lower:
-            hall = "Шаховской"
-        elif "покровск" in text_lower:
-            hall = "Покровский"
-
-        event_type = "репетиция" if "репетиц" in text_lower else "спектакль"
-
-        try:
-            service = get_calendar_service()
-        except Exception as e:
-            await update.message.reply_text(f"Ошибка подключения к календарю: {e}")
-            return
-
-        start_dt_iso = f"{date_iso}T{start_time}:00"
-        end_dt_iso = f"{date_iso}T{end_time}:00"
-        summary = f"{event_type.capitalize()} «{title}»"
-        location = f"Зал {hall}"
-        description = "участие в оркестре — фагот"
-
-        try:
-            cal_id = create_calendar_event(service, summary, start_dt_iso, end_dt_iso, location, description)
-        except Exception as e:
-            logger.error(f"Ошибка Google Calendar: {e}")
-            cal_id = ""
-
-        add_event(user_id, {
-            "event_name": title,
-            "date": date_iso,
-            "start_time": start_time,
-            "end_time": end_time,
-            "hall": hall,
-            "event_type": event_type,
-            "role": "участие в оркестре — фагот",
-            "calendar_event_id": cal_id
-        })
+    cal_event_id = await run_blocking(delete_event, user_id, title, date_iso, True, key=user_id)
+    remove_reminders(context.job_queue, user_id, title, date_iso)
 
+    if cal_event_id is None:
         await update.message.reply_text(
-            f"✅ Записано: {date_iso}, {start_time}–{end_time} — {event_type} «{title}» в зале {hall}.\n"
-            "Добавлено в Google Календарь с напоминанием за 3 часа."
+            f"Событие «{title}» на {date_iso} не найдено в вашем расписании."
         )
         return
 
-    # === Запрос: "Когда я работаю на этой неделе?" (личное расписание) ===
-    if "этой неделе" in text_lower and ("работаю" in text_lower or "расписан" in text_lower or "запланировано" in text_lower or "что у меня" in text_lower):
-        today = datetime.now().date()
-        start_of_week = today - timedelta(days=today.weekday())
-        end_of_week = start_of_week + timedelta(days=6)
-
-        local_events = get_events_for_current_week(user_id)
-        if local_events:
-            reply = "Ваше расписание на этой неделе:\n"
-            for ev in local_events:
-                reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event']}» в зале {ev['hall']}.\n"
-            await update.message.reply_text(reply)
-        else:
-            site_events = get_events_for_week(start_of_week, end_of_week)
-            if site_events:
-                context.user_data["pending_events"] = site_events
-                reply = "На этой неделе у вас пока нет записей.\n"
-                reply += "Но на сайте «Геликон-опера» найдены следующие мероприятия:\n"
-                for ev in site_events:
-                    reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}.\n"
-                reply += "\nХотите добавить их все в расписание? Напишите «да»."
-                await update.message.reply_text(reply)
-            else:
-                await update.message.reply_text("На этой неделе мероприятий не найдено.")
+    # Удаление из Google Calendar выполнит фоновая очередь (calendar_sync)
+    await update.message.reply_text(
+        f"🗑️ Событие «{title}» на {date_iso} удалено из расписания и будет удалено из Google Calendar."
+    )
+
+# === Ручное добавление репетиции или спектакля по шаблону ===
+async def handle_add(update, context, text, hits):
+    user_id = update.effective_user.id
+    with span("parse"):
+        command, error = parse_event_command(text, "add", hits)
+    if error:
+        await update.message.reply_text(error)
         return
+    title, date_iso = command["title"], command["date"]
+    start_time, end_time = command["start_time"], command["end_time"]
+    hall, event_type = command["hall"], command["event_type"]
+
+    cal_id = calendar_event_key(user_id, title, date_iso, start_time)
+    event = {
+        "event_name": title,
+        "date": date_iso,
+        "start_time": start_time,
+        "end_time": end_time,
+        "hall": hall,
+        "event_type": event_type,
+        "role": "участие в оркестре — фагот",
+        "calendar_event_id": cal_id
+    }
+    # Событие в Google Calendar создаст фоновая очередь (calendar_sync)
+    await run_blocking(add_event, user_id, event, [("insert", cal_id, calendar_event_payload(event))], key=user_id)
+    add_reminders(context.job_queue, user_id, [event])
 
-    # === Запрос: "Какие спектакли в театре на этой неделе?" (общая афиша) ===
-    if ("спектакл" in text_lower or "мероприят" in text_lower or "афиш" in text_lower) and "этой неделе" in text_lower:
-        today = datetime.now().date()
-        start_of_week = today - timedelta(days=today.weekday())
-        end_of_week = start_of_week + timedelta(days=6)
+    await update.message.reply_text(
+        f"✅ Записано: {date_iso}, {start_time}–{end_time} — {event_type} «{title}» в зале {hall}.\n"
+        "Событие появится в Google Календаре с напоминанием за 3 часа."
+    )
 
-        site_events = get_events_for_week(start_of_week, end_of_week)
+# === Запрос: "Когда я работаю на этой неделе?" (личное расписание) ===
+async def handle_my_week(update, context, text, hits):
+    user_id = update.effective_user.id
+    start_of_week, end_of_week = _week_range()
+
+    local_events, replies = await _load_my_week(user_id, 0)
+    if local_events:
+        reply = replies.get("my_week")
+        if reply is None:
+            reply = replies["my_week"] = _render_my_schedule("Ваше расписание на этой неделе:\n", local_events)
+        await update.message.reply_text(reply)
+    else:
+        site_events = get_afisha_for_range(start_of_week, end_of_week)
         if site_events:
-            reply = "На этой неделе в театре «Геликон-опера» пройдут следующие мероприятия:\n"
+            context.user_data["pending_events"] = site_events
+            reply = "На этой неделе у вас пока нет записей.\n"
+            reply += "Но на сайте «Геликон-опера» найдены следующие мероприятия:\n"
             for ev in site_events:
                 reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}.\n"
+            reply += "\nХотите добавить их все в расписание? Напишите «да»."
             await update.message.reply_text(reply)
         else:
-            await update.message.reply_text("На этой неделе мероприятий в театре не запланировано.")
-        return
-
-    # === Запрос: "Какие спектакли в театре на следующей неделе?" (общая афиша) ===
-    if ("спектакл" in text_lower or "мероприят" in text_lower or "афиш" in text_lower) and ("следующей неделе" in text_lower or "следующую неделю" in text_lower):
-        today = datetime.now().date()
-        start_of_next_week = today + timedelta(days=(7 - today.weekday()))
-        end_of_next_week = start_of_next_week + timedelta(days=6)
-
-        site_events = get_events_for_week(start_of_next_week, end_of_next_week)
+            await update.message.reply_text("На этой неделе мероприятий не найдено.")
+
+# === Запрос: "Какие спектакли в театре на этой неделе?" (общая афиша) ===
+async def handle_playbill_week(update, context, text, hits):
+    site_events = get_afisha_for_range(*_week_range())
+    if site_events:
+        reply = "На этой неделе в театре «Геликон-опера» пройдут следующие мероприятия:\n"
+        for ev in site_events:
+            reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}.\n"
+        await update.message.reply_text(reply)
+    else:
+        await update.message.reply_text("На этой неделе мероприятий в театре не запланировано.")
+
+# === Запрос: "Какие спектакли в театре на следующей неделе?" (общая афиша) ===
+async def handle_playbill_next_week(update, context, text, hits):
+    site_events = get_afisha_for_range(*_week_range(1))
+    if site_events:
+        reply = "На следующей неделе в театре «Геликон-опера» пройдут следующие мероприятия:\n"
+        for ev in site_events:
+            reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}.\n"
+        await update.message.reply_text(reply)
+    else:
+        await update.message.reply_text("На следующей неделе мероприятий в театре не запланировано.")
+
+# === Запрос: "Что у меня на следующей неделе?" (личное расписание) ===
+async def handle_my_next_week(update, context, text, hits):
+    user_id = update.effective_user.id
+    start_of_next_week, end_of_next_week = _week_range(1)
+
+    local_events, replies = await _load_my_week(user_id, 1)
+    if local_events:
+        reply = replies.get("my_next_week")
+        if reply is None:
+            reply = replies["my_next_week"] = _render_my_schedule("Ваше расписание на следующей неделе:\n", local_events)
+        await update.message.reply_text(reply)
+    else:
+        site_events = get_afisha_for_range(start_of_next_week, end_of_next_week)
         if site_events:
-            reply = "На следующей неделе в театре «Геликон-опера» пройдут следующие мероприятия:\n"
+            context.user_data["pending_events"] = site_events
+            reply = "На сайте «Геликон-опера» найдены следующие мероприятия:\n"
             for ev in site_events:
                 reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}.\n"
+            reply += "\nХотите добавить их все в расписание? Напишите «да»."
             await update.message.reply_text(reply)
         else:
-            await update.message.reply_text("На следующей неделе мероприятий в театре не запланировано.")
-        return
-
-    # === Запрос: "Что у меня на следующей неделе?" (личное расписание) ===
-    if "следующей неделе" in text_lower or ("расписание" in text_lower and "недел" in text_lower):
-        today = datetime.now().date()
-        start_of_next_week = today + timedelta(days=(7 - today.weekday()))
-        end_of_next_week = start_of_next_week + timedelta(days=6)
-
-        local_events = get_events_for_next_week(user_id)
-        if local_events:
-            reply = "Ваше расписание на следующей неделе:\n"
-            for ev in local_events:
-                reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event']}» в зале {ev['hall']}.\n"
-            await update.message.reply_text(reply)
-        else:
-            site_events = get_events_for_week(start_of_next_week, end_of_next_week)
-            if site_events:
-                context.user_data["pending_events"] = site_events
-                reply = "На сайте «Геликон-опера» найдены следующие мероприятия:\n"
-                for ev in site_events:
-                    reply += f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}.\n"
-                reply += "\nХотите добавить их все в расписание? Напишите «да»."
-                await update.message.reply_text(reply)
-            else:
-                await update.message.reply_text("На следующей неделе мероприятий не найдено.")
-        return
-
-    # === Подтверждение добавления всего списка ===
-    if text_lower in ["да", "добавь"]:
-        pending = context.user_data.get("pending_events")
-        if not pending:
-            await update.message.reply_text("Нет мероприятий для добавления.")
-            return
-
-        try:
-            service = get_calendar_service()
-        except Exception as e:
-            await update.message.reply_text(f"Ошибка подключения к календарю: {e}")
-            return
-
-        for ev in pending:
-            start_dt = f"{ev['date']}T{ev['start']}:00"
-            end_dt = f"{ev['date']}T{ev['end']}:00"
-            summary = f"{ev['type'].capitalize()} «{ev['event_name']}»"
-            location = f"Зал {ev['hall']}"
-            description = "участие в оркестре — фагот"
-
-            try:
-                cal_id = create_calendar_event(service, summary, start_dt, end_dt, location, description)
-            except Exception as e:
-                logger.error(f"Ошибка Google Calendar: {e}")
-                cal_id = ""
-
-            add_event(user_id, {
-                "event_name": ev["event_name"],
-                "date": ev["date"],
-                "start_time": ev["start"],
-                "end_time": ev["end"],
-                "hall": ev["hall"],
-                "event_type": ev["type"],
-                "role": "участие в оркестре — фагот",
-                "calendar_event_id": cal_id
-            })
-
-        await update.message.reply_text(
-            "✅ Записано:\n" +
-            "\n".join(
-                f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}."
-                for ev in pending
-            ) +
-            "\nДобавлено в Google Календарь с напоминанием за 3 часа."
-        )
-        context.user_data.pop("pending_events", None)
-        return
+            await update.message.reply_text("На следующей неделе мероприятий не найдено.")
 
-    # === Новости театра ===
-    if any(kw in text_lower for kw in ["новост", "ново", "актуальн", "свеж"]) or "театр" in text_lower:
-        news = parse_news()
-        if news and "Ошибка" not in news[0]:
-            news_text = "\n".join(f"{i+1}. {n}" for i, n in enumerate(news[:5]))
-            await update.message.reply_text(f"Новости «Геликон-оперы»:\n{news_text}")
-        else:
-            await update.message.reply_text("Не удалось загрузить новости. Попробуйте позже.")
+# === Подтверждение добавления всего списка ===
+async def handle_confirm(update, context, text, hits):
+    user_id = update.effective_user.id
+    pending = context.user_data.get("pending_events")
+    if not pending:
+        await update.message.reply_text("Нет мероприятий для добавления.")
         return
 
-    # === Дирижёр ===
-    if "дириж" in text_lower:
-        conductors = {
-            "в гостях у оперной сказки": "Михаил Егиазарьян",
-            "маддалена": "Валерий Кирьянов",
-            "кармен щедрин": "Феликс Коробов",
-            "кармен": "Феликс Коробов",
-            "алеко": "Феликс Коробов",
-            "паяцы": "Тимур Зангиев",
-            "борис годунов": "Александр Ведерников",
-            "сказки гофмана": "Феликс Коробов",
-            "травиата": "Феликс Коробов",
-            "тоска": "Феликс Коробов",
-            "аида": "Феликс Коробов",
-            "ключ на мостовой": "Дмитрий Бертман",
-            "золушка": "Феликс Коробов",
-            "диалоги кармелиток": "Феликс Коробов",
-            "медиум": "Дмитрий Бертман",
-            "кофейная кантата": "Дмитрий Бертман",
-            "летучая мышь": "Феликс Коробов",
-            "свет вифлеемской звезды": "Дмитрий Бертман",
-            "новый год в сказочном городе": "Дмитрий Бертман"
+    rows = []
+    calendar_ops = []
+    for ev in pending:
+        cal_id = calendar_event_key(user_id, ev["event_name"], ev["date"], ev["start"])
+        row = {
+            "event_name": ev["event_name"],
+            "date": ev["date"],
+            "start_time": ev["start"],
+            "end_time": ev["end"],
+            "hall": ev["hall"],
+            "event_type": ev["type"],
+            "role": "участие в оркестре — фагот",
+            "calendar_event_id": cal_id
         }
+        rows.append(row)
+        calendar_ops.append(("insert", cal_id, calendar_event_payload(row)))
 
-        query = text_lower
-        for word in ["спектакль", "репетиц", "дириж", "кто", "«", "»", '"', "‘", "’"]:
-            query = query.replace(word, "")
-        query = query.strip()
-
-        found = None
-        for title, conductor in conductors.items():
-            if title in query:
-                found = (title, conductor)
-                break
-
-        if found:
-            title, conductor = found
-            await update.message.reply_text(f"Дирижёром спектакля «{title.title()}» является {conductor}.")
-        else:
-            await update.message.reply_text(
-                "Уточните, пожалуйста, название спектакля. Например:\n"
-                "— Кто дирижёр «В гостях у оперной сказки»?\n"
-                "— Кто дирижёр «Маддалены»?"
-            )
-        return
+    # Вся неделя и задания для Google Calendar — одной транзакцией
+    await run_blocking(add_events, user_id, rows, calendar_ops, key=user_id)
+    add_reminders(context.job_queue, user_id, rows)
 
-    # === Уточняющий вопрос ===
-    if any(kw in text_lower for kw in ["когда", "во сколько", "какой зал", "что сегодня", "репетиц", "спектакл"]):
+    await update.message.reply_text(
+        "✅ Записано:\n" +
+        "\n".join(
+            f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}."
+            for ev in pending
+        ) +
+        "\nСобытия появятся в Google Календаре с напоминанием за 3 часа."
+    )
+    context.user_data.pop("pending_events", None)
+
+# === Новости театра ===
+async def handle_news(update, context, text, hits):
+    news = get_news_snapshot()
+    if news:
+        news_text = "\n".join(f"{i+1}. {n}" for i, n in enumerate(news[:5]))
+        await update.message.reply_text(f"Новости «Геликон-оперы»:\n{news_text}")
+    elif get_snapshot_info()["news_updated_at"] is not None:
+        await update.message.reply_text("Новостей на сайте театра пока нет.")
+    else:
+        await update.message.reply_text("Не удалось загрузить новости. Попробуйте позже.")
+
+# === Дирижёр ===
+async def handle_conductor(update, context, text, hits):
+    query = text.lower()
+    for word in _CONDUCTOR_NOISE:
+        query = query.replace(word, "")
+    query = query.strip()
+
+    found = None
+    for title, conductor in CONDUCTORS.items():
+        if title in query:
+            found = (title, conductor)
+            break
+
+    if found:
+        title, conductor = found
+        await update.message.reply_text(f"Дирижёром спектакля «{title.title()}» является {conductor}.")
+    else:
         await update.message.reply_text(
-            "Уточните, пожалуйста: во сколько начинается мероприятие? Какой спектакль/репетиция? В каком зале проходит: Стравинский или Шаховской?"
+            "Уточните, пожалуйста, название спектакля. Например:\n"
+            "— Кто дирижёр «В гостях у оперной сказки»?\n"
+            "— Кто дирижёр «Маддалены»?"
         )
-        return
 
-    # === По умолчанию ===
+# === Уточняющий вопрос ===
+async def handle_clarify(update, context, text, hits):
+    await update.message.reply_text(
+        "Уточните, пожалуйста: во сколько начинается мероприятие? Какой спектакль/репетиция? В каком зале проходит: Стравинский или Шаховской?"
+    )
+
+# === По умолчанию ===
+async def handle_fallback(update, context, text, hits):
     await update.message.reply_text(
         "Я помогаю с расписанием, новостями и информацией о дирижёрах. Например:\n"
         "— Когда я работаю на этой неделе?\n"
@@ -426,16 +417,118 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "— Удалить спектакль «Кармен» 15.10"
     )
 
-def main():
-    TOKEN = "12345*****"  # ⚠️ Замените на ваш токен от @BotFather
-
-    app = Application.builder().token(TOKEN).build()
+# Обработчики намерений из intents.INTENT_RULES
+INTENT_HANDLERS = {
+    "delete": handle_delete,
+    "add": handle_add,
+    "my_week": handle_my_week,
+    "playbill_week": handle_playbill_week,
+    "playbill_next_week": handle_playbill_next_week,
+    "my_next_week": handle_my_next_week,
+    "confirm": handle_confirm,
+    "news": handle_news,
+    "conductor": handle_conductor,
+    "clarify": handle_clarify,
+    "fallback": handle_fallback,
+}
+
+async def on_startup(app: Application):
+    # kill -USR2 <pid> — профилирование на PROFILE_SIGNAL_SECONDS без перезапуска
+    install_profile_signal(asyncio.get_running_loop())
+
+async def on_shutdown(app: Application):
+    await flush_users()
+    await close_client()
+    shutdown_executor()
+    close_connections()
+
+TOKEN = "12345*****"  # ⚠️ Замените на ваш токен от @BotFather
+
+# Режим работы: polling (по умолчанию) или webhook; можно передать и аргументом bot_service.py
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Публичный адрес бота (обычно reverse proxy с HTTPS); к нему добавляется WEBHOOK_PATH
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# Где слушает встроенный HTTP-сервер; снаружи к нему ходит только прокси
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token, запросы без него отклоняются.
+# Если не задан — новый при каждом запуске (webhook всё равно регистрируется заново)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Сколько соединений с webhook Telegram открывает одновременно
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+# Сколько обновлений обрабатывать одновременно (сообщения одного чата — всё равно по очереди)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 1))
+
+def build_application(token=TOKEN, **builder_options):
+    """
+    Собирает Application со всеми обработчиками и фоновыми задачами.
+    builder_options — дополнительные настройки ApplicationBuilder по имени метода,
+    например base_url="http://127.0.0.1:8081/bot" или concurrent_updates=64.
+    """
+    # Свой HTTPXRequest отмечает время запросов к Bot API в журнале этапов (profiling.trace)
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(TracedRequest())
+        # user_data (ожидающие «да» pending_events) хранится в SQLite и переживает перезапуск
+        .persistence(SQLitePersistence())
+        .post_shutdown(on_shutdown)
+    )
+    for option, value in builder_options.items():
+        builder = getattr(builder, option)(value)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    logger.info("Бот запущен...")
-    app.run_polling()
+    # Афиша и новости обновляются в фоне, обработчики читают готовый снимок
+    schedule_prefetch(app.job_queue)
+    # Токен Google Calendar обновляется заранее, вне обработки сообщений
+    schedule_token_refresh(app.job_queue)
+    # Очередь операций с Google Calendar догоняется в фоне, с повторами
+    schedule_outbox(app.job_queue)
+    # Напоминания о событиях из БД — одна задача JobQueue на ближайшее
+    schedule_reminders(app.job_queue)
+    # Еженедельный дайджест всем пользователям и продолжение прерванных рассылок
+    schedule_broadcasts(app.job_queue)
+    # Данные давно не писавших пользователей выгружаются из памяти
+    schedule_state_eviction(app.job_queue)
+    # Кто уже есть в users — чтобы не писать в БД на каждое сообщение
+    load_known_users()
+    return app
+
+def main(mode=None):
+    """Запускает бота в режиме mode: polling или webhook (по умолчанию — BOT_MODE)."""
+    mode = mode or BOT_MODE
+    if mode not in ("polling", "webhook"):
+        raise SystemExit(f"Неизвестный режим {mode!r}: ожидается polling или webhook")
+    if mode == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("Для режима webhook задайте WEBHOOK_URL — публичный адрес бота")
+
+    options = {"post_init": on_startup}
+    if CONCURRENT_UPDATES > 1:
+        options["concurrent_updates"] = PerChatUpdateProcessor(CONCURRENT_UPDATES)
+    app = build_application(**options)
+    # /metrics для Prometheus, если задан METRICS_PORT
+    start_metrics_server()
+
+    if mode == "webhook":
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logger.info(f"Бот запущен (webhook {webhook_url}, слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT})...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        logger.info("Бот запущен...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
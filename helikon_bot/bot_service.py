@@ -1,5 +1,8 @@
 # bot_service.py
+import sys
+
 from bot import main
 
 if __name__ == '__main__':
-    main()
+    # python bot_service.py [polling|webhook]; без аргумента — BOT_MODE или polling
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
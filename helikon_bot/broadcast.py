@@ -0,0 +1,279 @@
+# broadcast.py
+# Рассылки всем пользователям из таблицы users: еженедельный дайджест афиши
+# на следующую неделю и свежих новостей. Отправка ограничена ведром токенов —
+# общим на бота и отдельным на каждый чат, чтобы не упираться в лимиты Telegram;
+# ответ 429 (RetryAfter) приостанавливает всю рассылку на указанное время.
+# Прогресс (курсор по telegram_id) хранится в таблице broadcasts: после
+# перезапуска рассылка продолжается с того же места.
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from datetime import time as dtime
+from zoneinfo import ZoneInfo
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from db import create_broadcast, get_broadcast_recipients, get_broadcasts, get_unseen_news, update_broadcast_progress
+from executor import run_blocking
+from metrics import Counter
+from prefetch import get_afisha_for_range, get_news_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Сообщений в секунду на весь бот (Telegram допускает около 30)
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 25))
+# Сообщений в секунду в один чат (длинный дайджест уходит несколькими сообщениями)
+BROADCAST_CHAT_RATE = float(os.environ.get("BROADCAST_CHAT_RATE", 1))
+# Получателей за шаг; после каждого шага курсор сохраняется в БД
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", 25))
+# Сколько раз повторять сообщение после 429 или сетевой ошибки (после 429 — выждав retry_after)
+BROADCAST_MAX_RETRIES = 3
+# День и время еженедельного дайджеста: 0 — понедельник, 6 — воскресенье
+DIGEST_WEEKDAY = int(os.environ.get("DIGEST_WEEKDAY", 6))
+DIGEST_TIME = os.environ.get("DIGEST_TIME", "18:00")
+DIGEST_TIMEZONE = ZoneInfo(os.environ.get("DIGEST_TIMEZONE", "Europe/Moscow"))
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+# Сколько ведер отдельных чатов держать, прежде чем выбросить полные
+CHAT_BUCKETS_MAX = 10000
+
+BROADCAST_MESSAGES = Counter("broadcast_messages_total", "Сообщения рассылок по результату", ["status"])
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity про запас.
+    acquire() резервирует токен сразу (баланс может уйти в минус) и ждёт
+    своей очереди — так одновременные отправители не обгоняют друг друга.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    def pause(self, seconds):
+        """Никто не получит токен ближайшие seconds секунд (ответ 429 от Telegram)."""
+        now = time.monotonic()
+        self._refill(now)
+        self.paused_until = max(self.paused_until, now + seconds)
+        # После паузы — без накопленного запаса, чтобы не получить 429 снова
+        self.tokens = min(self.tokens, 0.0)
+
+    async def acquire(self):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = max(-self.tokens / self.rate, self.paused_until - now)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            # Пока ждали, могла начаться пауза
+            wait = self.paused_until - time.monotonic()
+
+
+_global_bucket = TokenBucket(BROADCAST_RATE)
+_chat_buckets = {}
+_runner = None
+# Рассылка добавлена, пока исполнитель доделывал предыдущую, — ему нужно перечитать список
+_dirty = False
+_cancelled = set()
+
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(_chat_buckets) >= CHAT_BUCKETS_MAX:
+            for idle in [key for key, b in _chat_buckets.items() if b.is_full()]:
+                del _chat_buckets[idle]
+        bucket = _chat_buckets[chat_id] = TokenBucket(BROADCAST_CHAT_RATE, capacity=1)
+    return bucket
+
+
+def _retry_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """Делит текст на части не длиннее limit, по границам строк."""
+    parts, current = [], ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+
+async def send_paced(bot, chat_id, parts, counter=BROADCAST_MESSAGES):
+    """
+    Отправляет все части одному получателю в пределах общего на бота и
+    отдельного на чат ограничения скорости; после 429 или сетевой ошибки
+    повторяет. Так же отправляются напоминания (reminders.py), чтобы вместе
+    с рассылками не превышать лимит Telegram. Результаты считаются в counter.
+    Возвращает sent, forbidden или error.
+    """
+    for part in parts:
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await _chat_bucket(chat_id).acquire()
+            await _global_bucket.acquire()
+            try:
+                await bot.send_message(chat_id, part)
+                break
+            except RetryAfter as e:
+                # Лимит считается на бота целиком — останавливаются все отправители
+                counter.inc(status="retry_after")
+                _global_bucket.pause(_retry_seconds(e))
+            except Forbidden:
+                # Пользователь заблокировал бота
+                counter.inc(status="forbidden")
+                return "forbidden"
+            except BadRequest as e:
+                logger.error(f"Сообщение {chat_id} отклонено: {e}")
+                counter.inc(status="error")
+                return "error"
+            except TelegramError as e:
+                logger.warning(f"Ошибка отправки {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        else:
+            counter.inc(status="error")
+            return "error"
+    counter.inc(status="sent")
+    return "sent"
+
+
+async def _run_broadcast(bot, broadcast):
+    # Текст разбивается на сообщения один раз и одинаков для всех получателей
+    parts = split_message(broadcast["text"])
+    broadcast_id, cursor = broadcast["id"], broadcast["cursor"]
+    logger.info(f"Рассылка {broadcast_id} ({broadcast['kind']}): продолжается после telegram_id {cursor}")
+    while broadcast_id not in _cancelled:
+        recipients = await run_blocking(get_broadcast_recipients, cursor, BROADCAST_CHUNK)
+        if not recipients:
+            await run_blocking(update_broadcast_progress, broadcast_id, cursor, 0, 0, "done")
+            logger.info(f"Рассылка {broadcast_id} завершена")
+            return
+        results = await asyncio.gather(*(send_paced(bot, chat_id, parts) for chat_id in recipients))
+        sent = results.count("sent")
+        cursor = recipients[-1]
+        await run_blocking(update_broadcast_progress, broadcast_id, cursor, sent, len(results) - sent)
+
+
+async def run_broadcasts(bot):
+    """Выполняет незавершённые рассылки по одной, от старых к новым."""
+    global _runner, _dirty
+    try:
+        while True:
+            _dirty = False
+            running = await run_blocking(get_broadcasts, "running")
+            running = [b for b in running if b["id"] not in _cancelled]
+            if not running:
+                if _dirty:
+                    continue
+                return
+            await _run_broadcast(bot, running[0])
+    except Exception as e:
+        logger.error(f"Ошибка рассылки: {e}", exc_info=True)
+    finally:
+        _runner = None
+
+
+def _ensure_runner(application):
+    global _runner, _dirty
+    _dirty = True
+    if _runner is None:
+        _runner = application.create_task(run_broadcasts(application.bot), name="broadcast")
+
+
+def render_digest(news_titles):
+    """Текст дайджеста: афиша следующей недели и новости news_titles. None — если писать не о чем."""
+    today = datetime.now(DIGEST_TIMEZONE).date()
+    next_monday = today + timedelta(days=7 - today.weekday())
+    events = get_afisha_for_range(next_monday, next_monday + timedelta(days=6))
+    if not events and not news_titles:
+        return None
+
+    lines = []
+    if events:
+        lines.append(f"Афиша «Геликон-оперы» на неделю с {next_monday:%d.%m}:")
+        lines.extend(
+            f"- {ev['date']}, {ev['start']}–{ev['end']} — {ev['type']} «{ev['event_name']}» в зале {ev['hall']}."
+            for ev in events
+        )
+    if news_titles:
+        if lines:
+            lines.append("")
+        lines.append("Новости театра:")
+        lines.extend(f"{i + 1}. {title}" for i, title in enumerate(news_titles))
+    return "\n".join(lines)
+
+
+async def start_digest(application):
+    """Создаёт и запускает рассылку дайджеста. Возвращает id рассылки или None."""
+    news = await run_blocking(get_unseen_news, list(get_news_snapshot()))
+    text = render_digest(news)
+    if text is None:
+        logger.info("Дайджест не отправлен: на следующей неделе нет событий и новостей")
+        return None
+    broadcast_id = await run_blocking(create_broadcast, "digest", text, news)
+    _ensure_runner(application)
+    return broadcast_id
+
+
+async def stop_broadcasts():
+    """Отменяет незавершённые рассылки. Возвращает их число."""
+    running = await run_blocking(get_broadcasts, "running")
+    for broadcast in running:
+        _cancelled.add(broadcast["id"])
+        await run_blocking(update_broadcast_progress, broadcast["id"], broadcast["cursor"], 0, 0, "cancelled")
+    return len(running)
+
+
+async def broadcast_status():
+    """Краткая сводка по последним рассылкам для администратора."""
+    broadcasts = await run_blocking(get_broadcasts, None, 5)
+    if not broadcasts:
+        return "Рассылок ещё не было."
+    lines = []
+    for b in broadcasts:
+        created = datetime.fromtimestamp(b["created_at"], DIGEST_TIMEZONE)
+        lines.append(f"#{b['id']} {b['kind']} от {created:%d.%m %H:%M}: {b['status']}, "
+                     f"отправлено {b['sent']} из {b['total']}, ошибок {b['failed']}")
+    return "\n".join(lines)
+
+
+async def digest_job(context):
+    await start_digest(context.application)
+
+
+async def resume_job(context):
+    _ensure_runner(context.application)
+
+
+def schedule_broadcasts(job_queue):
+    """Еженедельный дайджест и продолжение рассылок, прерванных перезапуском."""
+    hour, minute = map(int, DIGEST_TIME.split(":"))
+    # В JobQueue.run_daily дни считаются от воскресенья: 0 — воскресенье
+    job_queue.run_daily(digest_job, dtime(hour, minute, tzinfo=DIGEST_TIMEZONE),
+                        days=((DIGEST_WEEKDAY + 1) % 7,), name="weekly_digest")
+    job_queue.run_once(resume_job, when=5, name="broadcast_resume")
@@ -0,0 +1,116 @@
+# calendar_sync.py
+import asyncio
+import logging
+import os
+import random
+
+from db import claim_calendar_ops, complete_calendar_ops, fail_calendar_ops, get_calendar_outbox_stats
+from executor import run_blocking
+from metrics import Gauge
+from profiling import trace
+from google_calendar import get_calendar_service, create_calendar_events, delete_calendar_events, BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять очередь calendar_outbox (секунды)
+OUTBOX_INTERVAL = int(os.environ.get("OUTBOX_INTERVAL", 5))
+# Сколько операций забирать за один проход
+OUTBOX_CLAIM_LIMIT = int(os.environ.get("OUTBOX_CLAIM_LIMIT", 200))
+# Сколько batch-запросов к Google выполнять одновременно
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", 2))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 12))
+# Задержка повтора: base * 2^attempts, но не больше max (секунды)
+OUTBOX_BACKOFF_BASE = 30
+OUTBOX_BACKOFF_MAX = 6 * 3600
+
+OUTBOX_OPS = Gauge("calendar_outbox_ops", "Операции calendar_outbox по статусам", ["status"],
+                   function=get_calendar_outbox_stats)
+
+
+def _retry_delay(attempts):
+    delay = min(OUTBOX_BACKOFF_BASE * (2 ** attempts), OUTBOX_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def _run_chunks(service, ops, call):
+    """Выполняет call(service, chunk) для пачек операций, не больше OUTBOX_CONCURRENCY одновременно."""
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+
+    async def run_chunk(chunk):
+        async with semaphore:
+            try:
+                return chunk, await run_blocking(call, service, chunk)
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации с Google Calendar: {e}")
+                return chunk, [None] * len(chunk)
+
+    chunks = [ops[i:i + BATCH_SIZE] for i in range(0, len(ops), BATCH_SIZE)]
+    return await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+
+
+def _insert_chunk(service, chunk):
+    return create_calendar_events(
+        service,
+        [op["payload"] for op in chunk],
+        event_ids=[op["calendar_event_id"] for op in chunk],
+    )
+
+
+def _delete_chunk(service, chunk):
+    return delete_calendar_events(service, [op["calendar_event_id"] for op in chunk])
+
+
+async def process_outbox():
+    """
+    Один проход по очереди: сначала вставки, потом удаления, чтобы
+    «добавил и сразу удалил» не оставлял событие в календаре.
+    Возвращает (выполнено, отложено).
+    """
+    ops = await run_blocking(claim_calendar_ops, OUTBOX_CLAIM_LIMIT)
+    if not ops:
+        return 0, 0
+    with trace("calendar outbox", is_update=False) as tags:
+        tags["ops"] = len(ops)
+        return await _process_ops(ops)
+
+
+async def _process_ops(ops):
+    done, failed = [], []
+    try:
+        service = await run_blocking(get_calendar_service)
+    except Exception as e:
+        # Нет token.pickle, токен отозван и т.п.: операции откладываются как при
+        # любой ошибке — с растущей задержкой и статусом failed после OUTBOX_MAX_ATTEMPTS
+        logger.error(f"Google Calendar недоступен: {e}")
+        service = None
+        failed = [(op["id"], _retry_delay(op["attempts"]), f"нет доступа к календарю: {e}") for op in ops]
+
+    for op_name, call in (("insert", _insert_chunk), ("delete", _delete_chunk)):
+        stage = [op for op in ops if op["op"] == op_name]
+        if not stage or service is None:
+            continue
+        for chunk, results in await _run_chunks(service, stage, call):
+            for op, result in zip(chunk, results):
+                if result:
+                    done.append(op["id"])
+                else:
+                    failed.append((op["id"], _retry_delay(op["attempts"]), f"{op_name} не выполнен"))
+
+    if done:
+        await run_blocking(complete_calendar_ops, done)
+    if failed:
+        await run_blocking(fail_calendar_ops, failed, OUTBOX_MAX_ATTEMPTS)
+        logger.warning(f"Google Calendar: {len(failed)} операций отложено для повтора")
+    return len(done), len(failed)
+
+
+async def outbox_job(context):
+    """Задача JobQueue: догоняет Google Calendar по очереди calendar_outbox."""
+    try:
+        await process_outbox()
+    except Exception as e:
+        logger.error(f"Ошибка обработки очереди Google Calendar: {e}")
+
+
+def schedule_outbox(job_queue):
+    job_queue.run_repeating(outbox_job, interval=OUTBOX_INTERVAL, first=1, name="calendar_outbox")
@@ -0,0 +1,113 @@
+# commands.py
+# Разбор команд «добавь …» и «удалить …»: название, дата, время и зал.
+import re
+from datetime import datetime, timedelta
+
+from intents import has_keyword
+
+_TITLE_RE = re.compile(r'[«"‘](.+?)[»"’]')
+_NUMERIC_DATE_RE = re.compile(r"(\d{1,2})[ .\-](\d{1,2})(?:[ .\-](\d{4}))?")
+_TEXT_DATE_RE = re.compile(r"(\d{1,2})\s+([а-яё]+)", re.IGNORECASE)
+_TIME_RANGE_RE = re.compile(r"(\d{1,2}:\d{2})\s*(?:[-–]|\bдо\b)\s*(\d{1,2}:\d{2})", re.IGNORECASE)
+_TIME_RE = re.compile(r"(\d{1,2}:\d{2})")
+
+MONTHS = (
+    ('январ', 1), ('феврал', 2), ('март', 3), ('апрел', 4), ('май', 5), ('июн', 6),
+    ('июл', 7), ('август', 8), ('сентябр', 9), ('октябр', 10), ('ноябр', 11), ('декабр', 12),
+)
+
+TITLE_HINTS = {
+    "add": "Укажите название спектакля в кавычках, например: «В гостях у оперной сказки»",
+    "delete": "Укажите название спектакля/репетиции в кавычках, например: удалить спектакль «Кармен» 15.10",
+}
+# Длительность по умолчанию, если указано только время начала
+DEFAULT_DURATION = {"репетиция": 1.5, "спектакль": 2.5}
+DEFAULT_END_TIME = {"репетиция": "13:30", "спектакль": "21:30"}
+
+
+def _month_number(word):
+    for prefix, number in MONTHS:
+        if word.startswith(prefix):
+            return number
+    return None
+
+
+def parse_date(text):
+    """
+    Дата в виде «15.10», «15-10-2026» или «15 октября»; год по умолчанию — текущий.
+    Возвращает (date_iso, error).
+    """
+    match = _NUMERIC_DATE_RE.search(text)
+    if match:
+        day = int(match.group(1))
+        month = int(match.group(2))
+        year = int(match.group(3)) if match.group(3) else datetime.now().year
+    else:
+        match = _TEXT_DATE_RE.search(text)
+        if not match:
+            return None, "Укажите дату (например: 15.10 или 15 октября)"
+        day = int(match.group(1))
+        month = _month_number(match.group(2).lower())
+        if month is None:
+            return None, "Не удалось распознать месяц. Укажите дату как 15.10 или 15 октября."
+        year = datetime.now().year
+
+    try:
+        return datetime(year, month, day).date().strftime("%Y-%m-%d"), None
+    except ValueError:
+        return None, "Некорректная дата."
+
+
+def parse_time_range(text, event_type):
+    """
+    Время «14:00–15:30» или «14:00 до 15:30»; если указано только начало,
+    конец считается по длительности типа события. Возвращает (start, end, error).
+    """
+    match = _TIME_RANGE_RE.search(text)
+    if match:
+        return match.group(1), match.group(2), None
+
+    match = _TIME_RE.search(text)
+    if not match:
+        return None, None, "Укажите время (например: 14:00–15:30 или 14:00 до 15:30)"
+    start_time = match.group(1)
+    try:
+        end = datetime.strptime(start_time, "%H:%M") + timedelta(hours=DEFAULT_DURATION[event_type])
+        end_time = end.strftime("%H:%M")
+    except ValueError:
+        end_time = DEFAULT_END_TIME[event_type]
+    return start_time, end_time, None
+
+
+def parse_hall(hits):
+    if has_keyword(hits, "шаховск"):
+        return "Шаховской"
+    if has_keyword(hits, "покровск"):
+        return "Покровский"
+    return "Стравинский"
+
+
+def parse_event_command(text, intent, hits):
+    """
+    Разбирает команду add или delete. hits — маска ключевых слов из intents.classify.
+    Возвращает (command, error): command — словарь с title и date, для add ещё
+    start_time, end_time, hall и event_type; error — ответ пользователю, если
+    в сообщении чего-то не хватает.
+    """
+    match = _TITLE_RE.search(text)
+    if not match:
+        return None, TITLE_HINTS[intent]
+    command = {"intent": intent, "title": match.group(1).strip()}
+
+    command["date"], error = parse_date(text)
+    if error:
+        return None, error
+    if intent == "delete":
+        return command, None
+
+    event_type = "репетиция" if has_keyword(hits, "репетиц") else "спектакль"
+    start_time, end_time, error = parse_time_range(text, event_type)
+    if error:
+        return None, error
+    command.update(start_time=start_time, end_time=end_time, hall=parse_hall(hits), event_type=event_type)
+    return command, None
@@ -1,11 +1,66 @@
 # db.py
+import json
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 
+import schedule_cache
+from metrics import Counter, Histogram, timed
+
 DB_PATH = "gelikon.db"
 
+# Сколько подготовленных запросов держит каждое соединение
+STATEMENT_CACHE_SIZE = 128
+# Сколько секунд ждать снятия блокировки записи другим потоком
+BUSY_TIMEOUT = 5.0
+
+# Одно соединение на поток: sqlite3 не любит делить соединение между потоками
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+# Время публичных функций модуля вместе с ожиданием блокировки записи
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Время вызова функций db.py", ["function"])
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "Исключения в функциях db.py", ["function"])
+_timed = timed(DB_QUERY_SECONDS, DB_QUERY_ERRORS)
+
+def get_connection():
+    """
+    Возвращает соединение текущего потока, открывая его при первом обращении.
+    Включены WAL (читатели не блокируют писателя) и synchronous=NORMAL.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == DB_PATH:
+        return conn
+
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,  # закрываем из другого потока в close_connections()
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _local.conn = conn
+    _local.path = DB_PATH
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def close_connections():
+    """Закрывает соединения всех потоков (при остановке бота)."""
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+    _local.__dict__.clear()
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cur = conn.cursor()
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -30,35 +85,224 @@ def init_db():
         )
     """)
     conn.commit()
-    conn.close()
+    _migrate(conn)
+
+def _migrate(conn):
+    """Применяет недостающие миграции схемы; номер версии хранится в PRAGMA user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    # (telegram_id, calendar_event_id) событий календаря от удалённых дубликатов —
+    # удаляются из Google Calendar, когда появится calendar_outbox (миграция 2)
+    orphaned = []
+
+    if version < 1:
+        with conn:
+            # Повторное «да» раньше создавало дубликаты (и по событию в календаре на каждый).
+            # Оставляем самую раннюю запись с событием в календаре, а если его нет ни
+            # у одной — просто самую раннюю
+            conn.execute("""
+                CREATE TEMP TABLE events_ranked AS
+                SELECT id, telegram_id, COALESCE(calendar_event_id, '') AS calendar_event_id,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY telegram_id, event_name, date, start_time
+                           ORDER BY COALESCE(calendar_event_id, '') = '', id
+                       ) AS rank
+                FROM events
+            """)
+            kept = {r[0] for r in conn.execute("SELECT calendar_event_id FROM events_ranked WHERE rank = 1")}
+            orphaned = [
+                r for r in conn.execute("""
+                    SELECT DISTINCT telegram_id, calendar_event_id FROM events_ranked
+                    WHERE rank > 1 AND calendar_event_id != ''
+                """)
+                if r[1] not in kept
+            ]
+            conn.execute("DELETE FROM events WHERE id IN (SELECT id FROM events_ranked WHERE rank > 1)")
+            conn.execute("DROP TABLE events_ranked")
+            # Естественный ключ события; он же индекс для delete_event
+            conn.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_events_natural_key
+                ON events (telegram_id, event_name, date, start_time)
+            """)
+            # Покрывающий индекс для _fetch_events: выборка без обращения к таблице
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_events_user_date
+                ON events (telegram_id, date, start_time, end_time, event_name, hall, event_type)
+            """)
+            conn.execute("PRAGMA user_version = 1")
+
+    if version < 2:
+        with conn:
+            # Очередь операций с Google Calendar. calendar_event_id — заранее известный ID
+            # события в календаре, он же ключ идемпотентности: повтор операции безопасен.
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS calendar_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    telegram_id INTEGER NOT NULL,
+                    op TEXT NOT NULL,
+                    calendar_event_id TEXT NOT NULL,
+                    payload TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_op_event
+                ON calendar_outbox (op, calendar_event_id)
+            """)
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_outbox_due
+                ON calendar_outbox (status, next_attempt_at)
+            """)
+            for telegram_id, calendar_event_id in orphaned:
+                _enqueue_calendar_ops(conn, telegram_id, [("delete", calendar_event_id, None)])
+            conn.execute("PRAGMA user_version = 2")
 
+    if version < 3:
+        with conn:
+            # Афиша театра, обновляемая по разнице с сайтом
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS playbill (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    date TEXT NOT NULL,
+                    time TEXT NOT NULL,
+                    event_name TEXT NOT NULL,
+                    hall TEXT,
+                    type TEXT,
+                    status TEXT NOT NULL DEFAULT 'active',
+                    first_seen_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    cancelled_at TEXT,
+                    UNIQUE (date, time, event_name)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_playbill_updated ON playbill (updated_at)")
+            conn.execute("PRAGMA user_version = 3")
+
+    if version < 4:
+        with conn:
+            # Рассылки всем пользователям. cursor — последний telegram_id, которому
+            # сообщение уже отправлено: после перезапуска рассылка продолжается с него.
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    cursor INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    sent INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+            # Новости, уже попавшие в рассылку
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS news_seen (
+                    title TEXT PRIMARY KEY,
+                    seen_at REAL NOT NULL
+                )
+            """)
+            conn.execute("PRAGMA user_version = 4")
+
+    if version < 5:
+        with conn:
+            # user_data и chat_data бота (persistence.py) в JSON; kind — 'user' или 'chat'
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    kind TEXT NOT NULL,
+                    key INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (kind, key)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_state_updated ON conversation_state (updated_at)")
+            conn.execute("PRAGMA user_version = 5")
+
+    if version < 6:
+        with conn:
+            # События, сохранённые до calendar_outbox, у которых вставка в календарь
+            # не удалась (пустой calendar_event_id): назначаем им заранее известный ID
+            # и ставим вставку в очередь, чтобы она повторялась как у новых событий
+            rows = conn.execute("""
+                SELECT id, telegram_id, event_name, date, start_time, end_time,
+                       COALESCE(hall, ''), COALESCE(event_type, ''), COALESCE(role, '')
+                FROM events WHERE COALESCE(calendar_event_id, '') = ''
+            """).fetchall()
+            if rows:
+                # Нужен только при обновлении старой базы: google_calendar тянет клиент Google API
+                from google_calendar import calendar_event_key, calendar_event_payload
+                for row_id, telegram_id, *fields in rows:
+                    event = dict(zip(("event_name", "date", "start_time", "end_time",
+                                      "hall", "event_type", "role"), fields))
+                    cal_id = calendar_event_key(telegram_id, event["event_name"], event["date"], event["start_time"])
+                    conn.execute("UPDATE events SET calendar_event_id = ? WHERE id = ?", (cal_id, row_id))
+                    _enqueue_calendar_ops(conn, telegram_id, [("insert", cal_id, calendar_event_payload(event))])
+            conn.execute("PRAGMA user_version = 6")
+
+@_timed
 def get_user(telegram_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT name, instrument FROM users WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row  # (name, instrument) or None
+    conn = get_connection()
+    cur = conn.execute("SELECT name, instrument FROM users WHERE telegram_id = ?", (telegram_id,))
+    return cur.fetchone()  # (name, instrument) or None
 
-def create_or_update_user(telegram_id, name="Медведев О.", instrument="фагот"):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO users (telegram_id, name, instrument)
-        VALUES (?, ?, ?)
-        ON CONFLICT(telegram_id) DO UPDATE SET name = ?, instrument = ?
-    """, (telegram_id, name, instrument, name, instrument))
-    conn.commit()
-    conn.close()
+# Новый пользователь получает профиль по умолчанию; у существующего меняются
+# только явно переданные поля (None — оставить как есть)
+_UPSERT_USER_SQL = """
+    INSERT INTO users (telegram_id, name, instrument)
+    VALUES (?, COALESCE(?, 'Медведев О.'), COALESCE(?, 'фагот'))
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        name = COALESCE(?, users.name),
+        instrument = COALESCE(?, users.instrument)
+    WHERE COALESCE(?, users.name) IS NOT users.name
+       OR COALESCE(?, users.instrument) IS NOT users.instrument
+"""
 
-def add_event(telegram_id, event_data):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO events (
-            telegram_id, event_name, date, start_time, end_time, hall, event_type, role, calendar_event_id
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+def create_or_update_user(telegram_id, name=None, instrument=None):
+    # Время учитывается в upsert_users
+    upsert_users([(telegram_id, name, instrument)])
+
+@_timed
+def upsert_users(users):
+    """
+    Регистрирует пачку пользователей одной транзакцией. users — список
+    (telegram_id, name, instrument); запись без изменений не переписывается.
+    """
+    with get_connection() as conn:
+        conn.executemany(_UPSERT_USER_SQL, [
+            (telegram_id, name, instrument, name, instrument, name, instrument)
+            for telegram_id, name, instrument in users
+        ])
+
+@_timed
+def get_user_ids():
+    """telegram_id всех зарегистрированных пользователей."""
+    return [r[0] for r in get_connection().execute("SELECT telegram_id FROM users")]
+
+# Повторная запись того же события обновляет его, а не создаёт дубликат.
+# Пустой calendar_event_id не затирает уже сохранённый.
+_UPSERT_EVENT_SQL = """
+    INSERT INTO events (
+        telegram_id, event_name, date, start_time, end_time, hall, event_type, role, calendar_event_id
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(telegram_id, event_name, date, start_time) DO UPDATE SET
+        end_time = excluded.end_time,
+        hall = excluded.hall,
+        event_type = excluded.event_type,
+        role = excluded.role,
+        calendar_event_id = CASE
+            WHEN excluded.calendar_event_id != '' THEN excluded.calendar_event_id
+            ELSE events.calendar_event_id
+        END
+"""
+
+def _event_params(telegram_id, event_data):
+    return (
         telegram_id,
         event_data["event_name"],
         event_data["date"],
@@ -68,31 +312,266 @@ def add_event(telegram_id, event_data):
         event_data["event_type"],
         event_data["role"],
         event_data.get("calendar_event_id", "")
-    ))
-    conn.commit()
-    conn.close()
-
-def delete_event(user_id: int, event_name: str, date: str) -> str | None:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT calendar_event_id FROM events
-        WHERE telegram_id = ? AND event_name = ? AND date = ?
-    """, (user_id, event_name, date))
-    row = cursor.fetchone()
-
-    if row:
-        cal_id = row[0]
-        cursor.execute("""
+    )
+
+@_timed
+def add_event(telegram_id, event_data, calendar_ops=()):
+    """
+    Сохраняет событие. calendar_ops — операции для calendar_outbox
+    (см. _enqueue_calendar_ops), записываются в той же транзакции.
+    """
+    with get_connection() as conn:
+        conn.execute(_UPSERT_EVENT_SQL, _event_params(telegram_id, event_data))
+        _enqueue_calendar_ops(conn, telegram_id, calendar_ops)
+    schedule_cache.invalidate(telegram_id, [event_data["date"]])
+
+@_timed
+def add_events(telegram_id, events, calendar_ops=()):
+    """Записывает список событий (формат как у add_event) одной транзакцией."""
+    with get_connection() as conn:
+        conn.executemany(_UPSERT_EVENT_SQL, [_event_params(telegram_id, ev) for ev in events])
+        _enqueue_calendar_ops(conn, telegram_id, calendar_ops)
+    schedule_cache.invalidate(telegram_id, [ev["date"] for ev in events])
+
+@_timed
+def delete_event(user_id: int, event_name: str, date: str, sync_calendar=False) -> str | None:
+    """
+    Удаляет событие и возвращает его calendar_event_id (None, если события нет).
+    При sync_calendar удаление из Google Calendar ставится в calendar_outbox.
+    """
+    with get_connection() as conn:
+        rows = conn.execute("""
+            SELECT calendar_event_id FROM events
+            WHERE telegram_id = ? AND event_name = ? AND date = ?
+        """, (user_id, event_name, date)).fetchall()
+
+        if not rows:
+            return None
+
+        conn.execute("""
             DELETE FROM events
             WHERE telegram_id = ? AND event_name = ? AND date = ?
         """, (user_id, event_name, date))
-        conn.commit()
-        conn.close()
-        return cal_id
-    else:
-        conn.close()
-        return None
+        if sync_calendar:
+            _enqueue_calendar_ops(conn, user_id, [("delete", r[0], None) for r in rows if r[0]])
+    schedule_cache.invalidate(user_id, [date])
+    return rows[0][0]
+
+def _enqueue_calendar_ops(conn, telegram_id, ops):
+    """
+    Ставит операции (op, calendar_event_id, payload) в очередь. op — 'insert' или 'delete'.
+    Повторная постановка той же операции перезапускает её; ожидающая
+    противоположная операция для того же события отменяется.
+    """
+    now = time.time()
+    for op, calendar_event_id, payload in ops:
+        opposite = "delete" if op == "insert" else "insert"
+        conn.execute("""
+            UPDATE calendar_outbox SET status = 'cancelled'
+            WHERE op = ? AND calendar_event_id = ? AND status = 'pending'
+        """, (opposite, calendar_event_id))
+        conn.execute("""
+            INSERT INTO calendar_outbox (
+                telegram_id, op, calendar_event_id, payload, status, attempts, next_attempt_at, created_at
+            ) VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)
+            ON CONFLICT(op, calendar_event_id) DO UPDATE SET
+                payload = excluded.payload,
+                status = 'pending',
+                attempts = 0,
+                next_attempt_at = excluded.next_attempt_at,
+                last_error = NULL
+        """, (telegram_id, op, calendar_event_id,
+              json.dumps(payload, ensure_ascii=False) if payload is not None else None, now, now))
+
+@_timed
+def claim_calendar_ops(limit, lease=300):
+    """
+    Забирает до limit готовых к выполнению операций, помечая их 'inflight'
+    на lease секунд: если процесс упадёт, операции вернутся в работу сами.
+    Возвращает список словарей в порядке постановки.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        rows = conn.execute("""
+            SELECT id, telegram_id, op, calendar_event_id, payload, attempts
+            FROM calendar_outbox
+            WHERE status IN ('pending', 'inflight') AND next_attempt_at <= ?
+            ORDER BY id
+            LIMIT ?
+        """, (now, limit)).fetchall()
+        conn.executemany(
+            "UPDATE calendar_outbox SET status = 'inflight', next_attempt_at = ? WHERE id = ?",
+            [(now + lease, r[0]) for r in rows]
+        )
+    return [
+        {
+            "id": r[0],
+            "telegram_id": r[1],
+            "op": r[2],
+            "calendar_event_id": r[3],
+            "payload": json.loads(r[4]) if r[4] else None,
+            "attempts": r[5],
+        }
+        for r in rows
+    ]
+
+@_timed
+def complete_calendar_ops(op_ids):
+    with get_connection() as conn:
+        conn.executemany(
+            "UPDATE calendar_outbox SET status = 'done', last_error = NULL WHERE id = ? AND status = 'inflight'",
+            [(op_id,) for op_id in op_ids]
+        )
+
+@_timed
+def fail_calendar_ops(failures, max_attempts):
+    """
+    failures — список (op_id, задержка до повтора в секундах, текст ошибки).
+    После max_attempts попыток операция получает статус 'failed'.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        conn.executemany("""
+            UPDATE calendar_outbox SET
+                attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = ?,
+                last_error = ?
+            WHERE id = ? AND status = 'inflight'
+        """, [(max_attempts, now + delay, error, op_id) for op_id, delay, error in failures])
+
+@_timed
+def get_calendar_outbox_stats():
+    """Число операций в очереди по статусам."""
+    rows = get_connection().execute(
+        "SELECT status, COUNT(*) FROM calendar_outbox GROUP BY status"
+    ).fetchall()
+    return dict(rows)
+
+@_timed
+def get_upcoming_events(since_date):
+    """Все события пользователей начиная с даты since_date (для планировщика напоминаний)."""
+    rows = get_connection().execute("""
+        SELECT telegram_id, event_name, date, start_time, hall, event_type
+        FROM events
+        WHERE date >= ?
+    """, (str(since_date),)).fetchall()
+    return [
+        {
+            "telegram_id": r[0],
+            "event_name": r[1],
+            "date": r[2],
+            "start_time": r[3],
+            "hall": r[4],
+            "event_type": r[5]
+        }
+        for r in rows
+    ]
+
+@_timed
+def create_broadcast(kind, text, news_titles=()):
+    """
+    Создаёт рассылку текста text всем пользователям и отмечает news_titles
+    как разосланные — в одной транзакции. Возвращает id рассылки.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        cur = conn.execute("""
+            INSERT INTO broadcasts (kind, text, status, total, created_at)
+            VALUES (?, ?, 'running', ?, ?)
+        """, (kind, text, total, now))
+        conn.executemany(
+            "INSERT OR IGNORE INTO news_seen (title, seen_at) VALUES (?, ?)",
+            [(title, now) for title in news_titles]
+        )
+        return cur.lastrowid
+
+def _broadcast_row_to_dict(r):
+    return {
+        "id": r[0], "kind": r[1], "text": r[2], "status": r[3], "cursor": r[4],
+        "total": r[5], "sent": r[6], "failed": r[7], "created_at": r[8], "finished_at": r[9],
+    }
+
+@_timed
+def get_broadcasts(status=None, limit=10):
+    """Последние рассылки (все или с данным статусом), от старых к новым."""
+    cur = get_connection().execute("""
+        SELECT id, kind, text, status, cursor, total, sent, failed, created_at, finished_at
+        FROM broadcasts WHERE ? IS NULL OR status = ?
+        ORDER BY id DESC LIMIT ?
+    """, (status, status, limit))
+    return [_broadcast_row_to_dict(r) for r in reversed(cur.fetchall())]
+
+@_timed
+def get_broadcast_recipients(after_id, limit):
+    """Следующие limit пользователей с telegram_id больше after_id, по возрастанию."""
+    cur = get_connection().execute(
+        "SELECT telegram_id FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+        (after_id, limit)
+    )
+    return [r[0] for r in cur.fetchall()]
+
+@_timed
+def update_broadcast_progress(broadcast_id, cursor, sent, failed, status=None):
+    """Сдвигает курсор и добавляет sent/failed к счётчикам; status завершает рассылку."""
+    with get_connection() as conn:
+        conn.execute("""
+            UPDATE broadcasts SET
+                cursor = MAX(cursor, ?),
+                sent = sent + ?,
+                failed = failed + ?,
+                status = COALESCE(?, status),
+                finished_at = CASE WHEN ? IS NULL THEN finished_at ELSE ? END
+            WHERE id = ?
+        """, (cursor, sent, failed, status, status, time.time(), broadcast_id))
+
+@_timed
+def get_unseen_news(titles):
+    """Новости из titles, которые ещё не рассылались, в исходном порядке."""
+    if not titles:
+        return []
+    placeholders = ",".join("?" * len(titles))
+    seen = {
+        r[0] for r in get_connection().execute(
+            f"SELECT title FROM news_seen WHERE title IN ({placeholders})", list(titles)
+        )
+    }
+    return [title for title in titles if title not in seen]
+
+@_timed
+def load_conversation_state(kind, key, ttl):
+    """Сохранённые данные (JSON-строка) или None, если их нет или они старше ttl секунд."""
+    row = get_connection().execute("""
+        SELECT data FROM conversation_state
+        WHERE kind = ? AND key = ? AND updated_at >= ?
+    """, (kind, key, time.time() - ttl)).fetchone()
+    return row[0] if row else None
+
+@_timed
+def save_conversation_state(changes):
+    """
+    Записывает пачку изменений одной транзакцией. changes — список
+    (kind, key, data): data — JSON-строка или None (удалить запись).
+    """
+    now = time.time()
+    with get_connection() as conn:
+        conn.executemany("""
+            INSERT INTO conversation_state (kind, key, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(kind, key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        """, [(kind, key, data, now) for kind, key, data in changes if data is not None])
+        conn.executemany(
+            "DELETE FROM conversation_state WHERE kind = ? AND key = ?",
+            [(kind, key) for kind, key, data in changes if data is None]
+        )
+
+@_timed
+def delete_expired_conversation_state(ttl):
+    """Удаляет данные, не менявшиеся дольше ttl секунд. Возвращает число удалённых записей."""
+    with get_connection() as conn:
+        return conn.execute(
+            "DELETE FROM conversation_state WHERE updated_at < ?", (time.time() - ttl,)
+        ).rowcount
 
 def _get_week_range(date):
     """Возвращает (monday, sunday) для недели, содержащей date."""
@@ -100,11 +579,13 @@ def _get_week_range(date):
     sunday = monday + timedelta(days=6)
     return monday, sunday
 
+@_timed
 def get_events_for_current_week(telegram_id):
     today = datetime.today().date()
     monday, sunday = _get_week_range(today)
     return _fetch_events(telegram_id, monday, sunday)
 
+@_timed
 def get_events_for_next_week(telegram_id):
     today = datetime.today().date()
     next_monday = today + timedelta(days=(7 - today.weekday()))
@@ -112,16 +593,13 @@ def get_events_for_next_week(telegram_id):
     return _fetch_events(telegram_id, next_monday, next_sunday)
 
 def _fetch_events(telegram_id, start_date, end_date):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
+    cur = get_connection().execute("""
         SELECT event_name, date, start_time, end_time, hall, event_type
         FROM events
         WHERE telegram_id = ? AND date BETWEEN ? AND ?
         ORDER BY date, start_time
     """, (telegram_id, str(start_date), str(end_date)))
     rows = cur.fetchall()
-    conn.close()
     return [
         {
             "event": r[0],
@@ -133,3 +611,90 @@ def _fetch_events(telegram_id, start_date, end_date):
         }
         for r in rows
     ]
+
+def _playbill_row_to_event(r):
+    return {"event_name": r[0], "date": r[1], "time": r[2], "hall": r[3], "type": r[4]}
+
+@_timed
+def sync_playbill(events, start_date=None, end_date=None, cancel_missing=True):
+    """
+    Обновляет таблицу playbill по свежей афише (формат parser.parse_afisha).
+    Новые спектакли добавляются, изменившиеся обновляются, а пропавшие с сайта
+    в пределах [start_date, end_date] (по умолчанию — даты из events) помечаются отменёнными.
+    cancel_missing=False — афиша загружена не полностью: отсутствие события
+    ничего не значит, и отмены не отмечаются.
+    Возвращает {"added": [...], "changed": [...], "cancelled": [...]}.
+    """
+    diff = {"added": [], "changed": [], "cancelled": []}
+    if not events:
+        # Пустая афиша — скорее ошибка загрузки, чем отмена всего сезона
+        return diff
+
+    start = str(start_date) if start_date else min(ev["date"] for ev in events)
+    end = str(end_date) if end_date else max(ev["date"] for ev in events)
+    now = datetime.now().isoformat(timespec="seconds")
+
+    fresh = {(ev["date"], ev["time"], ev["event_name"]): ev for ev in events}
+    with get_connection() as conn:
+        stored = {
+            (r[1], r[2], r[0]): r
+            for r in conn.execute("""
+                SELECT event_name, date, time, hall, type, status FROM playbill
+                WHERE date BETWEEN ? AND ?
+            """, (start, end))
+        }
+
+        for key, ev in fresh.items():
+            row = stored.get(key)
+            if row is None:
+                diff["added"].append(ev)
+            elif row[5] != "active" or row[3] != ev["hall"] or row[4] != ev["type"]:
+                diff["changed"].append(ev)
+        for key, row in stored.items():
+            if cancel_missing and key not in fresh and row[5] == "active":
+                diff["cancelled"].append(_playbill_row_to_event(row))
+
+        conn.executemany("""
+            INSERT INTO playbill (date, time, event_name, hall, type, status, first_seen_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
+            ON CONFLICT(date, time, event_name) DO UPDATE SET
+                hall = excluded.hall,
+                type = excluded.type,
+                status = 'active',
+                updated_at = excluded.updated_at,
+                cancelled_at = NULL
+        """, [
+            (ev["date"], ev["time"], ev["event_name"], ev["hall"], ev["type"], now, now)
+            for ev in diff["added"] + diff["changed"]
+        ])
+        conn.executemany("""
+            UPDATE playbill SET status = 'cancelled', cancelled_at = ?, updated_at = ?
+            WHERE date = ? AND time = ? AND event_name = ?
+        """, [(now, now, ev["date"], ev["time"], ev["event_name"]) for ev in diff["cancelled"]])
+    return diff
+
+@_timed
+def get_playbill(start_date, end_date=None):
+    """Действующие события афиши с start_date по end_date (включительно), по дате и времени."""
+    cur = get_connection().execute("""
+        SELECT event_name, date, time, hall, type FROM playbill
+        WHERE status = 'active' AND date BETWEEN ? AND ?
+        ORDER BY date, time
+    """, (str(start_date), str(end_date) if end_date else "9999-12-31"))
+    return [_playbill_row_to_event(r) for r in cur.fetchall()]
+
+@_timed
+def get_playbill_changes(since):
+    """
+    Изменения афиши после момента since (datetime): события со статусом,
+    first_seen_at, updated_at и cancelled_at — чтобы понять, что добавлено, изменено или отменено.
+    """
+    cur = get_connection().execute("""
+        SELECT event_name, date, time, hall, type, status, first_seen_at, updated_at, cancelled_at
+        FROM playbill WHERE updated_at > ?
+        ORDER BY date, time
+    """, (since.isoformat(timespec="seconds"),))
+    return [
+        dict(_playbill_row_to_event(r), status=r[5], first_seen_at=r[6], updated_at=r[7], cancelled_at=r[8])
+        for r in cur.fetchall()
+    ]
@@ -0,0 +1,104 @@
+# executor.py
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Counter, Gauge
+from profiling import span, span_for
+
+logger = logging.getLogger(__name__)
+
+# Потоки для блокирующих вызовов (sqlite3, googleapiclient)
+BLOCKING_POOL_SIZE = int(os.environ.get("BLOCKING_POOL_SIZE", 8))
+
+_pool = None
+# Ключ (обычно telegram_id) -> [asyncio.Lock, число ожидающих]
+_key_locks = {}
+_stats = {"queued": 0, "running": 0, "completed": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+    return _pool
+
+
+def get_executor_stats():
+    """
+    Состояние пула: queued — ждут свободного потока, running — выполняются,
+    waiting_keys — ключи, у которых есть очередь вызовов.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["waiting_keys"] = len(_key_locks)
+    return stats
+
+
+EXECUTOR_TASKS = Gauge("executor_tasks", "Задачи пула блокирующих вызовов: в очереди и выполняются", ["state"],
+                       function=lambda: {k: v for k, v in get_executor_stats().items() if k in ("queued", "running")})
+EXECUTOR_DONE = Counter("executor_tasks_total", "Завершённые задачи пула по результату", ["result"],
+                        function=lambda: {k: v for k, v in get_executor_stats().items() if k in ("completed", "failed")})
+
+
+def _count(name, delta=1):
+    with _stats_lock:
+        _stats[name] += delta
+
+
+def _run(func, args, kwargs):
+    with _stats_lock:
+        _stats["queued"] -= 1
+        _stats["running"] += 1
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _count("running", -1)
+
+
+async def _submit(func, args, kwargs):
+    loop = asyncio.get_running_loop()
+    _count("queued")
+    try:
+        # Время в очереди пула и выполнения — этап обновления (db, calendar), см. profiling.trace
+        with span(span_for(func)):
+            result = await loop.run_in_executor(_get_pool(), functools.partial(_run, func, args, kwargs))
+    except Exception:
+        _count("failed")
+        raise
+    _count("completed")
+    return result
+
+
+async def run_blocking(func, *args, key=None, **kwargs):
+    """
+    Выполняет блокирующую функцию в пуле потоков, не останавливая цикл событий.
+    Вызовы с одинаковым key (например, telegram_id) выполняются строго по очереди
+    в порядке вызова; вызовы с разными ключами идут параллельно.
+    """
+    if key is None:
+        return await _submit(func, args, kwargs)
+
+    slot = _key_locks.get(key)
+    if slot is None:
+        slot = _key_locks[key] = [asyncio.Lock(), 0]
+    slot[1] += 1
+    try:
+        async with slot[0]:
+            return await _submit(func, args, kwargs)
+    finally:
+        slot[1] -= 1
+        if slot[1] == 0:
+            _key_locks.pop(key, None)
+
+
+def shutdown_executor(wait=True):
+    """Останавливает пул, дожидаясь уже начатых вызовов."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=wait)
+        _pool = None
@@ -1,30 +1,138 @@
 # google_calendar.py
+import hashlib
 import os
 import pickle
 import logging  # <-- добавлено
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import httplib2
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from executor import run_blocking
+from metrics import Counter, Histogram
 
 SCOPES = ['https://www.googleapis.com/auth/calendar.events']  # <-- пробелы убраны
 
-def get_calendar_service():
+# Google рекомендует не больше 50 запросов в одном batch
+BATCH_SIZE = 50
+# Сколько раз повторять упавшие подзапросы batch (только временные ошибки)
+BATCH_RETRIES = 3
+RETRYABLE_STATUSES = {403, 429, 500, 502, 503, 504}
+
+TOKEN_PATH = 'token.pickle'
+# Другой адрес Calendar API (прокси или локальная заглушка); по умолчанию — Google
+CALENDAR_API_ENDPOINT = os.environ.get('GOOGLE_CALENDAR_API_ENDPOINT')
+CLIENT_SECRETS_PATH = 'credentials.json'
+# Токен обновляется заранее, за столько до истечения
+TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
+# Как часто фоновая задача проверяет срок действия токена (секунды)
+TOKEN_CHECK_INTERVAL = 60
+
+# Учётные данные и сервис живут в памяти процесса: без чтения token.pickle
+# и загрузки discovery-документа на каждый запрос
+_creds = None
+_service = None
+_lock = threading.Lock()
+
+CALENDAR_REQUEST_SECONDS = Histogram("calendar_request_duration_seconds",
+                                     "Время HTTP-запросов к Google Calendar", ["op"])
+CALENDAR_FAILURES = Counter("calendar_request_failures_total",
+                            "Ошибки Google Calendar: целых запросов и подзапросов batch", ["op", "status"])
+# httplib2.Http не потокобезопасен — у каждого потока пула свой транспорт
+_thread_local = threading.local()
+
+def _load_credentials():
     creds = None
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    if os.path.exists(TOKEN_PATH):
+        with open(TOKEN_PATH, 'rb') as token:
             creds = pickle.load(token)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRETS_PATH, SCOPES)
             creds = flow.run_local_server(port=0)
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-    return build('calendar', 'v3', credentials=creds)
+        _save_credentials(creds)
+    return creds
 
-def create_calendar_event(service, summary, start_time, end_time, location, description):
-    event = {
+def _save_credentials(creds):
+    with open(TOKEN_PATH, 'wb') as token:
+        pickle.dump(creds, token)
+
+def _expires_soon(creds):
+    if not creds.expiry:
+        return False
+    # google-auth хранит expiry как наивное время UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < TOKEN_REFRESH_MARGIN
+
+def get_credentials():
+    """Возвращает учётные данные из памяти, загружая их с диска при первом обращении."""
+    global _creds
+    with _lock:
+        if _creds is None:
+            _creds = _load_credentials()
+        elif not _creds.valid and _creds.refresh_token:
+            _creds.refresh(Request())
+            _save_credentials(_creds)
+        return _creds
+
+def refresh_credentials_if_needed():
+    """
+    Обновляет токен, если он скоро истечёт. Вызывается фоновой задачей,
+    чтобы обновление не попадало в обработку сообщений пользователя.
+    """
+    with _lock:
+        if _creds is None or not getattr(_creds, 'refresh_token', None):
+            return False
+        if _creds.valid and not _expires_soon(_creds):
+            return False
+        _creds.refresh(Request())
+        _save_credentials(_creds)
+    logging.info("Токен Google Calendar обновлён заранее")
+    return True
+
+def get_calendar_service():
+    """Возвращает общий для процесса сервис Calendar (discovery-документ из пакета, без сети)."""
+    global _service
+    if _service is None:
+        creds = get_credentials()
+        with _lock:
+            if _service is None:
+                client_options = {'api_endpoint': CALENDAR_API_ENDPOINT} if CALENDAR_API_ENDPOINT else None
+                _service = build('calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False,
+                                 client_options=client_options)
+    return _service
+
+def _http_for(service):
+    """Транспорт текущего потока для общего сервиса; для чужого сервиса — его собственный."""
+    if service is not _service:
+        return None
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = _thread_local.http = AuthorizedHttp(get_credentials(), http=httplib2.Http())
+    return http
+
+async def token_refresh_job(context):
+    """Задача JobQueue: фоновое обновление токена Google Calendar."""
+    try:
+        await run_blocking(refresh_credentials_if_needed)
+    except Exception as e:
+        logging.error(f"Не удалось заранее обновить токен Google Calendar: {e}")
+
+def schedule_token_refresh(job_queue):
+    job_queue.run_repeating(token_refresh_job, interval=TOKEN_CHECK_INTERVAL, first=TOKEN_CHECK_INTERVAL,
+                            name="calendar_token_refresh")
+
+def _event_body(summary, start_time, end_time, location, description):
+    return {
         'summary': summary,
         'location': location,
         'description': description,
@@ -44,13 +152,158 @@ def create_calendar_event(service, summary, start_time, end_time, location, desc
             ],
         },
     }
-    event = service.events().insert(calendarId='primary', body=event).execute()
+
+def _failure_status(exception):
+    if isinstance(exception, HttpError):
+        return str(exception.resp.status)
+    return type(exception).__name__
+
+@contextmanager
+def _observe_request(op):
+    """Учитывает запрос к Calendar в метриках: время и, при исключении, ошибку."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        CALENDAR_FAILURES.inc(op=op, status=_failure_status(e))
+        raise
+    finally:
+        CALENDAR_REQUEST_SECONDS.observe(time.perf_counter() - start, op=op)
+
+def create_calendar_event(service, summary, start_time, end_time, location, description):
+    event = _event_body(summary, start_time, end_time, location, description)
+    with _observe_request('insert'):
+        event = service.events().insert(calendarId='primary', body=event).execute(http=_http_for(service))
     return event['id']
 
 def delete_calendar_event(service, event_id: str):
     """Удаляет событие из Google Calendar по его ID."""
     try:
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
+        with _observe_request('delete'):
+            service.events().delete(calendarId='primary', eventId=event_id).execute(http=_http_for(service))
     except Exception as e:
         logging.error(f"Ошибка при удалении события из Google Calendar: {e}")
         raise
+
+def _is_retryable(exception):
+    return isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES
+
+def _new_batch(service, callback):
+    # batch-адрес googleapiclient берёт из discovery-документа и не учитывает api_endpoint
+    if CALENDAR_API_ENDPOINT and service is _service:
+        return BatchHttpRequest(callback=callback, batch_uri=f"{CALENDAR_API_ENDPOINT.rstrip('/')}/batch/calendar/v3")
+    return service.new_batch_http_request(callback=callback)
+
+def _execute_batch(service, request_factories, ignore_statuses=()):
+    """
+    Выполняет запросы пачками через batch API. request_factories — функции,
+    создающие запрос (для повтора нужен новый объект запроса).
+    Повторяются только подзапросы с временными ошибками, с растущей паузой.
+    Возвращает список (ответ, исключение) в порядке request_factories.
+    """
+    results = [(None, None)] * len(request_factories)
+    pending = list(range(len(request_factories)))
+
+    for attempt in range(BATCH_RETRIES + 1):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        retry = []
+        for chunk_start in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[chunk_start:chunk_start + BATCH_SIZE]
+
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if exception is not None and isinstance(exception, HttpError) \
+                        and exception.resp.status in ignore_statuses:
+                    exception = None
+                results[index] = (response, exception)
+                if exception is not None:
+                    CALENDAR_FAILURES.inc(op='batch_item', status=_failure_status(exception))
+                    if _is_retryable(exception):
+                        retry.append(index)
+
+            batch = _new_batch(service, callback)
+            for index in chunk:
+                batch.add(request_factories[index](), request_id=str(index))
+            with _observe_request('batch'):
+                batch.execute(http=_http_for(service))
+        if not retry:
+            break
+        logging.warning(f"Google Calendar batch: повтор {len(retry)} подзапросов")
+        pending = sorted(retry)
+
+    return results
+
+def calendar_event_key(telegram_id, event_name, date, start_time):
+    """
+    Заранее известный ID события в Google Calendar (base32hex: 0-9, a-v).
+    Служит ключом идемпотентности: повторная вставка не создаёт дубликат.
+    """
+    digest = hashlib.sha1(f"{telegram_id}|{event_name}|{date}|{start_time}".encode("utf-8")).hexdigest()
+    return f"hb{digest}"
+
+def calendar_event_payload(event):
+    """Событие календаря для create_calendar_events по записи таблицы events (формат db.add_event)."""
+    return {
+        "summary": f"{event['event_type'].capitalize()} «{event['event_name']}»",
+        "start_time": f"{event['date']}T{event['start_time']}:00",
+        "end_time": f"{event['date']}T{event['end_time']}:00",
+        "location": f"Зал {event['hall']}",
+        "description": event["role"],
+    }
+
+def create_calendar_events(service, events, event_ids=None):
+    """
+    Создаёт несколько событий одним batch-запросом. events — список словарей
+    с ключами summary, start_time, end_time, location, description.
+    event_ids — заранее известные ID (см. calendar_event_key): если событие
+    с таким ID уже есть (409), оно обновляется и восстанавливается.
+    Возвращает список ID в том же порядке; None — событие создать не удалось.
+    """
+    bodies = [_event_body(**ev) for ev in events]
+    if event_ids is not None:
+        for body, event_id in zip(bodies, event_ids):
+            body['id'] = event_id
+    factories = [
+        lambda body=body: service.events().insert(calendarId='primary', body=body)
+        for body in bodies
+    ]
+    results = _execute_batch(service, factories)
+
+    conflicts = [
+        i for i, (_, exception) in enumerate(results)
+        if event_ids is not None and isinstance(exception, HttpError) and exception.resp.status == 409
+    ]
+    if conflicts:
+        # Событие с этим ID уже создавалось (в т.ч. удалённое) — перезаписываем его
+        factories = [
+            lambda body=bodies[i]: service.events().update(
+                calendarId='primary', eventId=body['id'], body=dict(body, status='confirmed')
+            )
+            for i in conflicts
+        ]
+        for i, result in zip(conflicts, _execute_batch(service, factories)):
+            results[i] = result
+
+    ids = []
+    for response, exception in results:
+        if exception is not None:
+            logging.error(f"Ошибка Google Calendar при пакетном создании: {exception}")
+        ids.append(response['id'] if response and exception is None else None)
+    return ids
+
+def delete_calendar_events(service, event_ids):
+    """
+    Удаляет несколько событий одним batch-запросом. Уже удалённые (404/410)
+    считаются успехом. Возвращает список bool в порядке event_ids.
+    """
+    factories = [
+        lambda event_id=event_id: service.events().delete(calendarId='primary', eventId=event_id)
+        for event_id in event_ids
+    ]
+    done = []
+    for _, exception in _execute_batch(service, factories, ignore_statuses={404, 410}):
+        if exception is not None:
+            logging.error(f"Ошибка при пакетном удалении из Google Calendar: {exception}")
+        done.append(exception is None)
+    return done
@@ -0,0 +1,108 @@
+# http_client.py
+import asyncio
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+# Общий лимит соединений процесса и лимит одновременных запросов к одному хосту
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_PER_HOST = int(os.environ.get("HTTP_MAX_PER_HOST", 4))
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+
+_client = None
+_host_semaphores = {}
+# Ключ -> задача, которую ждут все одновременные запросы с этим ключом
+_inflight = {}
+
+FETCH_SECONDS = Histogram("http_fetch_duration_seconds", "Время загрузки страниц сайтов", ["host"])
+FETCH_ERRORS = Counter("http_fetch_errors_total", "Неудачные загрузки: сетевые ошибки и статусы 4xx/5xx",
+                       ["host", "reason"])
+
+
+def get_client():
+    """Возвращает общий для процесса httpx.AsyncClient с keep-alive пулом соединений."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    """Закрывает общий клиент (вызывается при остановке бота)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def record_fetch(url, seconds, status=None, error=None):
+    """Учитывает загрузку url в метриках; status >= 400 или error — ошибка."""
+    host = urlsplit(url).netloc
+    FETCH_SECONDS.observe(seconds, host=host)
+    if error is not None:
+        FETCH_ERRORS.inc(host=host, reason=type(error).__name__)
+    elif status is not None and status >= 400:
+        FETCH_ERRORS.inc(host=host, reason=f"http_{status}")
+
+
+def _host_semaphore(url):
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    return semaphore
+
+
+async def coalesced(key, factory):
+    """
+    Объединяет одновременные вызовы с одинаковым ключом: корутина factory()
+    запускается один раз, остальные вызывающие ждут её результат (или исключение).
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: отмена одного ожидающего не должна отменять запрос для остальных
+    return await asyncio.shield(task)
+
+
+async def fetch(url, headers=None):
+    """
+    GET-запрос через общий клиент с ограничением соединений на хост.
+    Одинаковые одновременные запросы выполняются один раз.
+    Возвращает httpx.Response (статус не проверяется, 304 — нормальный ответ).
+    """
+    headers = headers or {}
+    key = ("GET", url, tuple(sorted(headers.items())))
+
+    async def _do_fetch():
+        async with _host_semaphore(url):
+            start = time.perf_counter()
+            try:
+                response = await get_client().get(url, headers=headers)
+            except Exception as e:
+                record_fetch(url, time.perf_counter() - start, error=e)
+                raise
+            record_fetch(url, time.perf_counter() - start, response.status_code)
+            return response
+
+    return await coalesced(key, _do_fetch)
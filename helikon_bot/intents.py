@@ -0,0 +1,116 @@
+# intents.py
+from collections import deque
+from functools import lru_cache
+
+# Правила в порядке приоритета: срабатывает первое подходящее. Правило —
+# набор групп ключевых слов, из каждой группы в сообщении должно встретиться
+# хотя бы одно; exact — сообщение целиком совпадает с одной из фраз.
+# Несколько правил с одним намерением означают «или».
+INTENT_RULES = (
+    ("delete", (("удалить",), ("репетиц", "спектакл")), ()),
+    ("add", (("добавь",), ("репетиц", "спектакл")), ()),
+    ("my_week", (("этой неделе",), ("работаю", "расписан", "запланировано", "что у меня")), ()),
+    ("playbill_week", (("спектакл", "мероприят", "афиш"), ("этой неделе",)), ()),
+    ("playbill_next_week", (("спектакл", "мероприят", "афиш"), ("следующей неделе", "следующую неделю")), ()),
+    ("my_next_week", (("следующей неделе",),), ()),
+    ("my_next_week", (("расписание",), ("недел",)), ()),
+    ("confirm", (), ("да", "добавь")),
+    ("news", (("новост", "ново", "актуальн", "свеж", "театр"),), ()),
+    ("conductor", (("дириж",),), ()),
+    ("clarify", (("когда", "во сколько", "какой зал", "что сегодня", "репетиц", "спектакл"),), ()),
+)
+FALLBACK_INTENT = "fallback"
+
+# Слова, которые нужны не для выбора намерения, а для разбора команды (commands.py)
+EXTRA_KEYWORDS = ("шаховск", "покровск")
+
+
+def _build_automaton(keywords):
+    """
+    Автомат Ахо — Корасик, развёрнутый в детерминированный: за один проход по
+    тексту, по одному переходу на символ, находит все ключевые слова.
+    Возвращает таблицу переходов и выходы состояний (битовые маски слов).
+    """
+    goto, out = [{}], [0]
+    for bit, word in enumerate(keywords):
+        state = 0
+        for ch in word:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto.append({})
+                out.append(0)
+                goto[state][ch] = nxt
+            state = nxt
+        out[state] |= 1 << bit
+
+    # Обход в ширину: ссылка неудачи ведёт в более мелкое состояние, его
+    # переходы уже готовы. Переходы в корень не храним — это значение по умолчанию.
+    fail = [0] * len(goto)
+    delta = [dict(goto[0])] + [None] * (len(goto) - 1)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        delta[state] = dict(delta[fail[state]])
+        delta[state].update(goto[state])
+        out[state] |= out[fail[state]]
+        for ch, nxt in goto[state].items():
+            fail[nxt] = delta[fail[state]].get(ch, 0) if state else 0
+            queue.append(nxt)
+    return delta, out
+
+
+def _compile_rules(rules, bits):
+    compiled = []
+    for intent, groups, exact in rules:
+        masks = tuple(sum(1 << bits[word] for word in group) for group in groups)
+        compiled.append((intent, masks, frozenset(exact)))
+    return tuple(compiled)
+
+
+@lru_cache(maxsize=4096)
+def _match_rules(hits, exact_phrase):
+    # Намерение зависит только от набора найденных слов и точной фразы,
+    # поэтому правила проверяются один раз на каждое сочетание
+    for intent, masks, exact in _RULES:
+        if exact:
+            if exact_phrase in exact:
+                return intent
+        elif all(hits & mask for mask in masks):
+            return intent
+    return FALLBACK_INTENT
+
+
+KEYWORDS = tuple(dict.fromkeys(
+    [word for _, groups, _ in INTENT_RULES for group in groups for word in group] + list(EXTRA_KEYWORDS)
+))
+_KEYWORD_BITS = {word: bit for bit, word in enumerate(KEYWORDS)}
+_DELTA, _OUT = _build_automaton(KEYWORDS)
+_RULES = _compile_rules(INTENT_RULES, _KEYWORD_BITS)
+_EXACT_PHRASES = frozenset(phrase for _, _, exact in INTENT_RULES for phrase in exact)
+
+
+def scan(text_lower):
+    """Битовая маска ключевых слов из KEYWORDS, найденных в тексте."""
+    delta, out = _DELTA, _OUT
+    state = 0
+    hits = 0
+    for ch in text_lower:
+        state = delta[state].get(ch, 0)
+        hits |= out[state]
+    return hits
+
+
+def has_keyword(hits, word):
+    """Есть ли слово word (из KEYWORDS) среди найденных scan()."""
+    return bool(hits & (1 << _KEYWORD_BITS[word]))
+
+
+def classify(text_lower):
+    """
+    Определяет намерение сообщения. Возвращает (intent, hits), где hits — маска
+    найденных ключевых слов, пригодная для has_keyword() и разбора команды.
+    """
+    hits = scan(text_lower)
+    exact_phrase = text_lower if text_lower in _EXACT_PHRASES else None
+    return _match_rules(hits, exact_phrase), hits
@@ -0,0 +1,242 @@
+# metrics.py
+# Счётчики и гистограммы в текстовом формате Prometheus, без внешних зависимостей.
+# Эндпоинт /metrics поднимается на локальном порту из METRICS_PORT (см. start_metrics_server).
+# Сокращённая копия лежит в telegram_bot/tele_bot_for_flask_site/metrics.py:
+# изменения формата вывода и общих частей (Counter, Gauge, Histogram, timed,
+# start_metrics_server) переносить и туда.
+import inspect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # function() возвращает значение, которое ведётся в другом месте (статистика
+        # кэша, очередь пула): число или словарь {значение метки или кортеж: число}
+        self.function = function
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            if name in _registry:
+                raise ValueError(f"Метрика {name} уже зарегистрирована")
+            _registry[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _collect(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.error(f"Не удалось получить значение {self.name}: {e}")
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        with self._lock:
+            self._values = {(k if isinstance(k, tuple) else (str(k),)): v for k, v in value.items()}
+
+    def render(self):
+        if self.function is not None:
+            self._collect()
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение: задаётся через set() или считывается function() при опросе."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Распределение значений (обычно длительностей в секундах) по корзинам."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет блок with; время записывается и при исключении."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def timed(histogram, errors=None, **labels):
+    """
+    Декоратор: время каждого вызова — в histogram, исключения — в счётчик errors.
+    Метка function, если она есть у метрики и не задана явно, — имя функции.
+    Работает и с обычными функциями, и с корутинами.
+    """
+    def decorator(func):
+        call_labels = dict(labels)
+        if "function" in histogram.labelnames and "function" not in call_labels:
+            call_labels["function"] = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**call_labels)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - start, **call_labels)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**call_labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **call_labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Все зарегистрированные метрики в текстовом формате Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # Зависший клиент не должен надолго занимать единственный поток сервера
+    timeout = 10
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Опросы раз в несколько секунд не должны засорять журнал бота
+        pass
+
+
+def start_metrics_server(port=None, host=METRICS_HOST):
+    """
+    Поднимает /metrics в фоновом потоке. Порт — аргумент или METRICS_PORT;
+    если не задан ни тот, ни другой, эндпоинт не запускается. Возвращает сервер или None.
+    Запросы обслуживаются по одному в этом же потоке: функции Gauge(function=...)
+    всегда вызываются из него, и соединение с БД, которое они открывают
+    (db.get_connection в helikon_bot), одно на весь сервер, а не новое на каждый опрос.
+    """
+    if port is None:
+        port = os.environ.get("METRICS_PORT")
+        if not port:
+            return None
+    try:
+        server = HTTPServer((host, int(port)), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Не удалось открыть порт метрик {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -1,65 +1,226 @@
 # parser.py
+import asyncio
 import requests
-from bs4 import BeautifulSoup
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import logging
+import os
 import re
+import threading
+import time
+from urllib.parse import parse_qs, urljoin, urlsplit
+
+from lxml import etree, html as lxml_html
+
+from http_client import USER_AGENT, coalesced, fetch, record_fetch
+from metrics import Counter, Gauge
 
 logger = logging.getLogger(__name__)
 
-PLAYBILL_URL = "https://www.helikon.ru/ru/playbill"
+PLAYBILL_URL = os.environ.get("HELIKON_PLAYBILL_URL", "https://www.helikon.ru/ru/playbill")
+
+# Кэш афиши: сколько секунд страница считается свежей и сколько страниц храним
+PLAYBILL_CACHE_TTL = int(os.environ.get("PLAYBILL_CACHE_TTL", 300))
+PLAYBILL_CACHE_MAX_ENTRIES = int(os.environ.get("PLAYBILL_CACHE_MAX_ENTRIES", 16))
+
+# Обход афиши по месяцам и страницам: максимум страниц и одновременных загрузок
+CRAWL_MAX_PAGES = int(os.environ.get("CRAWL_MAX_PAGES", 12))
+CRAWL_CONCURRENCY = int(os.environ.get("CRAWL_CONCURRENCY", 4))
+
+# url -> {"events": [...], "links": [...], "etag": str | None, "last_modified": str | None, "fetched_at": float}
+_playbill_cache = OrderedDict()
+_playbill_cache_lock = threading.Lock()
+_playbill_cache_stats = {"hits": 0, "misses": 0, "not_modified": 0}
+
+NEWS_URL = os.environ.get("HELIKON_NEWS_URL", "https://www.helikon.ru/ru/news/")
+
+
+def _get(url, headers):
+    """requests.get для синхронных функций, с учётом в метриках загрузки."""
+    start = time.perf_counter()
+    try:
+        response = requests.get(url, headers=headers, timeout=10)
+    except Exception as e:
+        record_fetch(url, time.perf_counter() - start, error=e)
+        raise
+    record_fetch(url, time.perf_counter() - start, response.status_code)
+    return response
+
 
 def parse_news(max_news=5):
     """
     Парсит новости с https://www.helikon.ru/ru/news/
     Возвращает список строк вида: "26.09.2025 — Текст новости"
     """
-    url = "https://www.helikon.ru/ru/news/"
+    url = NEWS_URL
     try:
         headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+            "User-Agent": USER_AGENT
         }
-        response = requests.get(url, headers=headers, timeout=10)
+        response = _get(url, headers)
         response.raise_for_status()
         response.encoding = 'utf-8'
 
-        soup = BeautifulSoup(response.text, 'html.parser')
-        news_items = []
+        return _parse_news_html(response.text, max_news)
 
-        for li in soup.select('ul li'):
-            text = li.get_text(strip=True)
-            if not text:
-                continue
+    except Exception as e:
+        logger.error(f"Ошибка при парсинге новостей: {e}")
+        return [f"Ошибка при загрузке новостей: {str(e)}"]
 
-            # Убираем дублирующуюся дату: "26.09.2025 26.09.2025Текст" → "26.09.2025Текст"
-            text = re.sub(r'^(\d{2}\.\d{2}\.\d{4})\s+\1', r'\1', text)
 
-            # Извлекаем дату
-            date_match = re.match(r'^(\d{2}\.\d{2}\.\d{4})', text)
-            if not date_match:
-                continue
-            date = date_match.group(1)
-            body = text[len(date):].strip()
+async def parse_news_async(max_news=5):
+    """Асинхронная версия parse_news: не блокирует цикл событий бота."""
+    try:
+        response = await fetch(NEWS_URL)
+        response.raise_for_status()
+        html = response.content.decode('utf-8', errors='replace')
+        return await asyncio.to_thread(_parse_news_html, html, max_news)
+    except Exception as e:
+        logger.error(f"Ошибка при парсинге новостей: {e}")
+        return [f"Ошибка при загрузке новостей: {str(e)}"]
 
-            if not body:
-                continue
 
-            # Формируем строку для вывода
-            news_items.append(f"{date} — {body}")
+# Регулярные выражения и замены разбора компилируются один раз, при импорте
+_NEWS_DUP_DATE_RE = re.compile(r'^(\d{2}\.\d{2}\.\d{4})\s+\1')
+_NEWS_DATE_RE = re.compile(r'^(\d{2}\.\d{2}\.\d{4})')
+_AFISHA_DATE_RE = re.compile(r'(\d{2})\.(\d{2})\.(\d{4})')
+_TITLE_SUFFIX_RE = re.compile(r'\s+(?:Премьера|В рамках|Хореографический спектакль)')
+_EXCURSION_KEYWORDS = ('экскурс', 'историческ', 'техническ')
+_CONCERT_KEYWORDS = ('концерт', 'jazzкафе', 'гостиная', 'каф', 'юбилейный концерт')
+_HALL_REPLACEMENTS = (
+    ('Белоколонный зал княгини Шаховской', 'Шаховской'),
+    ('Зал «Стравинский»', 'Стравинский'),
+    ('Зал «Покровский»', 'Покровский'),
+)
 
-        if not news_items:
-            return ["Новости не найдены."]
 
-        return news_items[:max_news]
+def _html_root(html):
+    """Дерево lxml без промежуточных объектов BeautifulSoup; None для пустой страницы."""
+    if not html or not html.strip():
+        return None
+    try:
+        return lxml_html.document_fromstring(html)
+    except (etree.ParserError, ValueError):
+        return None
 
-    except Exception as e:
-        logger.error(f"Ошибка при парсинге новостей: {e}")
-        return [f"Ошибка при загрузке новостей: {str(e)}"]
+
+def _text(element):
+    """Аналог BeautifulSoup get_text(strip=True): склеенные обрезанные текстовые узлы."""
+    return "".join(part.strip() for part in element.itertext())
+
+
+def _parse_news_html(html, max_news=5):
+    """Разбирает HTML страницы новостей (см. parse_news)."""
+    root = _html_root(html)
+    news_items = []
+
+    for li in root.xpath('//ul//li') if root is not None else ():
+        text = _text(li)
+        if not text:
+            continue
+
+        # Убираем дублирующуюся дату: "26.09.2025 26.09.2025Текст" → "26.09.2025Текст"
+        text = _NEWS_DUP_DATE_RE.sub(r'\1', text)
+
+        # Извлекаем дату
+        date_match = _NEWS_DATE_RE.match(text)
+        if not date_match:
+            continue
+        date = date_match.group(1)
+        body = text[len(date):].strip()
+
+        if not body:
+            continue
+
+        # Формируем строку для вывода
+        news_items.append(f"{date} — {body}")
+
+    if not news_items:
+        return ["Новости не найдены."]
+
+    return news_items[:max_news]
 
 
 # --- Остальной код (parse_afisha, get_events_for_week, calculate_end_time) остаётся без изменений ---
 
-def parse_afisha():
+def _cache_requests():
+    stats = get_playbill_cache_stats()
+    return {("playbill", result): stats[key] for key, result in
+            (("hits", "hit"), ("misses", "miss"), ("not_modified", "not_modified"))}
+
+
+CACHE_REQUESTS = Counter("cache_requests_total", "Обращения к кэшам по результату", ["cache", "result"],
+                         function=_cache_requests)
+CACHE_SIZE = Gauge("cache_entries", "Число записей в кэшах", ["cache"],
+                   function=lambda: {"playbill": get_playbill_cache_stats()["size"]})
+
+
+def get_playbill_cache_stats():
+    """Возвращает счётчики кэша афиши: hits, misses, not_modified (ответы 304) и size."""
+    with _playbill_cache_lock:
+        stats = dict(_playbill_cache_stats)
+        stats["size"] = len(_playbill_cache)
+    return stats
+
+
+def clear_playbill_cache():
+    """Сбрасывает кэш афиши и его счётчики."""
+    with _playbill_cache_lock:
+        _playbill_cache.clear()
+        for key in _playbill_cache_stats:
+            _playbill_cache_stats[key] = 0
+
+
+def _cache_lookup(url):
+    """Возвращает (запись, свежая ли она). Свежая запись засчитывается как попадание."""
+    with _playbill_cache_lock:
+        entry = _playbill_cache.get(url)
+        if entry is None:
+            _playbill_cache_stats["misses"] += 1
+            return None, False
+        _playbill_cache.move_to_end(url)
+        if time.monotonic() - entry["fetched_at"] < PLAYBILL_CACHE_TTL:
+            _playbill_cache_stats["hits"] += 1
+            return entry, True
+        _playbill_cache_stats["misses"] += 1
+        return entry, False
+
+
+def _conditional_headers(entry):
+    """Заголовки условного запроса для повторной проверки устаревшей записи."""
+    headers = {}
+    if entry:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def _cache_touch(url):
+    """Страница не изменилась (304): продлеваем срок жизни без повторного разбора."""
+    with _playbill_cache_lock:
+        entry = _playbill_cache.get(url)
+        if entry is not None:
+            entry["fetched_at"] = time.monotonic()
+        _playbill_cache_stats["not_modified"] += 1
+
+
+def _cache_store(url, events, headers, links=()):
+    with _playbill_cache_lock:
+        _playbill_cache[url] = {
+            "events": events,
+            "links": list(links),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched_at": time.monotonic(),
+        }
+        _playbill_cache.move_to_end(url)
+        while len(_playbill_cache) > PLAYBILL_CACHE_MAX_ENTRIES:
+            _playbill_cache.popitem(last=False)
+
+
+def parse_afisha(url=PLAYBILL_URL):
     """
     Парсит афишу с https://www.helikon.ru/ru/playbill  
     Возвращает список событий в формате:
@@ -70,68 +231,238 @@ def parse_afisha():
         'hall': str,
         'type': 'спектакль'  # или 'концерт', 'экскурсия' и т.д.
     }
+    Результат кэшируется на PLAYBILL_CACHE_TTL секунд, после чего страница
+    перепроверяется через ETag/If-Modified-Since: ответ 304 не требует разбора.
     """
+    entry, fresh = _cache_lookup(url)
+    if fresh:
+        return list(entry["events"])
+
     try:
-        response = requests.get(PLAYBILL_URL, timeout=10)
+        response = _get(url, _conditional_headers(entry))
+        if response.status_code == 304 and entry is not None:
+            _cache_touch(url)
+            return list(entry["events"])
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'lxml')
-
-        events = []
-
-        rows = soup.select('table tr')
-        for row in rows:
-            cols = row.find_all('td')
-            if len(cols) < 5:
-                continue
-
-            date_cell = cols[0].get_text(strip=True)
-            title_cell = cols[1].get_text(strip=True)
-            time_cell = cols[3].get_text(strip=True)
-            hall_cell = cols[4].get_text(strip=True)
-
-            date_match = re.search(r'\d{2}\.\d{2}\.\d{4}', date_cell)
-            if not date_match:
-                continue
-            date_str = date_match.group()
-
-            title_lower = title_cell.lower()
-            if any(kw in title_lower for kw in ['экскурс', 'историческ', 'техническ']):
-                event_type = "экскурсия"
-            elif any(kw in title_lower for kw in ['концерт', 'jazzкафе', 'гостиная', 'каф', 'юбилейный концерт']):
-                event_type = "концерт"
-            else:
-                event_type = "спектакль"
-
-            clean_title = re.split(r'\s+(Премьера|В рамках|Хореографический спектакль)', title_cell)[0].strip()
-
-            hall_clean = hall_cell.replace('Белоколонный зал княгини Шаховской', 'Шаховской') \
-                                 .replace('Зал «Стравинский»', 'Стравинский') \
-                                 .replace('Зал «Покровский»', 'Покровский') \
-                                 .strip()
-
-            try:
-                dt = datetime.strptime(date_str, "%d.%m.%Y")
-                date_iso = dt.strftime("%Y-%m-%d")
-            except ValueError:
-                continue
-
-            events.append({
-                "event_name": clean_title,
-                "date": date_iso,
-                "time": time_cell,
-                "hall": hall_clean,
-                "type": event_type
-            })
-
-        return events
+
+        events = _parse_afisha_html(response.text)
+        _cache_store(url, events, response.headers, _discover_playbill_links(response.text, url))
+        return list(events)
     except Exception as e:
         logger.error(f"Ошибка парсинга афиши: {e}")
+        # Лучше устаревшая афиша, чем никакой
+        return list(entry["events"]) if entry else []
+
+
+async def parse_afisha_async(url=PLAYBILL_URL):
+    """
+    Асинхронная версия parse_afisha с тем же кэшем. Одновременные вызовы
+    для одного URL выполняют одну загрузку и один разбор страницы.
+    """
+    events, _, _ = await _fetch_playbill_page(url)
+    return list(events)
+
+
+async def _fetch_playbill_page(url):
+    """
+    Возвращает (события, ссылки на другие страницы афиши, ok) для url — из кэша
+    или с сайта. ok=False — страницу загрузить не удалось, и события взяты
+    из устаревшего кэша или их нет вовсе.
+    """
+    entry, fresh = _cache_lookup(url)
+    if fresh:
+        return entry["events"], entry["links"], True
+    return await coalesced(("afisha", url), lambda: _load_afisha_async(url, entry))
+
+
+async def _load_afisha_async(url, entry):
+    try:
+        response = await fetch(url, _conditional_headers(entry))
+        if response.status_code == 304 and entry is not None:
+            _cache_touch(url)
+            return entry["events"], entry["links"], True
+        response.raise_for_status()
+
+        # Разбор большой страницы — в отдельном потоке, чтобы не держать цикл событий
+        html = response.text
+        events, links = await asyncio.to_thread(
+            lambda: (_parse_afisha_html(html), _discover_playbill_links(html, url))
+        )
+        _cache_store(url, events, response.headers, links)
+        return events, links, True
+    except Exception as e:
+        logger.error(f"Ошибка парсинга афиши {url}: {e}")
+        return (entry["events"], entry["links"], False) if entry else ([], [], False)
+
+
+# Ссылки на страницы афиши по месяцам и пагинацию: /playbill?month=..., ?PAGEN_1=2, /playbill/2025-11 и т.п.
+_HREF_RE = re.compile(r'href\s*=\s*["\']([^"\'#]+)["\']', re.IGNORECASE)
+_PLAYBILL_PAGE_RE = re.compile(
+    r'/playbill/?(?:\?.*\b(?:month|date|year|page|PAGEN_\d+)=|/\d{4}[-/]\d{1,2}\b)', re.IGNORECASE
+)
+_URL_MONTH_RE = re.compile(r'(\d{4})[-/.](\d{1,2})(?!\d)')
+
+
+def _discover_playbill_links(html, base_url):
+    """Ссылки на другие месяцы и страницы афиши (абсолютные, без повторов, в порядке появления)."""
+    base_host = urlsplit(base_url).netloc
+    links = []
+    seen = {base_url}
+    for href in _HREF_RE.findall(html):
+        href = href.replace("&amp;", "&")
+        if not _PLAYBILL_PAGE_RE.search(href):
+            continue
+        url = urljoin(base_url, href)
+        if urlsplit(url).netloc != base_host or url in seen:
+            continue
+        seen.add(url)
+        links.append(url)
+    return links
+
+
+def _link_month(url):
+    """(год, месяц) страницы афиши, если его видно из URL, иначе None."""
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    for key in ("month", "date"):
+        if key in query:
+            value = query[key][0]
+            match = _URL_MONTH_RE.search(value)
+            if match:
+                return int(match.group(1)), int(match.group(2))
+            if value.isdigit() and "year" in query and query["year"][0].isdigit():
+                return int(query["year"][0]), int(value)
+    match = _URL_MONTH_RE.search(parts.path)
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    return None
+
+
+def _month_in_range(url, start_date, end_date):
+    month = _link_month(url)
+    if month is None or not (1 <= month[1] <= 12):
+        # Страница пагинации или непонятный формат — загрузим, лишнее отфильтруется по датам
+        return True
+    first = (month[0], month[1])
+    return (start_date.year, start_date.month) <= first <= (end_date.year, end_date.month)
+
+
+async def crawl_afisha_async(start_date=None, end_date=None, max_pages=CRAWL_MAX_PAGES, concurrency=CRAWL_CONCURRENCY):
+    """
+    Обходит афишу по месяцам и страницам, начиная с PLAYBILL_URL: каждая «волна»
+    найденных ссылок загружается параллельно (не больше concurrency одновременно).
+    Возвращает (events, complete): объединённый список событий без повторов
+    (формат parse_afisha), отсортированный по дате и времени, за даты
+    start_date..end_date (если заданы), и признак полного обхода. complete=False,
+    если какая-то страница не загрузилась (её события — из устаревшего кэша или
+    пропущены) или обход упёрся в max_pages: пропавшее из такой афиши событие
+    не обязательно отменено.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(url):
+        async with semaphore:
+            return await _fetch_playbill_page(url)
+
+    seen = {PLAYBILL_URL}
+    frontier = [PLAYBILL_URL]
+    merged = {}
+    failed = []
+    truncated = False
+    while frontier:
+        pages = await asyncio.gather(*(load(url) for url in frontier))
+        loaded, frontier = frontier, []
+        for url, (events, links, ok) in zip(loaded, pages):
+            if not ok:
+                failed.append(url)
+            for ev in events:
+                merged.setdefault((ev["date"], ev["time"], ev["event_name"]), ev)
+            for link in links:
+                if link in seen:
+                    continue
+                if start_date and end_date and not _month_in_range(link, start_date, end_date):
+                    continue
+                if len(seen) >= max_pages:
+                    truncated = True
+                    break
+                seen.add(link)
+                frontier.append(link)
+
+    if failed:
+        logger.warning(f"Афиша загружена не полностью, страницы с ошибками: {', '.join(failed)}")
+    if truncated:
+        logger.warning(f"Обход афиши остановлен на {max_pages} страницах (CRAWL_MAX_PAGES)")
+
+    start_iso = start_date.isoformat() if start_date else ""
+    end_iso = end_date.isoformat() if end_date else "9999-12-31"
+    events = [
+        merged[key] for key in sorted(merged)
+        if start_iso <= key[0] <= end_iso
+    ]
+    return events, not failed and not truncated
+
+
+def _parse_afisha_html(html):
+    """
+    Разбирает HTML страницы афиши в список событий (см. parse_afisha).
+    Дерево строит lxml, из него XPath берёт только строки таблиц.
+    """
+    root = _html_root(html)
+    if root is None:
         return []
 
+    events = []
+
+    for row in root.xpath('//table//tr'):
+        cols = list(row.iter('td'))
+        if len(cols) < 5:
+            continue
+
+        date_match = _AFISHA_DATE_RE.search(_text(cols[0]))
+        if not date_match:
+            continue
+        day, month, year = date_match.groups()
+        try:
+            date_iso = datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+
+        title_cell = _text(cols[1])
+        time_cell = _text(cols[3])
+        hall_cell = _text(cols[4])
+
+        title_lower = title_cell.lower()
+        if any(kw in title_lower for kw in _EXCURSION_KEYWORDS):
+            event_type = "экскурсия"
+        elif any(kw in title_lower for kw in _CONCERT_KEYWORDS):
+            event_type = "концерт"
+        else:
+            event_type = "спектакль"
+
+        clean_title = _TITLE_SUFFIX_RE.split(title_cell, 1)[0].strip()
+
+        hall_clean = hall_cell
+        for long_name, short_name in _HALL_REPLACEMENTS:
+            hall_clean = hall_clean.replace(long_name, short_name)
+        hall_clean = hall_clean.strip()
+
+        events.append({
+            "event_name": clean_title,
+            "date": date_iso,
+            "time": time_cell,
+            "hall": hall_clean,
+            "type": event_type
+        })
+
+    return events
+
 
-def get_events_for_week(start_date: datetime.date, end_date: datetime.date):
-    """Возвращает все спектакли и концерты (не экскурсии) между start_date и end_date."""
-    all_events = parse_afisha()
+def get_events_for_week(start_date: datetime.date, end_date: datetime.date, events=None):
+    """
+    Возвращает все спектакли и концерты (не экскурсии) между start_date и end_date.
+    events — уже загруженная афиша (например, снимок prefetch); если не передана, афиша скачивается.
+    """
+    all_events = parse_afisha() if events is None else events
     result = []
     for ev in all_events:
         if ev["type"] == "экскурсия":
@@ -139,19 +470,47 @@ def get_events_for_week(start_date: datetime.date, end_date: datetime.date):
         try:
             ev_date = datetime.strptime(ev["date"], "%Y-%m-%d").date()
             if start_date <= ev_date <= end_date:
-                result.append({
-                    "date": ev["date"],
-                    "start": ev["time"],
-                    "end": calculate_end_time(ev["time"]),
-                    "hall": ev["hall"],
-                    "type": ev["type"],
-                    "event_name": ev["event_name"]
-                })
+                result.append(_week_event(ev))
         except Exception as e:
             logger.warning(f"Ошибка обработки даты события: {e}")
     return result
 
 
+def _week_event(ev):
+    """Событие афиши в формате ответа бота и pending_events."""
+    return {
+        "date": ev["date"],
+        "start": ev["time"],
+        "end": calculate_end_time(ev["time"]),
+        "hall": ev["hall"],
+        "type": ev["type"],
+        "event_name": ev["event_name"]
+    }
+
+
+def index_events_by_date(events):
+    """
+    Строит индекс афиши {'YYYY-MM-DD': [событие, ...]} в формате get_events_for_week
+    (без экскурсий). Время окончания считается один раз, при построении.
+    """
+    index = {}
+    for ev in events:
+        if ev["type"] == "экскурсия":
+            continue
+        index.setdefault(ev["date"], []).append(_week_event(ev))
+    return index
+
+
+def events_in_range(index, start_date, end_date):
+    """Выборка из index_events_by_date за даты start_date..end_date: по одному поиску на день."""
+    result = []
+    day = start_date
+    while day <= end_date:
+        result.extend(index.get(day.isoformat(), ()))
+        day += timedelta(days=1)
+    return result
+
+
 def calculate_end_time(start_time: str) -> str:
     """Рассчитывает время окончания (спектакль ~2.5 ч, концерт ~1.5 ч)"""
     try:
@@ -0,0 +1,241 @@
+# persistence.py
+# user_data и chat_data бота в SQLite (таблица conversation_state): ожидающие
+# подтверждения «да» (pending_events) переживают перезапуск. В памяти остаются
+# только недавно писавшие пользователи, остальные выгружаются и подгружаются
+# при следующем сообщении. Данные старше STATE_TTL считаются устаревшими.
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import delete_expired_conversation_state, load_conversation_state, save_conversation_state
+from executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Сколько живут сохранённые данные без изменений (секунды)
+STATE_TTL = int(os.environ.get("STATE_TTL", 2 * 86400))
+# Через сколько секунд без сообщений данные выгружаются из памяти
+STATE_IDLE_SECONDS = int(os.environ.get("STATE_IDLE_SECONDS", 1800))
+# Сколько записей держать в памяти, даже если все активны
+STATE_CACHE_SIZE = int(os.environ.get("STATE_CACHE_SIZE", 10000))
+# Как часто Application передаёт изменения на запись (секунды); пишутся одной транзакцией
+STATE_FLUSH_INTERVAL = int(os.environ.get("STATE_FLUSH_INTERVAL", 60))
+# Как часто проверять, кого выгрузить, и удалять устаревшие записи из таблицы
+STATE_EVICT_INTERVAL = 60
+STATE_CLEANUP_INTERVAL = 3600
+
+
+def _dump(data):
+    """JSON для записи; None — данных нет (запись удаляется)."""
+    return json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранилище user_data и chat_data. Данные загружаются не при старте,
+    а лениво — в refresh_*_data перед обработкой обновления. Изменения,
+    которые Application отдаёт раз в update_interval, копятся и пишутся
+    одной транзакцией. bot_data, callback_data и диалоги не хранятся.
+    """
+
+    def __init__(self, ttl=STATE_TTL, idle_seconds=STATE_IDLE_SECONDS, max_entries=STATE_CACHE_SIZE,
+                 update_interval=STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl = ttl
+        self.idle_seconds = idle_seconds
+        self.max_entries = max_entries
+        # (kind, key) -> [время последнего обращения, JSON последней записанной версии,
+        # словарь Application с этими данными]; порядок — от давно не писавших к недавним (LRU)
+        self._entries = OrderedDict()
+        # Ещё не записанные изменения: (kind, key) -> JSON или None
+        self._pending = {}
+        # Записи, выгруженные из памяти через Application.drop_*_data: их drop не удаляет из БД
+        self._evicting = set()
+        self._flush_task = None
+        self._last_cleanup = time.monotonic()
+
+    # --- Загрузка ---
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def _refresh(self, kind, key, data):
+        entry_key = (kind, key)
+        entry = self._entries.get(entry_key)
+        if entry is not None:
+            entry[0] = time.monotonic()
+            entry[2] = data
+            self._entries.move_to_end(entry_key)
+            return
+        if entry_key in self._pending:
+            # Выгружено раньше, чем изменения успели записаться
+            raw = self._pending[entry_key]
+        else:
+            raw = await run_blocking(load_conversation_state, kind, key, self.ttl)
+        if raw and not data:
+            data.update(json.loads(raw))
+        self._entries[entry_key] = [time.monotonic(), raw, data]
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Запись ---
+
+    def _stage(self, kind, key, data):
+        try:
+            raw = _dump(data)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Данные {kind} {key} не сохранены — не сериализуются в JSON: {e}")
+            return
+        entry = self._entries.get((kind, key))
+        if entry is None:
+            if raw is None:
+                # Пустые данные того, кого мы не загружали, — не повод удалять запись
+                return
+            entry = self._entries[(kind, key)] = [time.monotonic(), None, data]
+        entry[2] = data
+        if entry[1] == raw:
+            return
+        entry[1] = raw
+        self._pending[(kind, key)] = raw
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # Application вызывает update_*_data для всех изменившихся записей разом;
+        # задача записи запускается после них и забирает всю пачку
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, {}
+                try:
+                    await run_blocking(save_conversation_state,
+                                       [(kind, key, raw) for (kind, key), raw in batch.items()])
+                except Exception as e:
+                    logger.error(f"Не удалось сохранить данные пользователей ({len(batch)} записей): {e}")
+                    # Повторим со следующей пачкой; более новые изменения важнее
+                    for entry_key, raw in batch.items():
+                        self._pending.setdefault(entry_key, raw)
+                    return
+            if time.monotonic() - self._last_cleanup >= STATE_CLEANUP_INTERVAL:
+                self._last_cleanup = time.monotonic()
+                removed = await run_blocking(delete_expired_conversation_state, self.ttl)
+                if removed:
+                    logger.info(f"Удалено устаревших записей user_data/chat_data: {removed}")
+        finally:
+            self._flush_task = None
+
+    async def update_user_data(self, user_id, data):
+        self._stage("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage("chat", chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    def _drop(self, kind, key):
+        entry_key = (kind, key)
+        if entry_key in self._evicting:
+            self._evicting.discard(entry_key)
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                # Пользователь написал снова раньше, чем Application передал выгрузку:
+                # его update_*_data Application при этом пропускает (удаление важнее),
+                # так что новые данные записываем сами
+                self._stage(kind, key, entry[2])
+            return
+        self._entries.pop(entry_key, None)
+        self._pending[entry_key] = None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._drop("user", user_id)
+
+    async def drop_chat_data(self, chat_id):
+        self._drop("chat", chat_id)
+
+    async def flush(self):
+        """Дописывает всё накопленное (Application вызывает при остановке)."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_pending()
+
+    # --- Выгрузка из памяти ---
+
+    def evict(self, application):
+        """
+        Выгружает из памяти Application данные тех, кто давно не писал, и самые
+        старые записи сверх max_entries. Выгружаются только данные, уже переданные
+        на запись: свежие изменения дождутся следующего update_persistence.
+        """
+        now = time.monotonic()
+        excess = len(self._entries) - self.max_entries
+        evicted = 0
+        for entry_key, (last_access, raw, _) in list(self._entries.items()):
+            if excess <= 0 and now - last_access < self.idle_seconds:
+                break
+            kind, key = entry_key
+            store = application.user_data if kind == "user" else application.chat_data
+            current = store.get(key)
+            try:
+                if _dump(current) != raw:
+                    continue
+            except (TypeError, ValueError):
+                continue
+            del self._entries[entry_key]
+            excess -= 1
+            evicted += 1
+            if current is not None:
+                # Application.drop_*_data убирает запись из памяти и на следующем
+                # update_persistence вызовет drop_*_data — его пропускаем (см. _drop)
+                self._evicting.add(entry_key)
+                if kind == "user":
+                    application.drop_user_data(key)
+                else:
+                    application.drop_chat_data(key)
+        if evicted:
+            logger.debug(f"Выгружено из памяти user_data/chat_data: {evicted}")
+
+
+async def evict_job(context):
+    context.application.persistence.evict(context.application)
+
+
+def schedule_state_eviction(job_queue):
+    job_queue.run_repeating(evict_job, interval=STATE_EVICT_INTERVAL, first=STATE_EVICT_INTERVAL,
+                            name="state_eviction")
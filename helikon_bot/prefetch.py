@@ -0,0 +1,133 @@
+# prefetch.py
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+
+from db import get_playbill, sync_playbill
+from executor import run_blocking
+from parser import crawl_afisha_async, parse_news_async, index_events_by_date, events_in_range
+
+logger = logging.getLogger(__name__)
+
+# Интервал фонового обновления афиши и новостей (секунды)
+PREFETCH_INTERVAL = int(os.environ.get("PREFETCH_INTERVAL", 600))
+# Случайный разброс интервала, доля от него (чтобы не бить по сайту строго по часам)
+PREFETCH_JITTER = float(os.environ.get("PREFETCH_JITTER", 0.1))
+# Первый повтор после ошибки (секунды); дальше задержка удваивается, но не больше PREFETCH_INTERVAL
+PREFETCH_RETRY_DELAY = int(os.environ.get("PREFETCH_RETRY_DELAY", 30))
+# На сколько дней вперёд обходить афишу (все месяцы, попадающие в этот диапазон)
+PREFETCH_DAYS_AHEAD = int(os.environ.get("PREFETCH_DAYS_AHEAD", 92))
+
+# Последний удачный снимок сайта. Обработчики читают только его и никогда не ходят на helikon.ru.
+# Афиша хранится индексом по дате (parser.index_events_by_date) и дублируется в таблице playbill.
+_snapshot = {
+    "afisha_index": {},
+    "news": [],
+    "afisha_updated_at": None,
+    "news_updated_at": None,
+}
+_failures = 0
+
+
+def get_afisha_for_range(start_date, end_date):
+    """Спектакли и концерты из снимка за даты start_date..end_date (формат parser.get_events_for_week)."""
+    return events_in_range(_snapshot["afisha_index"], start_date, end_date)
+
+
+def _playbill_start():
+    # Начало текущей недели: запросы «на этой неделе» показывают её целиком
+    today = datetime.now().date()
+    return today - timedelta(days=today.weekday())
+
+
+def load_snapshot_from_store():
+    """Заполняет снимок афиши из таблицы playbill, чтобы после перезапуска бот отвечал сразу."""
+    _snapshot["afisha_index"] = index_events_by_date(get_playbill(_playbill_start()))
+
+
+def get_news_snapshot():
+    """Возвращает последний удачный список новостей (может быть пустым до первой загрузки)."""
+    return _snapshot["news"]
+
+
+def get_snapshot_info():
+    """Время последних удачных обновлений и число подряд неудачных попыток."""
+    return {
+        "afisha_updated_at": _snapshot["afisha_updated_at"],
+        "news_updated_at": _snapshot["news_updated_at"],
+        "failures": _failures,
+    }
+
+
+async def refresh_snapshot():
+    """
+    Обновляет снимок афиши и новостей. При ошибке части снимка
+    остаются прежними. Возвращает True, если обновились обе части.
+    """
+    start = _playbill_start()
+    (afisha, complete), news = await asyncio.gather(
+        crawl_afisha_async(start, start + timedelta(days=PREFETCH_DAYS_AHEAD)),
+        parse_news_async(),
+    )
+
+    ok = True
+    if afisha:
+        if not complete:
+            logger.warning("Афиша загружена не полностью: отмены не отмечаются до следующего полного обхода")
+        diff = await run_blocking(sync_playbill, afisha, cancel_missing=complete)
+        if any(diff.values()):
+            logger.info(
+                f"Афиша изменилась: добавлено {len(diff['added'])}, "
+                f"изменено {len(diff['changed'])}, отменено {len(diff['cancelled'])}"
+            )
+            for ev in diff["cancelled"]:
+                logger.info(f"Отменено: {ev['date']} {ev['time']} «{ev['event_name']}»")
+        rows = await run_blocking(get_playbill, start)
+        _snapshot["afisha_index"] = index_events_by_date(rows)
+        _snapshot["afisha_updated_at"] = datetime.now()
+    else:
+        logger.warning("Афиша не обновлена, используется предыдущий снимок")
+        ok = False
+
+    if news and "Ошибка" not in news[0]:
+        # Пустая страница новостей — тоже удачное обновление, просто новостей нет
+        _snapshot["news"] = [] if news == ["Новости не найдены."] else news
+        _snapshot["news_updated_at"] = datetime.now()
+    else:
+        logger.warning("Новости не обновлены, используется предыдущий снимок")
+        ok = False
+
+    return ok
+
+
+def _next_delay(failures):
+    """
+    Интервал до следующего обновления плюс разброс. После ошибки повтор идёт
+    раньше обычного, чтобы устаревший снимок не жил дольше, чем нужно; при
+    повторных ошибках задержка растёт, пока не дойдёт до PREFETCH_INTERVAL.
+    """
+    delay = min(PREFETCH_RETRY_DELAY * (2 ** (failures - 1)), PREFETCH_INTERVAL) if failures else PREFETCH_INTERVAL
+    return delay * random.uniform(1 - PREFETCH_JITTER, 1 + PREFETCH_JITTER)
+
+
+async def prefetch_job(context):
+    """Задача JobQueue: обновляет снимок и сама планирует следующий запуск."""
+    global _failures
+    try:
+        ok = await refresh_snapshot()
+    except Exception as e:
+        logger.error(f"Ошибка фонового обновления сайта: {e}")
+        ok = False
+
+    _failures = 0 if ok else _failures + 1
+    delay = _next_delay(_failures)
+    logger.info(f"Следующее обновление афиши и новостей через {delay:.0f} с")
+    context.job_queue.run_once(prefetch_job, when=delay, name="prefetch")
+
+
+def schedule_prefetch(job_queue):
+    """Регистрирует фоновое обновление; первый запуск — сразу после старта бота."""
+    load_snapshot_from_store()
+    job_queue.run_once(prefetch_job, when=0, name="prefetch")
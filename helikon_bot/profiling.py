@@ -0,0 +1,223 @@
+# profiling.py
+# Профилирование работающего бота без перезапуска: сэмплирующий профайлер
+# (команда /profile для администраторов или сигнал SIGUSR2) и журнал времени
+# этапов обработки каждого обновления (разбор, БД, Calendar, отправка ответа).
+import contextvars
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Профили пишутся в формате collapsed stacks (flamegraph.pl, speedscope, inferno)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Шаг сэмплирования стеков всех потоков (секунды)
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+# Сессия не длится дольше этого, даже если ждёт N обновлений
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", 600))
+# Длительность сессии, запущенной сигналом SIGUSR2
+PROFILE_SIGNAL_SECONDS = int(os.environ.get("PROFILE_SIGNAL_SECONDS", 30))
+# Telegram ID, которым доступна команда /profile (через запятую)
+ADMIN_IDS = frozenset(int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip())
+# Время этапов пишется в журнал для обновлений не быстрее порога (0 — для всех)
+UPDATE_TIMING_THRESHOLD_MS = float(os.environ.get("UPDATE_TIMING_THRESHOLD_MS", 0))
+
+_session = None
+_session_lock = threading.Lock()
+
+# Этапы текущего обновления: имя -> секунды; None вне trace()
+_spans = contextvars.ContextVar("update_spans", default=None)
+
+# Модуль блокирующей функции -> этап (см. executor.run_blocking)
+_MODULE_SPANS = {"db": "db", "google_calendar": "calendar", "calendar_sync": "calendar"}
+
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+
+class _ProfileSession(threading.Thread):
+    """Фоновый поток, который раз в interval снимает стеки всех остальных потоков."""
+
+    def __init__(self, seconds, updates, on_finish, interval):
+        super().__init__(name="profiler", daemon=True)
+        self.seconds = seconds
+        self.updates_left = updates
+        self.on_finish = on_finish
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self.path = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        deadline = self.started_at + min(self.seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        while not self._stop_event.wait(self.interval) and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[_collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+            self.samples += 1
+        self._finish()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _finish(self):
+        global _session
+        try:
+            self.path = _write_profile(self.stacks)
+            logger.info(f"Профиль записан: {self.path} ({self.samples} сэмплов, "
+                        f"{time.monotonic() - self.started_at:.1f} с)")
+        except OSError as e:
+            logger.error(f"Не удалось записать профиль: {e}")
+        with _session_lock:
+            if _session is self:
+                _session = None
+        if self.on_finish is not None:
+            try:
+                self.on_finish(self)
+            except Exception as e:
+                logger.error(f"Ошибка обработки готового профиля: {e}")
+
+
+def _collapse(thread_name, frame):
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    parts.append(thread_name)
+    # Формат collapsed stacks: от корня к листу через «;»
+    return ";".join(reversed(parts))
+
+
+def _write_profile(stacks):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+def top_functions(session, limit=10):
+    """Функции, чаще всего оказывавшиеся на вершине стека (включая ожидание в select/wait)."""
+    leaves = Counter()
+    for stack, count in session.stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return leaves.most_common(limit)
+
+
+def start_profiling(seconds=None, updates=None, on_finish=None, interval=PROFILE_INTERVAL):
+    """
+    Запускает сессию на seconds секунд или до обработки updates обновлений
+    (но не дольше PROFILE_MAX_SECONDS). on_finish(session) вызывается из потока
+    профайлера после записи файла. Возвращает False, если сессия уже идёт.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            return False
+        _session = _ProfileSession(seconds, updates, on_finish, interval)
+        _session.start()
+    logger.info(f"Профилирование запущено: "
+                f"{f'{seconds} с' if seconds else f'{updates} обновлений'}")
+    return True
+
+
+def stop_profiling():
+    """Останавливает текущую сессию; файл профиля запишет её поток. False — сессии нет."""
+    with _session_lock:
+        session = _session
+    if session is None:
+        return False
+    session.stop()
+    return True
+
+
+def _count_update():
+    with _session_lock:
+        session = _session
+        if session is None or session.updates_left is None:
+            return
+        session.updates_left -= 1
+        done = session.updates_left <= 0
+    if done:
+        session.stop()
+
+
+def handle_profile_signal():
+    """SIGUSR2: запускает профилирование на PROFILE_SIGNAL_SECONDS, повторный сигнал — останавливает."""
+    if not stop_profiling():
+        start_profiling(seconds=PROFILE_SIGNAL_SECONDS)
+
+
+def install_profile_signal(loop):
+    """
+    Подключает SIGUSR2 к циклу событий loop. Обработчик выполняется как обычный
+    колбэк цикла, а не посреди прерванного кода: обработчик signal.signal мог бы
+    сработать, пока этот же поток держит _session_lock в _count_update, и зависнуть.
+    """
+    if hasattr(signal, "SIGUSR2"):
+        loop.add_signal_handler(signal.SIGUSR2, handle_profile_signal)
+
+
+def span_for(func):
+    """Имя этапа для блокирующей функции по её модулю."""
+    return _MODULE_SPANS.get(getattr(func, "__module__", None), "blocking")
+
+
+@contextmanager
+def span(name):
+    """Добавляет время блока к этапу name текущего обновления (если оно отслеживается)."""
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[name] = spans.get(name, 0.0) + time.perf_counter() - start
+
+
+@contextmanager
+def trace(label, is_update=True):
+    """
+    Отслеживает обработку одного обновления (или фоновой задачи): по выходу
+    пишет в журнал общее время и время этапов, отмеченных span(). Отдаёт
+    словарь tags — то, что в него положат (например, намерение), попадёт в журнал.
+    """
+    spans = {}
+    tags = {}
+    token = _spans.set(spans)
+    start = time.perf_counter()
+    try:
+        yield tags
+    finally:
+        _spans.reset(token)
+        total_ms = (time.perf_counter() - start) * 1000
+        if is_update:
+            _count_update()
+        if total_ms >= UPDATE_TIMING_THRESHOLD_MS and logger.isEnabledFor(logging.INFO):
+            head = " ".join([label] + [f"{name}={value}" for name, value in tags.items()])
+            details = " ".join(f"{name}={seconds * 1000:.1f}" for name, seconds in sorted(spans.items()))
+            logger.info(f"{head}: {total_ms:.1f} мс ({details or 'без этапов'})")
+
+
+class TracedRequest(HTTPXRequest):
+    """Запросы к Bot API (sendMessage и др.) отмечаются этапом send."""
+
+    async def do_request(self, *args, **kwargs):
+        with span("send"):
+            return await super().do_request(*args, **kwargs)
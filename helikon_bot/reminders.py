@@ -0,0 +1,197 @@
+# reminders.py
+# Напоминания о репетициях и спектаклях из таблицы events — в том числе тем,
+# у кого нет Google Calendar. Все будущие напоминания лежат в min-куче по
+# времени отправки; в JobQueue всегда одна задача — на вершину кучи. Таблица
+# читается один раз при старте, дальше куча правится при добавлении и
+# удалении событий (add_reminders / remove_reminders).
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from broadcast import send_paced
+from db import get_upcoming_events
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# За сколько минут до начала напоминать, например 180. По умолчанию 0 —
+# напоминания выключены: у многих пользователей уже есть уведомления Google Calendar
+REMINDER_LEAD_MINUTES = int(os.environ.get("REMINDER_LEAD_MINUTES", 0))
+# Время событий в таблице — местное время театра
+REMINDER_TIMEZONE = ZoneInfo(os.environ.get("REMINDER_TIMEZONE", "Europe/Moscow"))
+# Напоминания, наступающие в пределах окна, отправляются одним запуском задачи (секунды)
+REMINDER_BATCH_WINDOW = 1.0
+# Куча перестраивается, когда удалённых записей в ней больше половины (и больше этого числа)
+COMPACT_MIN_DEAD = 1000
+
+# Записи кучи: (fire_at, seq, event). Удаление ленивое: запись считается
+# живой, только пока её же объект лежит в _live; остальные выбрасываются,
+# когда доходят до вершины, или все разом при перестройке.
+_heap = []
+# (telegram_id, event_name, date) -> {start_time: запись кучи}
+_live = {}
+_dead = 0
+_seq = itertools.count()
+_enabled = False
+_job = None
+_job_at = None
+
+REMINDERS_SCHEDULED = Gauge("reminders_scheduled", "Запланированные напоминания",
+                            function=lambda: len(_heap) - _dead)
+REMINDERS_SENT = Counter("reminders_sent_total", "Отправленные напоминания по результату", ["status"])
+
+
+def _event_key(event):
+    return event["telegram_id"], event["event_name"], event["date"]
+
+
+def _fire_at(event):
+    """Момент напоминания (timestamp) или None, если дата или время не разбираются."""
+    try:
+        start = datetime.strptime(f"{event['date']} {event['start_time']}", "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return None
+    return start.replace(tzinfo=REMINDER_TIMEZONE).timestamp() - REMINDER_LEAD_MINUTES * 60
+
+
+def _is_live(entry):
+    event = entry[2]
+    return _live.get(_event_key(event), {}).get(event["start_time"]) is entry
+
+
+def _put(event, now):
+    """
+    Добавляет или заменяет напоминание; возвращает запись или None, если его время
+    уже прошло. Такие не досылаются: после перезапуска бота это были бы повторы.
+    """
+    global _dead
+    fire_at = _fire_at(event)
+    if fire_at is None or fire_at <= now:
+        return None
+    entry = (fire_at, next(_seq), event)
+    slots = _live.setdefault(_event_key(event), {})
+    if event["start_time"] in slots:
+        _dead += 1
+    slots[event["start_time"]] = entry
+    return entry
+
+
+def _compact():
+    global _heap, _dead
+    if _dead > COMPACT_MIN_DEAD and _dead * 2 > len(_heap):
+        _heap = [entry for entry in _heap if _is_live(entry)]
+        heapq.heapify(_heap)
+        _dead = 0
+
+
+def _prune_top():
+    global _dead
+    while _heap and not _is_live(_heap[0]):
+        heapq.heappop(_heap)
+        _dead -= 1
+
+
+def _reschedule(job_queue):
+    """Держит единственную задачу JobQueue на времени вершины кучи."""
+    global _job, _job_at
+    _prune_top()
+    if not _heap:
+        return
+    top = _heap[0][0]
+    if _job is not None and _job_at <= top:
+        # Задача сработает не позже нужного и сама перепланируется
+        return
+    if _job is not None:
+        _job.schedule_removal()
+    _job = job_queue.run_once(reminder_job, when=max(0.0, top - time.time()), name="reminders")
+    _job_at = top
+
+
+def add_reminders(job_queue, telegram_id, events):
+    """
+    Планирует напоминания для только что записанных событий (формат как у
+    db.add_event). Повторная запись того же события переносит напоминание.
+    """
+    if not _enabled:
+        return
+    now = time.time()
+    for event in events:
+        entry = _put(dict(event, telegram_id=telegram_id), now)
+        if entry is not None:
+            heapq.heappush(_heap, entry)
+    _compact()
+    _reschedule(job_queue)
+
+
+def remove_reminders(job_queue, telegram_id, event_name, date):
+    """Снимает напоминания удалённого события (всех его сеансов в этот день)."""
+    global _dead
+    if not _enabled:
+        return
+    removed = _live.pop((telegram_id, event_name, date), None)
+    if removed:
+        _dead += len(removed)
+        _compact()
+        _reschedule(job_queue)
+
+
+def _reminder_text(event):
+    return (f"⏰ Напоминание: {event['date']} в {event['start_time']} — "
+            f"{event['event_type']} «{event['event_name']}» в зале {event['hall']}.")
+
+
+async def reminder_job(context):
+    """Отправляет наступившие напоминания и переносит задачу на следующее."""
+    global _job, _job_at, _dead
+    _job = _job_at = None
+    now = time.time()
+    due = []
+    while _heap and _heap[0][0] <= now + REMINDER_BATCH_WINDOW:
+        entry = heapq.heappop(_heap)
+        if not _is_live(entry):
+            _dead -= 1
+            continue
+        event = entry[2]
+        slots = _live[_event_key(event)]
+        del slots[event["start_time"]]
+        if not slots:
+            del _live[_event_key(event)]
+        due.append(event)
+
+    # У всего оркестра одно и то же время начала, поэтому напоминания приходят
+    # пачками: они идут через общий с рассылками лимит скорости, а на 429
+    # отправка выжидает retry_after и повторяется (broadcast.send_paced)
+    results = await asyncio.gather(*(
+        send_paced(context.bot, event["telegram_id"], [_reminder_text(event)], counter=REMINDERS_SENT)
+        for event in due
+    ))
+    for event, result in zip(due, results):
+        if result == "error":
+            logger.error(f"Не удалось отправить напоминание {event['telegram_id']} "
+                         f"о «{event['event_name']}» {event['date']}")
+
+    _reschedule(context.job_queue)
+
+
+def schedule_reminders(job_queue):
+    """Загружает будущие события из БД в кучу и планирует первое напоминание."""
+    global _enabled
+    if REMINDER_LEAD_MINUTES <= 0:
+        logger.info("Напоминания выключены (REMINDER_LEAD_MINUTES=0)")
+        return
+    _enabled = True
+    now = time.time()
+    today = datetime.now(REMINDER_TIMEZONE).date()
+    for event in get_upcoming_events(today):
+        entry = _put(event, now)
+        if entry is not None:
+            _heap.append(entry)
+    # Куча из всех событий строится за O(n), а не n вставками
+    heapq.heapify(_heap)
+    logger.info(f"Запланировано напоминаний: {len(_heap) - _dead}")
+    _reschedule(job_queue)
@@ -0,0 +1,86 @@
+# schedule_cache.py
+# Недельные расписания пользователей в памяти: (telegram_id, понедельник) ->
+# события недели и готовые тексты ответов. Расписание меняется только через
+# db.add_event / add_events / delete_event, и они сбрасывают ровно те недели,
+# которых коснулись (invalidate).
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from metrics import Counter
+
+# Сколько недель (пользователь + неделя) держать в памяти
+SCHEDULE_CACHE_SIZE = int(os.environ.get("SCHEDULE_CACHE_SIZE", 5000))
+
+# Ключ -> {"events": [...], "replies": {вид ответа: текст}}; порядок — LRU
+_entries = OrderedDict()
+# Чтения идут из потоков пула (db.py) и из цикла событий (bot.py)
+_lock = threading.Lock()
+# Растёт при каждой инвалидации: результат запроса, начатого раньше записи,
+# в кэш уже не попадёт
+_generation = 0
+
+SCHEDULE_CACHE_REQUESTS = Counter("schedule_cache_requests_total", "Обращения к кэшу расписаний", ["result"])
+
+
+def monday_of(day):
+    return day - timedelta(days=day.weekday())
+
+
+def generation():
+    return _generation
+
+
+def get(telegram_id, monday):
+    """
+    Запись кэша для недели, начинающейся в monday, или None. Учитывается в
+    schedule_cache_requests_total — вызывать один раз на запрос пользователя.
+    """
+    key = (telegram_id, monday)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+    SCHEDULE_CACHE_REQUESTS.inc(result="hit" if entry is not None else "miss")
+    return entry
+
+
+def put(telegram_id, monday, events, since_generation):
+    """
+    Кладёт события недели, прочитанные из БД, и возвращает новую запись.
+    since_generation — generation() до запроса: если с тех пор расписание
+    менялось, результат не кэшируется и возвращается None.
+    """
+    with _lock:
+        if since_generation != _generation:
+            return None
+        entry = _entries[(telegram_id, monday)] = {"events": events, "replies": {}}
+        while len(_entries) > SCHEDULE_CACHE_SIZE:
+            _entries.popitem(last=False)
+    return entry
+
+
+def invalidate(telegram_id, dates):
+    """Сбрасывает недели пользователя, в которые попадают даты dates (строки YYYY-MM-DD)."""
+    global _generation
+    mondays = set()
+    whole_user = False
+    for value in dates:
+        try:
+            mondays.add(monday_of(date.fromisoformat(value)))
+        except (TypeError, ValueError):
+            whole_user = True
+    with _lock:
+        _generation += 1
+        if whole_user:
+            mondays.update(monday for tid, monday in _entries if tid == telegram_id)
+        for monday in mondays:
+            _entries.pop((telegram_id, monday), None)
+
+
+def clear():
+    global _generation
+    with _lock:
+        _generation += 1
+        _entries.clear()
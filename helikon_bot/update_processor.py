@@ -0,0 +1,50 @@
+# update_processor.py
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений: до max_concurrent_updates одновременно,
+    но сообщения одного чата — строго по очереди, в порядке поступления.
+    Иначе «что у меня на неделе?» и следующее за ним «да» могли бы обработаться
+    в обратном порядке.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [asyncio.Lock, число ожидающих]
+        self._chat_locks = {}
+
+    async def process_update(self, update, coroutine):
+        # Сначала очередь своего чата, и только потом место среди max_concurrent_updates
+        # (семафор берёт BaseUpdateProcessor.process_update). В обратном порядке
+        # обновления одного занятого чата, ожидая своей очереди, заняли бы все места,
+        # и остальные чаты стояли бы без дела.
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+
+        slot = self._chat_locks.get(chat.id)
+        if slot is None:
+            slot = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self._chat_locks.pop(chat.id, None)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
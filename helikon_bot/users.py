@@ -0,0 +1,81 @@
+# users.py
+# Реестр пользователей в памяти: таблица users пишется, только когда появился
+# новый пользователь или изменился профиль, и не на каждое сообщение, а
+# пачками раз в USER_FLUSH_DELAY секунд.
+import asyncio
+import logging
+import os
+
+from db import get_user_ids, upsert_users
+from executor import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд копить новых пользователей перед записью
+USER_FLUSH_DELAY = float(os.environ.get("USER_FLUSH_DELAY", 2))
+
+# telegram_id -> (name, instrument), которые уже есть в БД; None в профиле — «не знаем, не трогаем»
+_known = {}
+# Ожидают записи: telegram_id -> (name, instrument)
+_pending = {}
+_flush_task = None
+
+
+def load_known_users():
+    """Заполняет реестр теми, кто уже есть в таблице users (при старте бота)."""
+    _known.update(dict.fromkeys(get_user_ids(), (None, None)))
+    logger.info(f"Известных пользователей: {len(_known)}")
+
+
+def remember_user(telegram_id, name=None, instrument=None):
+    """
+    Отмечает пользователя, написавшего боту. Запись в БД нужна только для новых
+    пользователей и при смене name/instrument (None — оставить как есть);
+    она выполняется позже, пачкой. Вызывается из цикла событий.
+    """
+    known = _known.get(telegram_id)
+    if known is not None and (name is None or name == known[0]) and (instrument is None or instrument == known[1]):
+        return
+    if known is not None:
+        name = name if name is not None else known[0]
+        instrument = instrument if instrument is not None else known[1]
+    _known[telegram_id] = (name, instrument)
+    _pending[telegram_id] = (name, instrument)
+    _schedule_flush()
+
+
+def _schedule_flush():
+    global _flush_task
+    if _flush_task is None:
+        _flush_task = asyncio.get_running_loop().create_task(_flush_later())
+
+
+async def _flush_later():
+    global _flush_task
+    try:
+        await asyncio.sleep(USER_FLUSH_DELAY)
+    finally:
+        # Если задачу отменил flush_users, remember_user мог уже запланировать новую
+        if _flush_task is asyncio.current_task():
+            _flush_task = None
+    await flush_users()
+
+
+async def flush_users():
+    """Записывает накопленных пользователей одной транзакцией (и при остановке бота)."""
+    global _pending, _flush_task
+    if _flush_task is not None and _flush_task is not asyncio.current_task():
+        # Отложенная запись больше не нужна — пишем всё сейчас
+        _flush_task.cancel()
+        _flush_task = None
+    if not _pending:
+        return
+    batch, _pending = _pending, {}
+    try:
+        await run_blocking(upsert_users, [(telegram_id, name, instrument)
+                                          for telegram_id, (name, instrument) in batch.items()])
+    except Exception as e:
+        logger.error(f"Не удалось сохранить пользователей ({len(batch)}): {e}")
+        for telegram_id, profile in batch.items():
+            _pending.setdefault(telegram_id, profile)
+        _schedule_flush()
@@ -1,6 +1,12 @@
 # bot.py
 import logging
-from telebot import TeleBot, types
+import os
+import signal
+from telebot import types
+
+from chat_workers import ConcurrentTeleBot
+from media import MediaRegistry
+from metrics import Counter, Gauge, Histogram, start_metrics_server, timed
 
 # Настройка логирования
 logging.basicConfig(
@@ -10,15 +16,30 @@ logging.basicConfig(
 
 # Инициализация бота
 TOKEN = '123456789*****'
-bot = TeleBot(TOKEN)
+# Сколько чатов обслуживается одновременно; сообщения одного чата — по очереди
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 8))
+# Сколько обновлений может ждать в очереди каждого потока
+BOT_QUEUE_SIZE = int(os.environ.get('BOT_QUEUE_SIZE', 100))
+# Сколько ждать обработки очередей при остановке (systemd TimeoutStopSec должен быть больше)
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 30))
+bot = ConcurrentTeleBot(TOKEN, workers=BOT_WORKERS, queue_size=BOT_QUEUE_SIZE)
+# Где хранятся file_id уже загруженных в Telegram файлов из static
+MEDIA_IDS_FILE = os.environ.get('MEDIA_IDS_FILE', 'media_ids.json')
+media = MediaRegistry(MEDIA_IDS_FILE)
+STICKER_PATH = './static/Mikky.webp'
+
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Время обработки сообщения по обработчикам", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+PENDING_UPDATES = Gauge("bot_pending_updates", "Обновления в очередях потоков, ещё не взятые в работу",
+                        function=bot.pool.pending)
 
 @bot.message_handler(commands=['start'])
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="start")
 def start_message(message):
     bot.send_message(message.chat.id, f'Привет, {message.chat.first_name}!')
 
     try:
-        with open('./static/1.PNG', 'rb') as sticker:
-            bot.send_sticker(message.chat.id, sticker)
+        media.send(bot, message.chat.id, STICKER_PATH, kind="sticker")
     except FileNotFoundError:
         logging.error("Стикер не найден")
 
@@ -28,6 +49,7 @@ def start_message(message):
     bot.send_message(message.chat.id, 'Для регистрации на сайте нажмите на Кнопку, далее на ссылку', reply_markup=markup)
 
 @bot.message_handler(content_types=['text'])
+@timed(HANDLER_SECONDS, HANDLER_ERRORS, handler="text")
 def message_reply(message):
     if message.text == "Кнопка":
         bot.send_message(message.chat.id, "https://flask.cubinez.ru")
@@ -38,8 +60,19 @@ def message_reply(message):
     elif message.text == "Кнопка 2":
         bot.send_message(message.chat.id, 'Спасибо за регистрацию!')
 
+def stop(signum, frame):
+    # Polling завершится после текущего getUpdates, дальше main() дообработает очереди
+    logging.info("Получен сигнал остановки, бот завершает работу...")
+    bot.stop_polling()
+
 def main():
+    # /metrics для Prometheus, если задан METRICS_PORT
+    start_metrics_server()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
     bot.infinity_polling()
+    bot.shutdown(SHUTDOWN_TIMEOUT)
+    logging.info("Бот остановлен")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
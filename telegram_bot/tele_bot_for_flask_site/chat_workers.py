@@ -0,0 +1,146 @@
+# chat_workers.py
+# Параллельная обработка обновлений TeleBot: фиксированный пул потоков,
+# обновления одного чата всегда попадают в один поток и идут по порядку.
+import logging
+import queue
+import threading
+import time
+
+from telebot import TeleBot
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _chat_id(update):
+    """Чат, к которому относится обновление; None — если чата нет (inline-запросы и т.п.)."""
+    for name in ("message", "edited_message", "callback_query", "my_chat_member", "chat_member",
+                 "chat_join_request", "business_message", "edited_business_message"):
+        item = getattr(update, name, None)
+        if item is None:
+            continue
+        if name == "callback_query":
+            item = item.message
+            if item is None:
+                return None
+        return item.chat.id
+    return None
+
+
+class ChatWorkerPool:
+    """
+    workers потоков со своей очередью каждый. Чат закреплён за потоком по
+    chat_id % workers, поэтому его сообщения обрабатываются строго по очереди,
+    а разные чаты — параллельно. Очереди ограничены queue_size: если потоки не
+    успевают, submit() ждёт, и бот просто позже забирает новые обновления у Telegram.
+    """
+
+    def __init__(self, handle, workers=8, queue_size=100):
+        self.handle = handle
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._round_robin = 0
+        for index, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(q,), name=f"chat-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_id, item):
+        if chat_id is None:
+            # Без чата порядок не важен — раскладываем по кругу
+            self._round_robin += 1
+            index = self._round_robin % len(self._queues)
+        else:
+            index = chat_id % len(self._queues)
+        self._queues[index].put(item)
+
+    def pending(self):
+        """Обновления, ещё не взятые в работу (для метрик)."""
+        return sum(q.qsize() for q in self._queues)
+
+    def close(self, timeout=None):
+        """
+        Дожидается обработки всего, что уже поставлено в очереди, и останавливает
+        потоки. timeout — общий срок на весь пул, а не на каждый поток.
+        Возвращает True, если все потоки успели завершиться.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        for q in self._queues:
+            try:
+                q.put(_STOP, timeout=remaining())
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(remaining())
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def _work(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            try:
+                self.handle(item)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления: {e}", exc_info=True)
+
+
+class ConcurrentTeleBot(TeleBot):
+    """
+    TeleBot, который раздаёт обновления по ChatWorkerPool. Сам бот работает
+    в непоточном режиме (threaded=False): обработчики вызываются прямо в потоке
+    пула, а получение обновлений не ждёт, пока ответит send_message.
+    """
+
+    def __init__(self, token, workers=8, queue_size=100, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.pool = ChatWorkerPool(self._process_update, workers, queue_size)
+        # update_id, отданные в пул и ещё не обработанные
+        self._unfinished = set()
+        self._unfinished_lock = threading.Lock()
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Обычно это делает TeleBot.process_new_updates; без этого следующий
+            # getUpdates вернул бы те же обновления
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            with self._unfinished_lock:
+                self._unfinished.add(update.update_id)
+            self.pool.submit(_chat_id(update), update)
+
+    def _process_update(self, update):
+        try:
+            super().process_new_updates([update])
+        finally:
+            with self._unfinished_lock:
+                self._unfinished.discard(update.update_id)
+
+    def shutdown(self, timeout=None):
+        """
+        Дообрабатывает полученные обновления (не дольше timeout секунд на весь пул)
+        и подтверждает Telegram обработанные, чтобы после перезапуска они не пришли
+        повторно. Подтверждается только непрерывный обработанный префикс: если пул
+        не успел, необработанные и всё после них Telegram пришлёт снова.
+        Вызывать после остановки polling.
+        """
+        self.pool.close(timeout)
+        with self._unfinished_lock:
+            unfinished = min(self._unfinished) if self._unfinished else None
+        if unfinished is None:
+            confirmed = self.last_update_id
+        else:
+            logger.warning(f"Пул не успел обработать обновления за {timeout} с; "
+                           f"подтверждаются только обновления до {unfinished - 1}")
+            confirmed = unfinished - 1
+        if confirmed > 0:
+            try:
+                # Запрос с offset подтверждает всё до confirmed включительно
+                self.get_updates(offset=confirmed + 1, limit=1, timeout=5, long_polling_timeout=0)
+            except Exception as e:
+                logger.error(f"Не удалось подтвердить обработанные обновления: {e}")
@@ -0,0 +1,120 @@
+# media.py
+# Реестр file_id: каждый файл из static загружается в Telegram один раз,
+# дальше отправляется по file_id. Если содержимое файла изменилось (другой
+# sha256), он загружается заново.
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Способ отправки -> как достать file_id из ответа Telegram
+_FILE_IDS = {
+    "sticker": lambda message: message.sticker.file_id,
+    "photo": lambda message: message.photo[-1].file_id,
+    "document": lambda message: message.document.file_id,
+}
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaRegistry:
+    """
+    Соответствие «путь -> sha256 и file_id», сохраняемое в JSON-файл.
+    file_id привязан к токену бота: при смене бота файл реестра нужно удалить
+    (или он сам обновится — отклонённый file_id приводит к повторной загрузке).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = self._load()
+        self._lock = threading.Lock()
+        # Путь -> блокировка: при наплыве /start файл загружается один раз,
+        # остальные потоки ждут и отправляют уже по file_id
+        self._upload_locks = {}
+        # Путь -> ((mtime, size), sha256): не перечитываем файл, пока он не менялся
+        self._hashes = {}
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать реестр медиа {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить реестр медиа {self.path}: {e}")
+
+    def _file_hash(self, path):
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        sha256 = _sha256(path)
+        self._hashes[path] = (signature, sha256)
+        return sha256
+
+    def _cached_file_id(self, path, sha256):
+        entry = self._entries.get(path)
+        if entry is not None and entry["sha256"] == sha256:
+            return entry["file_id"]
+        return None
+
+    def _forget(self, path):
+        with self._lock:
+            if self._entries.pop(path, None) is not None:
+                self._save()
+
+    def send(self, bot, chat_id, path, kind="sticker", **kwargs):
+        """
+        Отправляет файл способом kind (sticker, photo, document). Если файла нет —
+        FileNotFoundError, как при обычном open().
+        """
+        send_method = getattr(bot, f"send_{kind}")
+        sha256 = self._file_hash(path)
+
+        file_id = self._cached_file_id(path, sha256)
+        if file_id is not None:
+            try:
+                return send_method(chat_id, file_id, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                # file_id не принят (например, сменился токен бота) — загрузим заново
+                logger.warning(f"file_id для {path} отклонён: {e}")
+                self._forget(path)
+
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(path, threading.Lock())
+        with upload_lock:
+            # Пока ждали, файл мог загрузить другой поток
+            file_id = self._cached_file_id(path, sha256)
+            if file_id is not None:
+                return send_method(chat_id, file_id, **kwargs)
+            with open(path, "rb") as f:
+                message = send_method(chat_id, f, **kwargs)
+            with self._lock:
+                self._entries[path] = {"sha256": sha256, "file_id": _FILE_IDS[kind](message)}
+                self._save()
+            logger.info(f"Файл {path} загружен в Telegram, дальше отправляется по file_id")
+            return message
@@ -0,0 +1,206 @@
+# metrics.py
+# Метрики бота в текстовом формате Prometheus, без внешних зависимостей: время
+# и ошибки обработчиков сообщений, очередь пула потоков. Эндпоинт /metrics
+# поднимается на локальном порту из METRICS_PORT (см. start_metrics_server).
+# Сокращённая копия helikon_bot/metrics.py: формат вывода и общие части
+# (Counter, Gauge, Histogram, timed, start_metrics_server) держать в синхронизации.
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # function() возвращает значение, которое ведётся в другом месте (очередь
+        # пула потоков): число или словарь {значение метки или кортеж: число}
+        self.function = function
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            if name in _registry:
+                raise ValueError(f"Метрика {name} уже зарегистрирована")
+            _registry[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _collect(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.error(f"Не удалось получить значение {self.name}: {e}")
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        with self._lock:
+            self._values = {(k if isinstance(k, tuple) else (str(k),)): v for k, v in value.items()}
+
+    def render(self):
+        if self.function is not None:
+            self._collect()
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение, которое считывается function() при опросе."""
+    kind = "gauge"
+
+
+class Histogram(_Metric):
+    """Распределение значений (обычно длительностей в секундах) по корзинам."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def timed(histogram, errors=None, **labels):
+    """
+    Декоратор обработчика TeleBot: время каждого вызова — в histogram,
+    исключения — в счётчик errors, с метками labels.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Все зарегистрированные метрики в текстовом формате Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # Зависший клиент не должен надолго занимать единственный поток сервера
+    timeout = 10
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Опросы раз в несколько секунд не должны засорять журнал бота
+        pass
+
+
+def start_metrics_server(port=None, host=METRICS_HOST):
+    """
+    Поднимает /metrics в фоновом потоке. Порт — аргумент или METRICS_PORT;
+    если не задан ни тот, ни другой, эндпоинт не запускается. Возвращает сервер или None.
+    Запросы обслуживаются по одному в этом же потоке: опросы Prometheus редки
+    и быстры, а отдельный поток на каждый запрос не нужен.
+    """
+    if port is None:
+        port = os.environ.get("METRICS_PORT")
+        if not port:
+            return None
+    try:
+        server = HTTPServer((host, int(port)), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Не удалось открыть порт метрик {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{server.server_address[1]}/metrics")
+    return server